@@ -16,19 +16,40 @@
 
 
 import argparse
+import json
 import os
 import shutil
+import time
 from concurrent.futures import ProcessPoolExecutor, as_completed
-from typing import Optional
+from typing import List, Optional, Tuple
 
-from google.cloud import bigquery
-from google.cloud.bigquery import SourceFormat
-
-from openaire.bigquery import bq_create_dataset, bq_load_table
+from openaire.admission import DEFAULT_EXPANSION_RATIO, AdmissionController
+from openaire.autotune import CHUNK_ALIGNMENT, create_tuner
+from openaire.batch_transform import transform_part_in_batches
 from openaire.config import create_config
-from openaire.data import download_from_zenodo_wget, remove_nulls
-from openaire.files import decompress_tar_gz, get_chunks
-from openaire.gcs import gcs_upload_files
+from openaire.data import download_from_zenodo_wget, run_pipeline, transform_file, transform_to_sink
+from openaire.dedup import dedup_table
+from openaire.download_cache import DownloadCache
+from openaire.files import decompress_tar_gz
+from openaire.graph import export_relation_graph
+from openaire.history import RunHistory
+from openaire.id_index import build_id_index
+from openaire.integrity import check_relation_integrity
+from openaire.model import Table
+from openaire.pid_index import RESULT_TABLES, build_pid_index
+from openaire.pipeline import CollectStats
+from openaire.plan import STAGES, format_plan, plan_to_dict, plan_workflow
+from openaire.profiling import enable_profiling, profile_stage, worker_task
+from openaire.progress import Progress, format_bytes, largest_first, total_size
+from openaire.sample import DEFAULT_SAMPLE_BYTES, SAMPLE_SUFFIX, TABLE_RELATION_TYPE, sample_tar
+from openaire.shard import apply_shard, create_manifest, parse_shard, part_key
+from openaire.workers import (
+    benchmark_startup,
+    format_benchmark,
+    set_worker_pool_size,
+    shutdown_worker_pools,
+    worker_pool,
+)
 
 
 class OpenAIREWorkflow:
@@ -39,26 +60,204 @@ class OpenAIREWorkflow:
         self,
         max_processors: int = 7,
         config_path: Optional[str] = "config.yaml",
+        shard: Optional[Tuple[int, int]] = None,
+        tables: Optional[List[str]] = None,
+        sample: Optional[float] = None,
+        sample_seed: int = 0,
+        sample_bytes: int = DEFAULT_SAMPLE_BYTES,
     ):
         self.max_processors = max_processors
         self.config_path = config_path
+        self.shard_index, self.num_shards = shard if shard else (0, 1)
+        self.sample_fraction = sample
+        self.sample_seed = sample_seed
+        self.sample_bytes = sample_bytes
 
         ### Read in the config file and get the required.
-        self.cloud_workspace, self.workflow_config = create_config(self.config_path)
+        # A sample run has its own suffixed data folders, GCS folder and dataset, so it never overwrites a full run.
+        self.cloud_workspace, self.workflow_config = create_config(
+            self.config_path, suffix=SAMPLE_SUFFIX if self.is_sample else ""
+        )
+
+        # Only process a subset of the tables in the config file, if given.
+        if tables:
+            unknown = set(tables) - {table.name for table in self.workflow_config.tables}
+            assert not unknown, f"Tables not found in the config file: {sorted(unknown)}"
+            self.workflow_config.tables = [table for table in self.workflow_config.tables if table.name in tables]
         self.tables = self.workflow_config.tables
 
+        # Throughput and ratios measured in previous runs, used by the plan. A sample run keeps its own history, so that
+        # its measurements of small parts are not where the next full run starts.
+        history_file = f"run_history{SAMPLE_SUFFIX if self.is_sample else ''}.json"
+        self.history = RunHistory(os.path.join(self.workflow_config.cache_folder, history_file))
+
+        # When sharded, only process the parts assigned to this shard that are not already in the shared manifest.
+        self.manifest = None
+        if self.is_sharded:
+            self.manifest = create_manifest(self.workflow_config.manifest_path)
+            self.tables = apply_shard(
+                self.workflow_config.tables, self.shard_index, self.num_shards, done=self.manifest.done_keys()
+            )
+            print(f"Shard {self.shard_index}/{self.num_shards}: processing tables {[t.name for t in self.tables]}")
+
+        # Streams of a table are committed together by the machine that wrote them, which needs every part of it.
+        assert not (
+            self.is_sharded and self.workflow_config.sink == "bigquery"
+        ), f"The bigquery sink cannot be used with --shard, use the gcs sink instead."
+        assert not (self.is_sharded and self.is_sample), f"A sample run cannot be sharded."
+        if self.is_sample:
+            assert 0 < self.sample_fraction <= 1, f"The sample fraction must be between 0 and 1: {self.sample_fraction}"
+
+    @property
+    def is_sharded(self) -> bool:
+        return self.num_shards > 1
+
+    @property
+    def is_sample(self) -> bool:
+        return self.sample_fraction is not None
+
+    @property
+    def is_coordinator(self) -> bool:
+        """Whether this node runs the BigQuery import, the first shard when sharded."""
+
+        return self.shard_index == 0
+
+    @property
+    def default_stages(self) -> List[str]:
+        """The stages run when none are selected, the integrity check, pid index, graph export and relation subsets only
+        if they are enabled in the config."""
+
+        optional = {
+            "dedup": bool(self.workflow_config.dedup),
+            "integrity_check": self.workflow_config.integrity_check,
+            "pid_index": bool(self.workflow_config.pid_schemes),
+            "graph_export": self.workflow_config.graph_export,
+            "relation_subsets": bool(self.workflow_config.relation_subsets),
+        }
+        return [stage for stage in STAGES if optional.get(stage, True)]
+
+    def plan(self, stages: List[str]):
+        """Plan - estimate the wall time, disk, memory and cloud bytes of each stage, without running anything."""
+
+        print(f"----------------------------------------------------")
+        print(f"Plan - Estimating the cost of stages {stages} for tables {[table.name for table in self.tables]}.")
+
+        max_workers = os.cpu_count() or self.max_processors
+        estimates = plan_workflow(
+            self.tables,
+            stages,
+            self.history,
+            max_processors=max_workers,
+            column_stats=self.workflow_config.column_stats,
+            dedup_bloom_bytes=self.workflow_config.dedup_bloom_bytes,
+        )
+        print(format_plan(estimates))
+
+        plan_path = os.path.join(self.workflow_config.report_folder, "plan.json")
+        with open(plan_path, "w") as f:
+            json.dump(plan_to_dict(estimates), f, indent=2)
+
+        print(f"Stages marked 'default' have no measurements from a previous run yet, see {self.history.path}")
+        print(f"Plan written to: {plan_path}")
+        print(f"----------------------------------------------------")
+
     def download(self):
         """Download files for a list of given tables from Zenodo."""
 
+        if self.is_sample:
+            self.download_sample()
+            return
+
         print(f"----------------------------------------------------")
         print(f"Download - Downloads the *.tar parts for each table from Zenodo.")
 
+        progress = Progress("Download", sum(table.download_size for table in self.tables))
+
+        # Files in the shared download cache are linked in rather than downloaded again.
+        cache = None
+        if self.workflow_config.download_cache_path:
+            cache = DownloadCache(self.workflow_config.download_cache_path, self.workflow_config.download_cache_bytes)
+
         # Loop though the tables and download the part table files.
+        cached_bytes = 0
         for table in self.tables:
+            checksums = table.download_checksums
             for url, output_path in table.download_paths.items():
-                download_from_zenodo_wget(url=url, output_path=output_path)
+                cached = cache is not None and checksums.get(url) is not None and checksums[url] in cache
+                success = download_from_zenodo_wget(
+                    url=url, output_path=output_path, checksum=checksums.get(url), cache=cache
+                )
+                assert success, f"Table {table.name}: unable to download {url}"
+                progress.update(os.path.getsize(output_path), label=os.path.basename(output_path))
+                if cached:
+                    cached_bytes += os.path.getsize(output_path)
+
+        if cache:
+            print(f"Linked {format_bytes(cached_bytes)} from the download cache, now {format_bytes(cache.size())}.")
+
+        # Files from the cache would inflate the measured download rate.
+        self.history.record("download", progress.done_bytes - cached_bytes, progress.elapsed)
+
+        print(f"----------------------------------------------------")
+
+    def download_sample(self):
+        """Download sample - stream the start of each *.tar part from Zenodo and extract a deterministic sample of its
+        rows, instead of downloading and decompressing the whole release.
+
+        The entity tables are sampled first. The relation table is then sampled with the ids they gave, so that its
+        edges only link entities of the sample."""
 
         print(f"----------------------------------------------------")
+        print(
+            f"Download sample - Sampling {self.sample_fraction} of the ids with seed {self.sample_seed}, reading at "
+            f"most {format_bytes(self.sample_bytes)} of each table from Zenodo."
+        )
+
+        entity_tables = [table for table in self.tables if table.name != "relation"]
+        relation_tables = [table for table in self.tables if table.name == "relation"]
+        progress = Progress("Download sample", self.sample_bytes * len(self.tables))
+
+        # Part files of a previous sample would be mixed in with this one.
+        for table in self.tables:
+            shutil.rmtree(table.part_location, ignore_errors=True)
+            os.makedirs(table.part_location, exist_ok=True)
+
+        sampled_ids = {}
+        report = {"fraction": self.sample_fraction, "seed": self.sample_seed, "max_bytes": self.sample_bytes}
+        with worker_pool(self.max_processors) as executor:
+            for tables in (entity_tables, relation_tables):
+                relation_ids = sampled_ids if tables is relation_tables else None
+                futures = {}
+                for table in tables:
+                    # The bytes of the table are split over its parts, so the sample is drawn from every part.
+                    urls = list(table.download_paths.keys())
+                    part_bytes = max(self.sample_bytes // len(urls), 1)
+                    for url in urls:
+                        args = (url, table.decompress_folder, table.name)
+                        args += (self.sample_fraction, self.sample_seed, part_bytes, relation_ids)
+                        futures[executor.submit(worker_task(sample_tar), *args)] = table
+
+                for future in as_completed(futures):
+                    table = futures[future]
+                    ids, counts = future.result()
+                    if table.name in TABLE_RELATION_TYPE:
+                        sampled_ids.setdefault(TABLE_RELATION_TYPE[table.name], set()).update(ids)
+                    table_report = report.setdefault(table.name, {})
+                    for key, value in counts.items():
+                        table_report[key] = table_report.get(key, 0) + value
+                    progress.update(counts["bytes_read"], label=table.name)
+
+        for table in self.tables:
+            print(
+                f"Table {table.name}: kept {report[table.name]['rows_kept']} of {report[table.name]['rows_read']} rows"
+            )
+
+        report_path = os.path.join(self.workflow_config.report_folder, "sample.json")
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+        print(f"Sample report written to: {report_path}")
+        print(f"----------------------------------------------------")
 
     def decompress(self):
         """Expand the downloaded files for each table."""
@@ -66,6 +265,9 @@ class OpenAIREWorkflow:
         print(f"----------------------------------------------------")
         print(f"Decompress - Decompress the table *.tar parts.")
 
+        download_files = [path for table in self.tables for path in table.download_paths.values()]
+        progress = Progress("Decompress", total_size(download_files))
+
         # Decompress each of the downloaded files.
         for table in self.tables:
             print(f"Processing table: {table.name}")
@@ -73,38 +275,354 @@ class OpenAIREWorkflow:
             for download_files in table.download_paths.values():
                 print(f"Decompressing file: {download_files}")
                 decompress_tar_gz(file_path=download_files, extract_path=table.decompress_folder)
+                progress.update(os.path.getsize(download_files), label=os.path.basename(download_files))
+
+        extracted_bytes = total_size([file for table in self.tables for file in table.extracted_files])
+        self.history.record(
+            "decompress",
+            progress.done_bytes,
+            progress.elapsed,
+            output_ratio=extracted_bytes / progress.done_bytes if progress.done_bytes else None,
+        )
 
     def transform(self):
-        """Transform - remove nulls from selected top level columns in the data."""
+        """Transform - run the rows of each table through its transform pipeline, e.g. remove nulls from selected top
+        level columns in the data."""
+
+        print(f"----------------------------------------------------")
+        print(f"Transform - Running the rows of each table through its pipeline of transform stages.")
+
+        # Tables with a pipeline that only reads the rows, e.g. for their column statistics, are read but not written.
+        transform_tables = [table for table in self.tables if table.needs_transform]
+        read_files = [file for table in self.tables if table.pipeline.stages for file in table.extracted_files]
+        progress = Progress("Transform", total_size(read_files))
+        largest_part = max([os.path.getsize(file) for file in read_files] + [0])
+
+        # Memory use of a worker scales with its part file, so start tasks only when their memory fits, up to one per
+        # CPU. The starting estimate of memory per input byte is the one observed in the previous run. With autotuning,
+        # the number of tasks running at once starts from the one settled on in the previous run, or half the highest.
+        bounds = self.workflow_config.autotune_bounds
+        tuner = create_tuner(
+            "transform_workers",
+            self.history.get("transform", "transform_workers"),
+            max(1, bounds["transform_workers"][1] // 2),
+            bounds,
+            self.workflow_config.autotune,
+        )
+        max_workers = bounds["transform_workers"][1] if tuner else os.cpu_count() or self.max_processors
+        controller = AdmissionController(
+            max_workers=max_workers,
+            expansion_ratio=self.history.get("transform", "memory_ratio", DEFAULT_EXPANSION_RATIO),
+            tuner=tuner,
+        )
+
+        with worker_pool(max_workers) as executor:
+            # Use list of gz parts from previous decompress step
+            for table in self.tables:
+                print(f"Processing table: {table.name}")
+                print(f"Files to process: {table.extracted_files}")
+
+                # Each task runs its own empty copy of the pipeline, whose timings and state are merged into the
+                # pipeline of the table.
+                pipeline = table.pipeline
+
+                if table.streams_to_bigquery:
+                    self.transform_to_bigquery(table, controller, executor, progress)
+
+                elif table.needs_transform:
+                    tasks = []
+                    for file_path in table.extracted_files:
+                        basename = f"{os.path.basename(file_path).split('.')[0]}_NR.json.gz"
+                        output_path = os.path.join(os.path.dirname(file_path), basename)
+                        tasks.append((os.path.getsize(file_path), (file_path, pipeline.empty(), output_path)))
+
+                    # Large parts are split into batches of lines across every worker, one part at a time, so that a
+                    # single large part does not leave the other cores idle. The other parts get a worker each.
+                    split_bytes = self.workflow_config.split_part_bytes
+                    split_tasks = [task for task in tasks if split_bytes and task[0] >= split_bytes]
+                    tasks = [task for task in tasks if task not in split_tasks]
+                    for size, (file_path, _, output_path) in split_tasks:
+                        print(f"Transforming {file_path} in batches across up to {controller.max_workers} workers.")
+                        num_batches = transform_part_in_batches(file_path, output_path, pipeline, executor, controller)
+                        print(f"Finished transforming {table.name} in {num_batches} batches: {output_path}")
+                        progress.update(size, label=f"{table.name} {os.path.basename(file_path)}")
+
+                    for (file_path, _, output_path), part_pipeline in controller.run(
+                        executor, worker_task(transform_file), tasks
+                    ):
+                        print(f"Finished transforming {table.name}: {output_path}")
+                        progress.update(os.path.getsize(file_path), label=f"{table.name} {os.path.basename(file_path)}")
+                        pipeline.merge(part_pipeline)
+
+                    assert len(table.extracted_files) == len(
+                        table.transform_files
+                    ), f"Number of part gz files and NR are not the same: {len(table.extracted_files)} vs {len(table.transform_files)}"
+
+                elif pipeline.stages:
+                    tasks = [
+                        (os.path.getsize(file_path), (file_path, pipeline.empty()))
+                        for file_path in table.extracted_files
+                    ]
+                    for (file_path, _), part_pipeline in controller.run(executor, worker_task(run_pipeline), tasks):
+                        print(f"Finished reading {table.name}: {file_path}")
+                        progress.update(os.path.getsize(file_path), label=f"{table.name} {os.path.basename(file_path)}")
+                        pipeline.merge(part_pipeline)
+
+                if pipeline.stages:
+                    timings = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in pipeline.timings.items())
+                    print(f"Transform stages of {table.name} over {pipeline.rows} rows: {timings}")
+
+        self.write_transform_report()
+
+        file_tables = [table for table in transform_tables if not table.streams_to_bigquery]
+        transformed_bytes = total_size([file for table in file_tables for file in table.transform_files])
+        file_bytes = total_size([file for table in file_tables for file in table.extracted_files])
+        self.history.record(
+            "transform",
+            progress.done_bytes,
+            progress.elapsed,
+            output_ratio=transformed_bytes / file_bytes if file_bytes else None,
+            largest_part_bytes=largest_part or None,
+            memory_ratio=controller.observed_ratio or None,
+            transform_workers=tuner.value if tuner else None,
+        )
+
+        print(f"----------------------------------------------------")
+
+    def transform_to_bigquery(
+        self,
+        table: Table,
+        controller: AdmissionController,
+        executor: ProcessPoolExecutor,
+        progress: Progress,
+    ):
+        """Transform the parts of a table and stream them straight into BigQuery with the Storage Write API, one
+        pending stream per part. The streams are committed together once every part is written, so the table is
+        either loaded in full or left empty."""
+
+        from openaire.bigquery import bq_create_dataset
+        from openaire.sink import BigQueryWriteSink
+
+        bq_create_dataset(
+            self.cloud_workspace.project_id,
+            self.cloud_workspace.dataset_id,
+            self.cloud_workspace.data_location,
+            description="Openaire data dump",
+        )
+
+        sink = BigQueryWriteSink(
+            table_id=table.full_table_id,
+            schema_file_path=table.schema_path,
+            table_description="Openaire data dump",
+            partition_field=table.partition_field,
+            partition_type=table.partition_type,
+            clustering_fields=table.clustering_fields,
+            max_rejected=self.workflow_config.sink_max_rejected,
+        )
+        sink.create_table(overwrite=self.workflow_config.sink_overwrite)
+
+        tasks = [
+            (os.path.getsize(file_path), (file_path, table.pipeline.empty(), sink))
+            for file_path in table.extracted_files
+        ]
+
+        stream_names = []
+        rejected = {}
+        for (file_path, _, _), (stream_name, part_rejected, part_pipeline) in controller.run(
+            executor, worker_task(transform_to_sink), tasks
+        ):
+            print(f"Finished streaming {file_path} to BigQuery")
+            progress.update(os.path.getsize(file_path), label=f"{table.name} {os.path.basename(file_path)}")
+            stream_names.append(stream_name)
+            table.pipeline.merge(part_pipeline)
+            for path, count in part_rejected.items():
+                rejected[path] = rejected.get(path, 0) + count
+
+        # Values that could not be coerced to their column type were left out, as a load job would reject them.
+        if rejected:
+            print(f"Table {table.name}: {sum(rejected.values())} values rejected by the sink: {rejected}")
+        sink.check_rejected(rejected)
+
+        sink.commit(stream_names)
+        print(f"Committed {len(stream_names)} streams to table {table.full_table_id}")
+
+    def write_transform_report(self):
+        """Write the rows and the time spent in each stage of the transform pipeline of each table as a JSON report,
+        and the column statistics of the tables if collected. Each shard writes the reports of its own parts."""
+
+        shard = f"_shard_{self.shard_index}_of_{self.num_shards}" if self.is_sharded else ""
+        pipelines = {table.name: table.pipeline for table in self.tables if table.pipeline.stages}
+
+        report_path = os.path.join(self.workflow_config.report_folder, f"transform_stages{shard}.json")
+        with open(report_path, "w") as f:
+            json.dump({name: pipeline.report() for name, pipeline in pipelines.items()}, f, indent=2)
+        print(f"Transform stage timings written to: {report_path}")
+
+        table_stats = {
+            name: pipeline.stage(CollectStats.name).stats
+            for name, pipeline in pipelines.items()
+            if pipeline.stage(CollectStats.name)
+        }
+        if table_stats:
+            report_path = os.path.join(self.workflow_config.report_folder, f"column_stats{shard}.json")
+            with open(report_path, "w") as f:
+                json.dump({name: stats.to_dict() for name, stats in table_stats.items()}, f, indent=2)
+            print(f"Column statistics written to: {report_path}")
+
+    def dedup(self):
+        """Dedup - find the records that repeat the id of an earlier record of their table, across all of its part
+        files, and report them or drop them before the upload."""
 
         print(f"----------------------------------------------------")
-        print(f"Transform - Removing nulls from suspect columns.")
+        print(f"Dedup - Finding the duplicate records of each table, to {self.workflow_config.dedup} them.")
 
-        # Use list of gz parts from previous decompress step
+        start = time.time()
+        drop = self.workflow_config.dedup == "drop"
+        report = {}
         for table in self.tables:
-            print(f"Processing table: {table.name}")
-            print(f"Files to process: {table.extracted_files}")
+            # Streamed tables have no part files on disk, they were loaded as they were transformed.
+            if table.streams_to_bigquery:
+                print(f"Table {table.name} is streamed to BigQuery, not deduplicating it.")
+                continue
+
+            report[table.name] = dedup_table(
+                table.name,
+                table.transform_files,
+                tmp_folder=os.path.join(self.workflow_config.index_folder, "tmp", "dedup", table.name),
+                drop=drop,
+                max_processes=self.max_processors,
+                bloom_bytes=self.workflow_config.dedup_bloom_bytes,
+            )
+            print(
+                f"Table {table.name}: {report[table.name]['duplicates']} duplicates of "
+                f"{report[table.name]['rows']} rows{', dropped' if drop else ''}"
+            )
 
-            if table.remove_nulls:
-                for i, chunk in enumerate(get_chunks(input_list=table.extracted_files, chunk_size=7)):
-                    with ProcessPoolExecutor(max_workers=7) as executor:
-                        print(f"In chunk {i}: {chunk}")
+        report_path = os.path.join(self.workflow_config.report_folder, "dedup.json")
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Dedup report written to: {report_path}")
+
+        deduped_bytes = total_size([file for table in self.tables for file in table.transform_files])
+        self.history.record(
+            "dedup",
+            deduped_bytes,
+            time.time() - start,
+            duplicates=sum(table_report["duplicates"] for table_report in report.values()),
+        )
 
-                        futures = {}
-                        for file_path in chunk:
-                            basename = f"{os.path.basename(file_path).split('.')[0]}_NR.json.gz"
-                            output_path = os.path.join(os.path.dirname(file_path), basename)
+        print(f"----------------------------------------------------")
 
-                            future = executor.submit(remove_nulls, file_path, table.remove_nulls, output_path)
-                            futures[future] = output_path
+    def integrity_check(self):
+        """Integrity check - build a sorted id index for each entity table and check the relation table against it."""
 
-                        for future in as_completed(futures):
-                            output_path = futures[future]
-                            print(f"Finished removing nulls from column {table.remove_nulls}: {output_path}")
+        print(f"----------------------------------------------------")
+        print(f"Integrity Check - Checking relation source and target ids against the entity tables.")
+
+        relation = next((table for table in self.tables if table.name == "relation"), None)
+        if relation is None or relation.streams_to_bigquery:
+            print(f"No relation table files in the workflow, skipping the integrity check.")
+            print(f"----------------------------------------------------")
+            return
+
+        start = time.time()
+
+        # Build the id indexes for the entity tables, one table per process.
+        index_paths = {}
+        with worker_pool(self.max_processors) as executor:
+            futures = {}
+            for table in self.tables:
+                if table.name == "relation":
+                    continue
+
+                # Streamed tables have no transformed files on disk, their endpoints are reported as unchecked.
+                if table.streams_to_bigquery:
+                    print(f"Table {table.name} is streamed to BigQuery, not building its id index.")
+                    continue
+
+                output_path = os.path.join(self.workflow_config.index_folder, f"{table.name}_ids.npy")
+                tmp_folder = os.path.join(self.workflow_config.index_folder, "tmp", table.name)
+                future = executor.submit(worker_task(build_id_index), table.transform_files, output_path, tmp_folder)
+                futures[future] = (table.name, output_path)
+
+            for future in as_completed(futures):
+                name, output_path = futures[future]
+                print(f"Built id index for table {name} with {future.result()} ids: {output_path}")
+                index_paths[name] = output_path
+
+        report = check_relation_integrity(relation.transform_files, index_paths, max_processes=self.max_processors)
+
+        report_path = os.path.join(self.workflow_config.report_folder, "integrity_check.json")
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+        print(f"Relation edges checked: {report['edges']}")
+        print(f"Dangling sources: {dict(report['dangling_source'])}")
+        print(f"Dangling targets: {dict(report['dangling_target'])}")
+        print(f"Unchecked endpoints (entity table not in the workflow): {dict(report['unchecked'])}")
+        print(f"Integrity report written to: {report_path}")
+
+        checked_bytes = total_size([file for table in self.tables for file in table.transform_files])
+        self.history.record("integrity_check", checked_bytes, time.time() - start)
 
-                assert len(table.extracted_files) == len(
-                    table.transform_files
-                ), f"Number of part gz files and NR are not the same: {len(table.extracted_files)} vs {len(table.transform_files)}"
+        print(f"----------------------------------------------------")
+
+    def pid_index(self):
+        """PID index - build a local index from the persistent identifiers of the results to their OpenAIRE ids."""
+
+        print(f"----------------------------------------------------")
+        print(f"PID Index - Indexing the {self.workflow_config.pid_schemes} pids of the result tables.")
+
+        # Streamed tables have no transformed files on disk to index.
+        table_files = {
+            table.name: table.transform_files
+            for table in self.tables
+            if table.name in RESULT_TABLES and not table.streams_to_bigquery
+        }
+        if not table_files:
+            print(f"No result table files in the workflow, skipping the pid index.")
+            print(f"----------------------------------------------------")
+            return
+
+        start = time.time()
+        num_entries = build_pid_index(
+            table_files,
+            output_path=self.workflow_config.pid_index_path,
+            tmp_folder=os.path.join(self.workflow_config.index_folder, "tmp", "pid_index"),
+            schemes=set(self.workflow_config.pid_schemes),
+            max_processes=self.max_processors,
+        )
+        print(f"Indexed {num_entries} pids of tables {sorted(table_files)}: {self.workflow_config.pid_index_path}")
+
+        indexed_bytes = total_size([file for files in table_files.values() for file in files])
+        self.history.record("pid_index", indexed_bytes, time.time() - start)
+
+        print(f"----------------------------------------------------")
+
+    def graph_export(self):
+        """Graph export - save the relation table as a graph of interned ids with a CSR adjacency per relation type."""
+
+        print(f"----------------------------------------------------")
+        print(f"Graph Export - Exporting the relation table as a NumPy graph.")
+
+        relation = next((table for table in self.tables if table.name == "relation"), None)
+        if relation is None:
+            print(f"The relation table is not in the workflow, skipping the graph export.")
+            print(f"----------------------------------------------------")
+            return
+
+        # The extracted files are read, as they are on disk whichever sink the relation table is written to.
+        start = time.time()
+        summary = export_relation_graph(
+            relation.extracted_files,
+            output_folder=self.workflow_config.graph_path,
+            tmp_folder=os.path.join(self.workflow_config.index_folder, "tmp", "graph"),
+            max_processes=self.max_processors,
+        )
+        num_edges = sum(relation_type["edges"] for relation_type in summary["types"].values())
+        print(f"Exported {summary['nodes']} nodes and {num_edges} edges: {self.workflow_config.graph_path}")
+
+        self.history.record("graph_export", total_size(relation.extracted_files), time.time() - start)
 
         print(f"----------------------------------------------------")
 
@@ -114,28 +632,98 @@ class OpenAIREWorkflow:
         print(f"----------------------------------------------------")
         print(f"GCS Upload - Uploading table files to Google Cloud Storage.")
 
+        from openaire.gcs import DEFAULT_CHUNK_SIZE, gcs_upload_files
+
+        # With autotuning, the connections and chunk size start from the ones settled on in the previous run, and are
+        # tuned across all of the tables.
+        bounds = self.workflow_config.autotune_bounds
+        enabled = self.workflow_config.autotune
+        connections_tuner = create_tuner(
+            "upload_connections",
+            self.history.get("gcs_upload", "upload_connections"),
+            os.cpu_count() or self.max_processors,
+            bounds,
+            enabled,
+        )
+        chunk_tuner = create_tuner(
+            "upload_chunk_bytes",
+            self.history.get("gcs_upload", "upload_chunk_bytes"),
+            DEFAULT_CHUNK_SIZE,
+            bounds,
+            enabled,
+            doubling=True,
+            alignment=CHUNK_ALIGNMENT,
+        )
+        max_processes = bounds["upload_connections"][1] if enabled else os.cpu_count() or self.max_processors
+
+        start = time.time()
+        upload_bytes = 0
         for table in self.tables:
+            if table.streams_to_bigquery:
+                print(f"Table {table.name} was streamed to BigQuery in the transform, skipping the upload.")
+                continue
+
+            file_paths = largest_first(table.transform_files)
             uri_part_list = [
-                f"{self.cloud_workspace.bucket_folder}/{table.name}/{os.path.basename(file)}"
-                for file in table.transform_files
+                f"{self.cloud_workspace.bucket_folder}/{table.name}/{os.path.basename(file)}" for file in file_paths
             ]
 
             success = gcs_upload_files(
                 bucket_name=self.cloud_workspace.bucket_id,
-                file_paths=table.transform_files,
+                file_paths=file_paths,
                 blob_names=uri_part_list,
+                max_processes=max_processes,
+                connections_tuner=connections_tuner,
+                chunk_tuner=chunk_tuner,
             )
 
             assert success, f"Table {table.name}: Files were not successfully uploaded to GCS."
+            upload_bytes += total_size(file_paths)
+
+            if self.manifest:
+                for download_path in table.download_paths.values():
+                    self.manifest.mark_done(
+                        part_key(table, download_path),
+                        {"shard": f"{self.shard_index}/{self.num_shards}", "blobs": uri_part_list},
+                    )
+
+        self.history.record(
+            "gcs_upload",
+            upload_bytes,
+            time.time() - start,
+            upload_connections=connections_tuner.value if connections_tuner else None,
+            upload_chunk_bytes=chunk_tuner.value if chunk_tuner else None,
+        )
 
         print(f"----------------------------------------------------")
 
+    def wait_for_shards(self):
+        """Wait until every shard has recorded its uploaded parts in the manifest."""
+
+        print(f"----------------------------------------------------")
+        print(f"Wait For Shards - Waiting for all table parts to be uploaded by the other shards.")
+
+        keys = {
+            part_key(table, download_path)
+            for table in self.workflow_config.tables
+            for download_path in table.zenodo_download_paths.values()
+        }
+        self.manifest.wait_for(keys)
+
+        print(f"All {len(keys)} table parts have been uploaded.")
+        print(f"----------------------------------------------------")
+
     def bq_import(self):
         """Ingest the tables from GCS to BQ."""
 
         print(f"----------------------------------------------------")
         print(f"BQ Import - Import tables from Google Cloud Storage to Bigquery.")
 
+        from google.cloud import bigquery
+        from google.cloud.bigquery import SourceFormat
+
+        from openaire.bigquery import bq_create_dataset, bq_load_table, bq_table_num_bytes
+
         bq_create_dataset(
             self.cloud_workspace.project_id,
             self.cloud_workspace.dataset_id,
@@ -143,17 +731,79 @@ class OpenAIREWorkflow:
             description="Openaire data dump",
         )
 
-        for table in self.tables:
+        start = time.time()
+        load_tables = [table for table in self.tables if not table.streams_to_bigquery]
+        load_bytes = total_size([file for table in load_tables for file in table.transform_files])
+        bq_bytes = 0
+
+        # Import every table, including those with no parts processed on this node when sharded.
+        for table in self.workflow_config.tables:
+            if table.streams_to_bigquery:
+                print(f"Table {table.name} was streamed to BigQuery in the transform, skipping the import.")
+                continue
+
             bq_load_table(
                 uri=table.gcs_uri_pattern,
                 table_id=table.full_table_id,
                 schema_file_path=table.schema_path,
                 write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
                 source_format=SourceFormat.NEWLINE_DELIMITED_JSON,
-                ignore_unknown_values=True
+                ignore_unknown_values=True,
+                partition=bool(table.partition_field),
+                partition_field=table.partition_field,
+                partition_type=table.partition_type,
+                cluster=bool(table.clustering_fields),
+                clustering_fields=table.clustering_fields,
             )
 
             print(f"Done uploading to table! {table.full_table_id}")
+            bq_bytes += bq_table_num_bytes(table.full_table_id)
+
+        # The GCS bytes are only known here for the parts processed on this machine, so skip recording when sharded.
+        if not self.is_sharded:
+            self.history.record(
+                "bq_import",
+                load_bytes,
+                time.time() - start,
+                bq_ratio=bq_bytes / load_bytes if load_bytes else None,
+            )
+        print(f"----------------------------------------------------")
+
+    def relation_subsets(self):
+        """Materialise the common subsets of the relation table, by source and target type, as their own tables."""
+
+        print(f"----------------------------------------------------")
+        print(
+            f"Relation Subsets - Creating tables of the relation table subsets {self.workflow_config.relation_subsets}."
+        )
+
+        from openaire.bigquery import bq_create_table_from_query
+
+        relation = next((table for table in self.workflow_config.tables if table.name == "relation"), None)
+        assert relation, f"No relation table in the config file to create the subsets from."
+
+        start = time.time()
+        scanned_bytes = 0
+        for source_type, target_type in self.workflow_config.relation_subsets:
+            # Each subset has a single source and target type, so cluster on the ids that are joined on.
+            table_id = (
+                f"{self.cloud_workspace.project_id}.{self.cloud_workspace.dataset_id}."
+                f"relation_{source_type}_{target_type}{self.workflow_config.release_date}"
+            )
+            sql = (
+                f"SELECT * FROM `{relation.full_table_id}` "
+                f"WHERE sourceType = '{source_type}' AND targetType = '{target_type}'"
+            )
+            scanned_bytes += bq_create_table_from_query(
+                sql=sql,
+                table_id=table_id,
+                clustering_fields=["source", "target"],
+                table_description=f"Openaire relation table subset, {source_type} to {target_type}",
+            )
+            print(f"Created relation subset table: {table_id}")
+
+        self.history.record("relation_subsets", scanned_bytes, time.time() - start)
+
         print(f"----------------------------------------------------")
 
     def cleanup(self):
@@ -162,12 +812,13 @@ class OpenAIREWorkflow:
         print(f"----------------------------------------------------")
         print(f"Cleanup - Remove the downloaded and decompressed files for all tables.")
 
-        data_dir = os.path.join(self.workflow_config.data_path, "data")
+        data_dir = os.path.dirname(self.workflow_config.download_folder)
 
         print(f"Removing data directory: {data_dir}")
 
         shutil.rmtree(self.workflow_config.download_folder)
         shutil.rmtree(self.workflow_config.decompress_folder)
+        shutil.rmtree(self.workflow_config.index_folder, ignore_errors=True)
         os.rmdir(data_dir)
 
         assert not os.path.exists(data_dir), f"Data path directory still exists: {data_dir}"
@@ -175,7 +826,17 @@ class OpenAIREWorkflow:
         print(f"----------------------------------------------------")
 
 
-def main(config_path: str):
+def main(
+    config_path: str,
+    shard: Optional[Tuple[int, int]] = None,
+    tables: Optional[List[str]] = None,
+    stages: Optional[List[str]] = None,
+    plan: bool = False,
+    profile: bool = False,
+    sample: Optional[float] = None,
+    sample_seed: int = 0,
+    sample_bytes: int = DEFAULT_SAMPLE_BYTES,
+):
     ###############################################################################
     #
     # Openaire Workflow
@@ -188,17 +849,64 @@ def main(config_path: str):
 
     # Make sure that the config file exists.
     assert os.path.exists(config_path), f"Config path does not exist! {config_path}"
-    workflow = OpenAIREWorkflow(config_path=config_path)
+    workflow = OpenAIREWorkflow(
+        config_path=config_path,
+        shard=shard,
+        tables=tables,
+        sample=sample,
+        sample_seed=sample_seed,
+        sample_bytes=sample_bytes,
+    )
+
+    # Run the stages in workflow order, whatever order they were given in.
+    if stages:
+        unknown = set(stages) - set(STAGES)
+        assert not unknown, f"Unknown stages: {sorted(unknown)}, must be from {STAGES}"
+        stages = [stage for stage in STAGES if stage in stages]
+    else:
+        stages = workflow.default_stages
+
+    if plan:
+        workflow.plan(stages)
+        return
+
+    if profile:
+        enable_profiling(os.path.join(workflow.workflow_config.report_folder, "profile"))
 
     print(f"Starting the OpenAIRE Workflow.")
 
-    # Tasks
-    workflow.download()
-    workflow.decompress()
-    workflow.transform()
-    workflow.gcs_upload()
-    workflow.bq_import()
-    workflow.cleanup()
+    # Tasks. The stages share one pool of warm worker processes, shut down once the last stage is done. It is sized for
+    # the stage that runs the most tasks at once, the tuned transform and upload can go up to their bounds.
+    if workflow.workflow_config.autotune:
+        bounds = workflow.workflow_config.autotune_bounds
+        set_worker_pool_size(
+            max(bounds["transform_workers"][1], bounds["upload_connections"][1], workflow.max_processors)
+        )
+    else:
+        set_worker_pool_size(workflow.max_processors)
+    try:
+        for stage in stages:
+            if stage == "decompress" and workflow.is_sample:
+                print(f"Skipping the decompress stage, the sample is extracted as it is downloaded.")
+                continue
+
+            if stage in ("dedup", "integrity_check", "pid_index", "graph_export") and workflow.is_sharded:
+                print(f"Skipping the {stage} stage, it needs every table part on one machine.")
+                continue
+
+            if stage == "relation_subsets" and not workflow.is_coordinator:
+                continue
+
+            if stage == "bq_import":
+                if not workflow.is_coordinator:
+                    continue
+                if workflow.is_sharded:
+                    workflow.wait_for_shards()
+
+            with profile_stage(stage):
+                getattr(workflow, stage)()
+    finally:
+        shutdown_worker_pools()
 
     print(f"Workflow is finished!")
 
@@ -212,6 +920,78 @@ if __name__ == "__main__":
         help="Path to the configuration file",
         default="config.yaml",
     )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        required=False,
+        help="Run one shard of the workflow on this machine, in the form i/N, e.g. 0/4. Shard 0 runs the BQ import.",
+        default=None,
+    )
+    parser.add_argument(
+        "--tables",
+        type=str,
+        required=False,
+        help="Comma separated list of the tables to process, e.g. publication,relation. Defaults to all tables.",
+        default=None,
+    )
+    parser.add_argument(
+        "--stages",
+        type=str,
+        required=False,
+        help=f"Comma separated list of the stages to run, from {','.join(STAGES)}. Defaults to all stages.",
+        default=None,
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Print the estimated wall time, disk, memory and cloud bytes of each stage, without running anything.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile each stage and its worker processes, writing a merged report per stage to reports/profile.",
+    )
+    parser.add_argument(
+        "--sample",
+        type=float,
+        required=False,
+        help="Run on a deterministic sample of this fraction of the ids, e.g. 0.01, streamed from the start of each "
+        "table on Zenodo and loaded into the <dataset_id>_sample dataset.",
+        default=None,
+    )
+    parser.add_argument(
+        "--sample-seed",
+        type=int,
+        required=False,
+        help="Seed of the sample, the same seed and fraction always draw the same ids.",
+        default=0,
+    )
+    parser.add_argument(
+        "--sample-bytes",
+        type=int,
+        required=False,
+        help=f"Compressed bytes read from Zenodo per table for the sample. Defaults to {DEFAULT_SAMPLE_BYTES}.",
+        default=DEFAULT_SAMPLE_BYTES,
+    )
+    parser.add_argument(
+        "--benchmark-startup",
+        action="store_true",
+        help="Time the start up of the workflow, its imports and its worker processes, then exit.",
+    )
     args = parser.parse_args()
 
-    main(config_path=args.config_path)
+    if args.benchmark_startup:
+        print(format_benchmark(benchmark_startup(os.path.dirname(os.path.abspath(__file__)))))
+        raise SystemExit(0)
+
+    main(
+        config_path=args.config_path,
+        shard=parse_shard(args.shard) if args.shard else None,
+        tables=args.tables.split(",") if args.tables else None,
+        stages=args.stages.split(",") if args.stages else None,
+        plan=args.plan,
+        profile=args.profile,
+        sample=args.sample,
+        sample_seed=args.sample_seed,
+        sample_bytes=args.sample_bytes,
+    )
@@ -0,0 +1,331 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+### Memory aware admission of tasks to a process pool.
+
+import os
+import resource
+from concurrent.futures import Executor, FIRST_COMPLETED, Future, wait
+from contextlib import contextmanager
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from openaire.autotune import ThroughputTuner
+from openaire.progress import format_bytes
+
+# Peak memory of a transform task as a multiple of the size of its gzipped input, when none has been observed yet.
+DEFAULT_EXPANSION_RATIO = 15.0
+
+# Memory always kept free for the main process and the OS, the larger of this and 10% of the total memory.
+DEFAULT_RESERVE_BYTES = 1024**3
+
+
+def read_meminfo(key: str) -> Optional[int]:
+    """Read a value from /proc/meminfo in bytes, e.g. MemAvailable. Returns None where there is no /proc/meminfo.
+
+    :param key: The name of the value.
+    :return: The value in bytes.
+    """
+
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith(f"{key}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def total_memory() -> int:
+    """The total physical memory of the machine in bytes."""
+
+    return read_meminfo("MemTotal") or os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def available_memory() -> int:
+    """The memory available for starting new tasks without swapping, in bytes."""
+
+    return read_meminfo("MemAvailable") or os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def process_status(pid: Any, key: str) -> int:
+    """Read a memory value of a process from /proc/<pid>/status in bytes, e.g. VmRSS. Returns 0 if unavailable.
+
+    :param pid: The process id, or "self".
+    :param key: The name of the value.
+    :return: The value in bytes.
+    """
+
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith(f"{key}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return 0
+
+
+def reset_peak_memory():
+    """Reset the memory high water mark (VmHWM) of the current process to its current resident memory, where Linux
+    allows it, so that a later peak_memory is that of the work done since rather than of the life of the process."""
+
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_memory() -> int:
+    """The memory high water mark of the current process in bytes, since the last reset_peak_memory where supported.
+    Falls back to ru_maxrss, the high water mark of the life of the process, which is in KB on Linux."""
+
+    return process_status("self", "VmHWM") or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class TaskMemory:
+
+    """The memory the running tasks use on top of what their worker held when they started, e.g. the interpreter, the
+    preloaded modules and the heap left by earlier tasks. Idle workers are not counted.
+
+    Each running task has a slot in a block of shared memory, where its worker writes its process id and its resident
+    memory at the start of the task, see measured_call, so that the memory of the task can be read while it runs.
+
+    :param num_slots: The most tasks running at once.
+    """
+
+    def __init__(self, num_slots: int):
+        self.shm = SharedMemory(create=True, size=num_slots * 16)
+        self.slots = self.shm.buf[: num_slots * 16].cast("q")
+        for i in range(len(self.slots)):
+            self.slots[i] = 0
+        self.free = list(range(num_slots))
+
+    def take(self) -> Tuple[str, int]:
+        """A free slot for a task, as the name of the shared memory block and the index of the slot."""
+
+        return self.shm.name, self.free.pop()
+
+    def release(self, slot: int):
+        self.slots[2 * slot] = 0
+        self.free.append(slot)
+
+    def used(self) -> int:
+        """The resident memory of the running tasks above the memory of their worker when they started, in bytes."""
+
+        used = 0
+        for slot in range(len(self.slots) // 2):
+            pid = self.slots[2 * slot]
+            if pid:
+                used += max(0, process_status(pid, "VmRSS") - self.slots[2 * slot + 1])
+
+        return used
+
+    def close(self):
+        self.slots.release()
+        self.shm.close()
+        self.shm.unlink()
+
+
+def measured_call(func: Callable, *args, slot: Optional[Tuple[str, int]] = None) -> Tuple[Any, int]:
+    """Run a task in a worker process and measure its peak memory.
+
+    The high water mark of the worker is reset before the task where Linux allows it, so that the peak is that of this
+    task rather than of an earlier task run by the same worker. The memory the worker used before the task, e.g. the
+    interpreter and imported modules, is not counted.
+
+    :param func: The task function.
+    :param slot: Optional slot of a TaskMemory, where the memory of the worker at the start of the task is written.
+    :return: The result of the task and the peak memory used by the task in the worker, in bytes.
+    """
+
+    reset_peak_memory()
+    start = process_status("self", "VmRSS")
+
+    shm = SharedMemory(name=slot[0]) if slot else None
+    slots = shm.buf.cast("q") if shm else None
+    try:
+        # The memory is written before the process id, which marks the slot as in use.
+        if slots:
+            slots[2 * slot[1] + 1] = start
+            slots[2 * slot[1]] = os.getpid()
+        result = func(*args)
+    finally:
+        if slots:
+            slots[2 * slot[1]] = 0
+            slots.release()
+            shm.close()
+
+    peak = peak_memory()
+
+    return result, max(0, peak - start)
+
+
+class AdmissionController:
+
+    """Start tasks in a process pool only while their estimated memory fits into the memory available.
+
+    The memory of a task is estimated from the size of its input and an expansion ratio. The ratio starts from a
+    previous run or the default, and is raised to the largest ratio observed as tasks finish.
+
+    :param max_workers: The maximum number of tasks running at once, at most the number of workers of the pool.
+    :param expansion_ratio: The starting peak memory of a task as a multiple of its input size.
+    :param reserve_bytes: Memory always kept free. Defaults to the larger of 1 GB and 10% of the total memory.
+    :param poll_interval: Seconds between checks of the memory when tasks are waiting to start.
+    :param tuner: Optional tuner of the number of tasks running at once, from the input bytes per second of the finished
+        tasks. It is kept within max_workers.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        expansion_ratio: float = DEFAULT_EXPANSION_RATIO,
+        reserve_bytes: Optional[int] = None,
+        poll_interval: float = 2.0,
+        tuner: Optional[ThroughputTuner] = None,
+    ):
+        self.max_workers = min(tuner.value, max_workers) if tuner else max_workers
+        self.pool_workers = max_workers
+        self.tuner = tuner
+        self.expansion_ratio = expansion_ratio
+        self.reserve_bytes = reserve_bytes or max(DEFAULT_RESERVE_BYTES, total_memory() // 10)
+        self.poll_interval = poll_interval
+        self.observed_ratio = 0.0
+        self.task_memory: Optional[TaskMemory] = None
+        self.running: Dict[Future, Tuple[int, int]] = {}
+
+    def estimate(self, size: int) -> int:
+        """The estimated peak memory of a task with an input of the given size.
+
+        :param size: The input size in bytes.
+        :return: The estimated memory in bytes.
+        """
+
+        return int(size * self.expansion_ratio)
+
+    def fits(self, size: int) -> bool:
+        """Whether a task fits into the memory available now, taking into account the memory the running tasks have
+        not yet reached. Both the estimates and the memory the tasks use so far leave out what their workers held
+        before the tasks started, as measured_call does for the peaks the estimates come from.
+
+        :param size: The input size of the task in bytes.
+        :return: Whether the task fits.
+        """
+
+        committed = sum(self.estimate(task_size) for task_size, _ in self.running.values())
+        used = self.task_memory.used() if self.task_memory else 0
+        not_yet_used = max(0, committed - used)
+        headroom = available_memory() - self.reserve_bytes - not_yet_used
+
+        return self.estimate(size) <= headroom
+
+    def observe(self, size: int, peak: int):
+        """Update the expansion ratio with the peak memory of a finished task.
+
+        :param size: The input size of the task in bytes.
+        :param peak: The peak memory of the task in bytes.
+        """
+
+        if size > 0 and peak > 0:
+            self.observed_ratio = max(self.observed_ratio, peak / size)
+            self.expansion_ratio = max(self.expansion_ratio, self.observed_ratio)
+
+    @contextmanager
+    def tracking(self):
+        """Track the memory of the tasks started with submit until the end of the with block, see TaskMemory. Each
+        worker of the pool can have a running task and one waiting for it."""
+
+        self.task_memory = TaskMemory(2 * self.pool_workers)
+        try:
+            yield
+        finally:
+            self.task_memory.close()
+            self.task_memory = None
+            self.running = {}
+
+    def submit(self, executor: Executor, func: Callable, size: int, *args) -> Future:
+        """Submit a task to the process pool, measuring its memory, within tracking. Whether it fits is up to the caller.
+
+        :param executor: The process pool.
+        :param func: The task function, called as func(*args).
+        :param size: The input size of the task in bytes.
+        :return: The future of the task, to pass to finish.
+        """
+
+        slot = self.task_memory.take()
+        future = executor.submit(measured_call, func, *args, slot=slot)
+        self.running[future] = (size, slot[1])
+
+        return future
+
+    def finish(self, future: Future) -> Any:
+        """Wait for a task started with submit, and update the expansion ratio and the tuner with it.
+
+        :param future: The future of the task.
+        :return: The result of the task.
+        """
+
+        size, slot = self.running.pop(future)
+        self.task_memory.release(slot)
+        result, peak = future.result()
+        self.observe(size, peak)
+        if self.tuner:
+            self.max_workers = min(self.tuner.observe(size), self.pool_workers)
+
+        return result
+
+    def run(self, executor: Executor, func: Callable, tasks: List[Tuple[int, tuple]]) -> Iterator[Tuple[tuple, Any]]:
+        """Run tasks in a process pool, largest first, starting each one only when its memory fits.
+
+        When the largest waiting task does not fit, a smaller one that does is started instead. When nothing is running,
+        the largest waiting task is always started, so that a task bigger than the machine still gets to run.
+
+        :param executor: The process pool.
+        :param func: The task function, called as func(*args).
+        :param tasks: The tasks, as a list of (input size in bytes, args).
+        :return: Generator of (args, result) as each task finishes.
+        """
+
+        func_name = self.run.__name__
+        pending = sorted(tasks, key=lambda task: task[0], reverse=True)
+        running = {}
+
+        with self.tracking():
+            while pending or running:
+                while pending and len(running) < self.max_workers:
+                    task = next((task for task in pending if self.fits(task[0])), None)
+                    if task is None and not running:
+                        task = pending[0]
+                    if task is None:
+                        break
+
+                    pending.remove(task)
+                    size, args = task
+                    running[self.submit(executor, func, size, *args)] = args
+                    print(
+                        f"{func_name}: started task with input {format_bytes(size)}, estimated memory "
+                        f"{format_bytes(self.estimate(size))}, running={len(running)}, waiting={len(pending)}, "
+                        f"available memory {format_bytes(available_memory())}"
+                    )
+
+                done, _ = wait(list(running), timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    args = running.pop(future)
+                    yield args, self.finish(future)
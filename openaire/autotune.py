@@ -0,0 +1,198 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+### Autotuning of the concurrency settings of the stages from the throughput measured while they run.
+
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Seconds of completed tasks measured before each adjustment.
+DEFAULT_WINDOW_SECONDS = 10.0
+
+# Change in throughput, as a fraction, below which a window counts as no better or worse than the best.
+DEFAULT_TOLERANCE = 0.05
+
+# Windows in a row without a better throughput after which a setting is settled.
+DEFAULT_PATIENCE = 2
+
+# Upload chunk sizes must be multiples of 256 KB.
+CHUNK_ALIGNMENT = 256 * 1024
+
+
+def default_bounds() -> Dict[str, Tuple[int, int]]:
+    """The bounds of each tuned setting on this machine, (lowest, highest). Uploads are bound by the network rather
+    than the CPUs, so they may use more connections than there are CPUs."""
+
+    cpus = os.cpu_count() or 1
+    return {
+        "transform_workers": (1, cpus),
+        "upload_connections": (1, max(8, 2 * cpus)),
+        "upload_chunk_bytes": (CHUNK_ALIGNMENT, 64 * 1024**2),
+    }
+
+
+class ThroughputTuner:
+
+    """Tune a concurrency setting of a stage, e.g. its number of workers, from the throughput it achieves.
+
+    The bytes of the finished tasks are measured over windows of at least window_seconds, and at least one task per
+    unit of the setting, so that each window sees the setting at work. After each window the setting is adjusted
+    AIMD style: while the throughput improves, the setting grows, by a step or by doubling it; when the throughput falls
+    below the best seen, the setting is cut by half, back towards the best. When the throughput has not improved for
+    patience windows it has plateaued, and the setting is settled at the lowest value that gave the best throughput.
+
+    :param name: The name of the setting, e.g. transform_workers.
+    :param value: The starting value, e.g. the value settled on in the previous run.
+    :param bounds: The lowest and highest values.
+    :param doubling: Whether the setting grows by doubling, e.g. a chunk size, rather than by a step.
+    :param step: The additive step, defaults to a sixteenth of the highest value so that large machines ramp up fast.
+    :param alignment: The values are multiples of this.
+    :param window_seconds: The shortest window.
+    :param tolerance: The change in throughput, as a fraction, that counts as better or worse.
+    :param patience: The windows without improvement before the setting is settled.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        value: int,
+        bounds: Tuple[int, int],
+        doubling: bool = False,
+        step: Optional[int] = None,
+        alignment: int = 1,
+        window_seconds: float = DEFAULT_WINDOW_SECONDS,
+        tolerance: float = DEFAULT_TOLERANCE,
+        patience: int = DEFAULT_PATIENCE,
+    ):
+        assert bounds[0] <= bounds[1], f"Tuner {name}: the bounds are the wrong way round: {bounds}"
+        self.name = name
+        self.bounds = bounds
+        self.doubling = doubling
+        self.step = step or max(alignment, bounds[1] // 16)
+        self.alignment = alignment
+        self.window_seconds = window_seconds
+        self.tolerance = tolerance
+        self.patience = patience
+
+        self.value = self.clamp(value)
+        self.best_value = self.value
+        self.best_rate: Optional[float] = None
+        self.flat_windows = 0
+        self.settled = False
+        self.history: List[Dict] = []
+
+        self.reset_window()
+
+    def reset_window(self, now: Optional[float] = None):
+        """Start a new window, e.g. when the tuner starts measuring after another one has settled."""
+
+        self.window_start = time.monotonic() if now is None else now
+        self.window_bytes = 0
+        self.window_tasks = 0
+
+    def clamp(self, value: float) -> int:
+        value = int(value) // self.alignment * self.alignment
+        return max(self.bounds[0], min(self.bounds[1], value))
+
+    def grow(self, value: int) -> int:
+        return self.clamp(value * 2 if self.doubling else value + self.step)
+
+    def shrink(self, value: int) -> int:
+        return self.clamp(value / 2)
+
+    def observe(self, num_bytes: int, now: Optional[float] = None) -> int:
+        """Add a finished task to the current window, and adjust the setting if the window is complete.
+
+        :param num_bytes: The bytes processed by the task.
+        :param now: The time, from time.monotonic, for testing.
+        :return: The setting to use from now on.
+        """
+
+        now = time.monotonic() if now is None else now
+        self.window_bytes += num_bytes
+        self.window_tasks += 1
+
+        elapsed = now - self.window_start
+        min_tasks = 1 if self.doubling else self.value
+        if elapsed >= self.window_seconds and self.window_tasks >= min_tasks:
+            self.adjust(self.window_bytes / elapsed)
+            self.reset_window(now)
+
+        return self.value
+
+    def adjust(self, rate: float):
+        """Adjust the setting from the throughput of a window.
+
+        :param rate: The throughput of the window in bytes per second.
+        """
+
+        self.history.append({"value": self.value, "rate": rate})
+        if self.settled:
+            return
+
+        if self.best_rate is None or rate > self.best_rate * (1 + self.tolerance):
+            # Better: keep growing while it helps.
+            self.best_rate, self.best_value = rate, self.value
+            self.flat_windows = 0
+            self.value = self.grow(self.value)
+        elif rate < self.best_rate * (1 - self.tolerance):
+            # Worse: back off multiplicatively, but not below what gave the best throughput.
+            self.flat_windows += 1
+            self.value = max(self.best_value, self.shrink(self.value))
+        else:
+            # No better: probe one step further in case it helps, the best value stays the lower one.
+            self.flat_windows += 1
+            self.value = self.grow(self.value)
+
+        # Settled on a plateau, or at the highest value with nothing left to try.
+        if self.flat_windows >= self.patience or self.value == self.best_value == self.bounds[1]:
+            self.settled = True
+            self.value = self.best_value
+            print(f"{self.name}: settled on {self.value} at {self.best_rate / 1024**2:.1f} MB/s")
+
+    def to_dict(self) -> Dict:
+        return {
+            "value": self.value,
+            "best_rate": self.best_rate,
+            "settled": self.settled,
+            "bounds": list(self.bounds),
+            "windows": self.history,
+        }
+
+
+def create_tuner(
+    name: str,
+    history_value: Optional[int],
+    default: int,
+    bounds: Dict[str, Tuple[int, int]],
+    enabled: bool,
+    **kwargs,
+) -> Optional[ThroughputTuner]:
+    """Create the tuner of a setting, starting from the value settled on in the previous run if any.
+
+    :param name: The name of the setting, a key of the bounds.
+    :param history_value: The value recorded by the previous run, or None.
+    :param default: The value to start from when there is none.
+    :param bounds: The bounds of every setting.
+    :param enabled: Whether autotuning is enabled, None is returned if not.
+    :return: The tuner, or None.
+    """
+
+    if not enabled:
+        return None
+
+    return ThroughputTuner(name, history_value or default, bounds[name], **kwargs)
@@ -0,0 +1,204 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+### Transform of a single part file across a pool of worker processes, in batches of lines passed through shared memory.
+
+import gzip
+import io
+import json
+from collections import deque
+from concurrent.futures import Executor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Iterator, List, Tuple
+
+import jsonlines
+
+from openaire.admission import AdmissionController
+from openaire.pipeline import Pipeline
+from openaire.profiling import worker_task
+
+# Size of the batches of decompressed lines handed to the workers.
+DEFAULT_BATCH_BYTES = 32 * 1024**2
+
+# Part files at least this size (gzipped) are transformed in batches across every worker rather than by one worker.
+DEFAULT_SPLIT_PART_BYTES = 512 * 1024**2
+
+
+def read_line_batches(input_path: str, batch_bytes: int) -> Iterator[Tuple[bytes, int]]:
+    """Decompress a gzipped JSONL file and split it into batches of whole lines of about batch_bytes each. A line
+    longer than batch_bytes makes up a batch of its own.
+
+    :param input_path: Path to the .json.gz file.
+    :param batch_bytes: The size of the batches.
+    :return: Generator of the batches, with the number of gzipped bytes read for each, so that the memory of a batch
+        can be estimated like that of a part file.
+    """
+
+    carry = b""
+    compressed = 0
+    with open(input_path, "rb") as raw, gzip.GzipFile(fileobj=raw, mode="rb") as f:
+        while True:
+            chunk = f.read(batch_bytes)
+            if not chunk:
+                break
+
+            # Cut at the last line ending within batch_bytes, or after the first line if it is longer than that.
+            data = carry + chunk
+            cut = data.rfind(b"\n", 0, batch_bytes) + 1 or data.find(b"\n") + 1
+            if cut == 0:
+                carry = data
+                continue
+
+            yield data[:cut], raw.tell() - compressed
+            compressed = raw.tell()
+            carry = data[cut:]
+
+    while carry.strip():
+        cut = carry.rfind(b"\n", 0, batch_bytes) + 1 or len(carry)
+        yield carry[:cut], 0
+        carry = carry[cut:]
+
+
+def transform_batch(shm_name: str, length: int, pipeline: Pipeline) -> Tuple[bytes, Pipeline]:
+    """Transform a batch of JSON lines held in shared memory, in a worker process.
+
+    The output is returned as a complete gzip member, so that the batches can be written one after the other into a
+    valid .json.gz file, and the compression is spread over the workers as well.
+
+    :param shm_name: Name of the shared memory block holding the batch.
+    :param length: Number of bytes of the batch in the block.
+    :param pipeline: An empty copy of the transform pipeline of the table.
+    :return: The transformed lines, gzipped, and the pipeline with the timings and state of the batch.
+    """
+
+    shm = SharedMemory(name=shm_name)
+    try:
+        lines = bytes(shm.buf[:length]).split(b"\n")
+    finally:
+        shm.close()
+
+    # The rows are written with jsonlines, as save_jsonl_gz writes them, so a part file transformed in batches is the
+    # same as one transformed in a single worker.
+    output = io.BytesIO()
+    with gzip.GzipFile(fileobj=output, mode="wb") as gzip_file:
+        with jsonlines.Writer(gzip_file) as writer:
+            writer.write_all(pipeline.run(json.loads(line) for line in lines if line.strip()))
+
+    return output.getvalue(), pipeline
+
+
+class SharedSlots:
+
+    """A set of reusable shared memory blocks for the batches in flight.
+
+    :param num_slots: The number of blocks.
+    :param slot_bytes: The size of each block.
+    """
+
+    def __init__(self, num_slots: int, slot_bytes: int):
+        self.slot_bytes = slot_bytes
+        self.free: List[SharedMemory] = [SharedMemory(create=True, size=slot_bytes) for _ in range(num_slots)]
+        self.all = list(self.free)
+
+    def put(self, data: bytes) -> SharedMemory:
+        """Copy a batch into a free block, or a block of its own if the batch is larger than the blocks."""
+
+        if len(data) > self.slot_bytes or not self.free:
+            shm = SharedMemory(create=True, size=len(data))
+        else:
+            shm = self.free.pop()
+        shm.buf[: len(data)] = data
+
+        return shm
+
+    def release(self, shm: SharedMemory):
+        if shm in self.all:
+            self.free.append(shm)
+        else:
+            shm.close()
+            shm.unlink()
+
+    def close(self):
+        for shm in self.all:
+            shm.close()
+            shm.unlink()
+
+
+def transform_part_in_batches(
+    input_path: str,
+    output_path: str,
+    pipeline: Pipeline,
+    executor: Executor,
+    controller: AdmissionController,
+    batch_bytes: int = DEFAULT_BATCH_BYTES,
+) -> int:
+    """Transform one part file using every worker of a process pool.
+
+    The calling process is the reader: it decompresses the part and hands batches of raw lines to the workers through
+    shared memory, so that the lines are not pickled. It is also the writer: the gzipped output of each batch is
+    written in the order the batches were read, so the output has the rows in the same order as the input.
+
+    The batches are admitted by the controller like the part files are, by the gzipped bytes they were read from: a
+    batch is only handed out while it fits into the memory available, and at most two batches per worker the
+    controller allows are in flight. The peak memory of each batch updates the expansion ratio and the throughput of
+    the tuner of the controller.
+
+    :param input_path: Path to the part file.
+    :param output_path: Where to write the transformed part file.
+    :param pipeline: The transform pipeline of the table, the timings and state of each batch are merged into it.
+    :param executor: The process pool.
+    :param controller: The admission controller of the transform.
+    :param batch_bytes: The size of the batches of lines.
+    :return: The number of batches.
+    """
+
+    slots = SharedSlots(2 * controller.pool_workers, batch_bytes)
+    in_flight = deque()
+    num_batches = 0
+
+    try:
+        with open(output_path, "wb") as output, controller.tracking():
+
+            def write_next():
+                future, shm = in_flight.popleft()
+                try:
+                    data, batch_pipeline = controller.finish(future)
+                    output.write(data)
+                    pipeline.merge(batch_pipeline)
+                finally:
+                    slots.release(shm)
+
+            for batch, size in read_line_batches(input_path, batch_bytes):
+                while in_flight and (len(in_flight) >= 2 * controller.max_workers or not controller.fits(size)):
+                    write_next()
+
+                shm = slots.put(batch)
+                # Each batch gets its own empty pipeline, so that only the timings and state of the batch are sent back.
+                future = controller.submit(
+                    executor, worker_task(transform_batch), size, shm.name, len(batch), pipeline.empty()
+                )
+                in_flight.append((future, shm))
+                num_batches += 1
+
+            while in_flight:
+                write_next()
+    finally:
+        for future, shm in in_flight:
+            future.cancel()
+            slots.release(shm)
+        slots.close()
+
+    return num_batches
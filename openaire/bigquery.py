@@ -51,6 +51,22 @@ def bq_table_exists(table_id: str) -> bool:
     return table_exists
 
 
+def bq_table_num_bytes(table_id: str) -> int:
+    """Get the number of bytes stored in a BigQuery table.
+
+    :param table_id: the fully qualified BigQuery table identifier
+    :return: the number of bytes, 0 if the table does not exist.
+    """
+
+    assert_table_id(table_id)
+    client = bigquery.Client()
+
+    try:
+        return client.get_table(table_id).num_bytes or 0
+    except NotFound:
+        return 0
+
+
 def bq_create_dataset(project_id: str, dataset_id: str, location: str, description: str = "") -> bigquery.Dataset:
     """Create a BigQuery dataset.
 
@@ -185,3 +201,39 @@ def bq_load_table(
         state = False
 
     return state
+
+
+def bq_create_table_from_query(
+    *,
+    sql: str,
+    table_id: str,
+    clustering_fields: Union[None, List[str]] = None,
+    table_description: str = "",
+) -> int:
+    """Create a BigQuery table from the results of a query, replacing the table if it already exists.
+
+    :param sql: the query.
+    :param table_id: the fully qualified BigQuery table identifier of the destination table.
+    :param clustering_fields: what fields to cluster the destination table on, if any.
+    :param table_description: the description of the table.
+    :return: the number of bytes processed by the query.
+    """
+
+    func_name = bq_create_table_from_query.__name__
+    assert_table_id(table_id)
+
+    client = bigquery.Client()
+    job_config = bigquery.QueryJobConfig(
+        destination=table_id,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        destination_table_description=table_description,
+    )
+    if clustering_fields:
+        job_config.clustering_fields = clustering_fields
+
+    print(f"{func_name}: create bigquery table from query table_id={table_id}, sql={sql}")
+    query_job = client.query(sql, job_config=job_config)
+    query_job.result()
+    print(f"{func_name}: created table_id={table_id}, bytes processed={query_job.total_bytes_processed}")
+
+    return query_job.total_bytes_processed or 0
@@ -0,0 +1,395 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+### Column statistics of a table collected in a single pass with mergeable sketches.
+
+import json
+import math
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# Number of index bits of the HyperLogLog sketches, 2^12 registers for a standard error of about 1.6%.
+DEFAULT_HLL_PRECISION = 12
+
+# Relative accuracy of the quantile sketches.
+DEFAULT_RELATIVE_ACCURACY = 0.01
+
+# The quantiles reported for the lengths.
+REPORT_QUANTILES = [0.5, 0.9, 0.99]
+
+# Values are hashed in chunks of about this many bytes, which bounds the memory of the NumPy arrays of a chunk.
+HASH_CHUNK_BYTES = 4 * 1024**2
+
+# Odd multiplier of the polynomial hash of the bytes of a value, the FNV-1 64 bit prime.
+HASH_MULTIPLIER = np.uint64(0x100000001B3)
+
+
+def mix64(hashes: np.ndarray) -> np.ndarray:
+    """The splitmix64 finalizer, so that every bit of the hashes depends on every bit of their input."""
+
+    hashes = hashes ^ (hashes >> np.uint64(30))
+    hashes = hashes * np.uint64(0xBF58476D1CE4E5B9)
+    hashes = hashes ^ (hashes >> np.uint64(27))
+    hashes = hashes * np.uint64(0x94D049BB133111EB)
+    return hashes ^ (hashes >> np.uint64(31))
+
+
+def hash_chunk(buffer: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Hash the values encoded in a buffer with NumPy: each byte is multiplied by a power of HASH_MULTIPLIER given by
+    its position in its value and the products are summed per value, modulo 2^64.
+
+    :param buffer: The bytes of the values one after the other, as an array of uint8.
+    :param lengths: The number of bytes of each value.
+    :return: The hashes, as an array of uint64.
+    """
+
+    sums = np.zeros(len(lengths), dtype=np.uint64)
+    if len(buffer):
+        starts = np.cumsum(lengths) - lengths
+        positions = np.arange(len(buffer), dtype=np.int64) - np.repeat(starts, lengths)
+        powers = np.ones(int(lengths.max()), dtype=np.uint64)
+        powers[1:] = np.cumprod(np.full(len(powers) - 1, HASH_MULTIPLIER, dtype=np.uint64))
+        # Empty values have no bytes, so the sums of the other values run from their start to the next start.
+        nonempty = lengths > 0
+        sums[nonempty] = np.add.reduceat(buffer.astype(np.uint64) * powers[positions], starts[nonempty])
+
+    return mix64(sums ^ (lengths.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)))
+
+
+def hash_values(values: List[Any]) -> np.ndarray:
+    """Stable 64 bit hashes of a batch of values, so that sketches built in different processes agree. Values are
+    hashed by the UTF-8 bytes of their str, which is their repr for anything but strings.
+
+    :param values: The values.
+    :return: The hashes, as an array of uint64.
+    """
+
+    # The values are encoded together, when they are all ASCII the length of each in bytes is its length in characters.
+    texts = list(map(str, values))
+    joined = "".join(texts)
+    data = joined.encode("utf-8")
+    if len(data) == len(joined):
+        lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    else:
+        lengths = np.fromiter((len(text.encode("utf-8")) for text in texts), dtype=np.int64, count=len(texts))
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if not len(lengths):
+        return np.zeros(0, dtype=np.uint64)
+
+    # Hash the values in chunks of about HASH_CHUNK_BYTES.
+    ends = np.cumsum(lengths)
+    cuts = np.searchsorted(ends, np.arange(HASH_CHUNK_BYTES, int(ends[-1]), HASH_CHUNK_BYTES), side="right")
+    bounds = [0] + sorted(set(cuts.tolist()) - {0, len(lengths)}) + [len(lengths)]
+    offsets = [0] + ends.tolist()
+
+    return np.concatenate(
+        [
+            hash_chunk(buffer[offsets[start] : offsets[end]], lengths[start:end])
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+    )
+
+
+def bit_length(values: np.ndarray) -> np.ndarray:
+    """The number of bits of each of an array of uint64, as int.bit_length."""
+
+    values = values.copy()
+    lengths = np.zeros(len(values), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = values >= np.uint64(1 << shift)
+        lengths[high] += shift
+        values[high] >>= np.uint64(shift)
+
+    return lengths + (values > 0)
+
+
+class HyperLogLog:
+
+    """HyperLogLog sketch of the number of distinct values. Sketches with the same precision merge by taking the
+    maximum of each register, so the values can be counted in separate processes.
+
+    :param precision: The number of index bits, the sketch has 2^precision registers of one byte.
+    """
+
+    def __init__(self, precision: int = DEFAULT_HLL_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value: Any):
+        self.add_many([value])
+
+    def add_many(self, values: List[Any]):
+        """Add a batch of values, hashed together with NumPy rather than one at a time."""
+
+        hashes = hash_values(values)
+        bits = 64 - self.precision
+        index = (hashes >> np.uint64(bits)).astype(np.intp)
+        rank = bits - bit_length(hashes & np.uint64((1 << bits) - 1)) + 1
+
+        # The array is a view of the registers, so they are updated in place.
+        np.maximum.at(np.frombuffer(self.registers, dtype=np.uint8), index, rank.astype(np.uint8))
+
+    def merge(self, other: "HyperLogLog"):
+        assert (
+            self.precision == other.precision
+        ), f"Cannot merge sketches of precision {self.precision} and {other.precision}"
+        merged = np.maximum(
+            np.frombuffer(self.registers, dtype=np.uint8), np.frombuffer(other.registers, dtype=np.uint8)
+        )
+        self.registers = bytearray(merged.tobytes())
+
+    def count(self) -> int:
+        """The estimated number of distinct values."""
+
+        m = len(self.registers)
+        registers = np.frombuffer(self.registers, dtype=np.uint8)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / float(np.sum(np.power(2.0, -registers.astype(np.float64))))
+
+        # Small range correction with linear counting.
+        zeros = int(np.count_nonzero(registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+
+        return int(round(estimate))
+
+
+class QuantileSketch:
+
+    """Sketch of the distribution of non-negative values, e.g. lengths, with logarithmic buckets so that every quantile
+    is within the relative accuracy of the true value. Sketches merge by adding the counts of their buckets.
+
+    :param relative_accuracy: The relative accuracy of the quantiles.
+    """
+
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.buckets = Counter()
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+        if value <= 0:
+            self.zeros += 1
+        else:
+            self.buckets[math.ceil(math.log(value, self.gamma))] += 1
+
+    def add_many(self, values: List[float]):
+        """Add a batch of values, bucketed together with NumPy rather than one at a time."""
+
+        if not values:
+            return
+
+        array = np.asarray(values, dtype=np.float64)
+        self.count += len(array)
+        self.total += float(array.sum())
+        for value in (float(array.min()), float(array.max())):
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+
+        positive = array[array > 0]
+        self.zeros += len(array) - len(positive)
+        indexes, counts = np.unique(np.ceil(np.log(positive) / math.log(self.gamma)), return_counts=True)
+        self.buckets.update(dict(zip(indexes.astype(np.int64).tolist(), counts.tolist())))
+
+    def merge(self, other: "QuantileSketch"):
+        self.buckets.update(other.buckets)
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """The estimated value at quantile q, between 0 and 1. None if the sketch is empty."""
+
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                value = 2 * self.gamma**index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+
+        return self.max
+
+    def to_dict(self) -> Dict:
+        summary = {"min": self.min, "max": self.max, "mean": self.total / self.count if self.count else None}
+        summary.update({f"p{int(q * 100)}": self.quantile(q) for q in REPORT_QUANTILES})
+        return summary
+
+
+class FieldStats:
+
+    """Statistics of one field of a table: how often it is null or empty, the distinct count of its values and the
+    distribution of its lengths (the number of items of a repeated field, or the number of characters of a string).
+
+    :param field_type: The BigQuery type of the field.
+    :param repeated: Whether the field is REPEATED.
+    """
+
+    def __init__(self, field_type: str, repeated: bool):
+        self.field_type = field_type
+        self.repeated = repeated
+        self.count = 0
+        self.nulls = 0
+        self.empty = 0
+        self.lengths = QuantileSketch()
+        self.distinct = HyperLogLog() if field_type not in ("RECORD", "STRUCT") else None
+
+    def observe(self, value: Any):
+        self.observe_many([value])
+
+    def observe_many(self, values: List[Any]):
+        """Add the values of the field in a batch of records."""
+
+        self.count += len(values)
+        present = [value for value in values if value is not None]
+        self.nulls += len(values) - len(present)
+
+        if self.repeated:
+            lists = [value if isinstance(value, list) else [value] for value in present]
+            lengths = [len(value) for value in lists]
+            items = [item for value in lists for item in value if item is not None]
+        else:
+            lengths = [len(value) for value in present if isinstance(value, str)]
+            items = present
+        self.lengths.add_many(lengths)
+        self.empty += lengths.count(0)
+
+        if self.distinct is not None:
+            self.distinct.add_many(items)
+
+    def merge(self, other: "FieldStats"):
+        self.count += other.count
+        self.nulls += other.nulls
+        self.empty += other.empty
+        self.lengths.merge(other.lengths)
+        if self.distinct is not None and other.distinct is not None:
+            self.distinct.merge(other.distinct)
+
+    def to_dict(self) -> Dict:
+        summary = {
+            "type": self.field_type,
+            "repeated": self.repeated,
+            "count": self.count,
+            "nulls": self.nulls,
+            "null_rate": self.nulls / self.count if self.count else None,
+            "empty": self.empty,
+        }
+        if self.distinct is not None:
+            summary["distinct_estimate"] = self.distinct.count()
+        if self.lengths.count:
+            summary["length"] = self.lengths.to_dict()
+
+        return summary
+
+
+class TableStats:
+
+    """Column statistics of a table, for every field of its schema including the fields of nested records, given as
+    dotted paths. The fields of a repeated record are counted once per item.
+
+    Each worker process fills its own TableStats for the parts it transforms, and these are merged into the statistics
+    of the table, so the table is profiled in the same single pass as the transform.
+
+    :param fields: The schema fields of the table.
+    """
+
+    def __init__(self, fields: List[Dict]):
+        self.fields = fields
+        self.rows = 0
+        self.stats: Dict[str, FieldStats] = {}
+        self.add_fields(fields, "")
+
+    def empty(self) -> "TableStats":
+        """New empty statistics for the same fields, e.g. for a worker to fill."""
+
+        return TableStats(self.fields)
+
+    @staticmethod
+    def from_schema(schema_file_path: str) -> "TableStats":
+        with open(schema_file_path, "r") as f:
+            return TableStats(json.load(f))
+
+    def add_fields(self, fields: List[Dict], prefix: str):
+        for field in fields:
+            path = f"{prefix}{field['name']}"
+            self.stats[path] = FieldStats(field["type"], field.get("mode") == "REPEATED")
+            if "fields" in field:
+                self.add_fields(field["fields"], f"{path}.")
+
+    def observe(self, row: Dict):
+        """Add a row to the statistics.
+
+        :param row: The row, after the transform.
+        """
+
+        self.observe_batch([row])
+
+    def observe_batch(self, rows: List[Dict]):
+        """Add a batch of rows to the statistics, column by column, so that the values of each field are hashed and
+        bucketed together.
+
+        :param rows: The rows, after the transform.
+        """
+
+        self.rows += len(rows)
+        self.observe_records(rows, self.fields, "")
+
+    def observe_records(self, records: List[Dict], fields: List[Dict], prefix: str):
+        for field in fields:
+            path = f"{prefix}{field['name']}"
+            values = [record.get(field["name"]) for record in records]
+            self.stats[path].observe_many(values)
+
+            if "fields" in field:
+                items = [
+                    item
+                    for value in values
+                    if value is not None
+                    for item in (value if isinstance(value, list) else [value])
+                    if isinstance(item, dict)
+                ]
+                if items:
+                    self.observe_records(items, field["fields"], f"{path}.")
+
+    def merge(self, other: "TableStats"):
+        self.rows += other.rows
+        for path, stats in other.stats.items():
+            self.stats[path].merge(stats)
+
+    def to_dict(self) -> Dict:
+        return {"rows": self.rows, "fields": {path: stats.to_dict() for path, stats in self.stats.items()}}
@@ -17,22 +17,29 @@
 
 ### Read in config file and create the cloud workspace data classes.
 
+import json
 import logging
 import os
 import pathlib
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Tuple, List
+from typing import Dict, Tuple, List, Optional
 
-import pendulum
 import yaml
 
+from openaire.autotune import default_bounds
+from openaire.batch_transform import DEFAULT_SPLIT_PART_BYTES
+from openaire.dedup import DEDUP_MODES, DEFAULT_BLOOM_BYTES
+from openaire.download_cache import DEFAULT_CACHE_BYTES
+from openaire.integrity import RELATION_TYPE_TABLES
 from openaire.model import Table
+from openaire.pipeline import create_pipeline
+from openaire.projection import Projection
+from openaire.zenodo import load_part_inventory
 
 
 @dataclass
 class CloudWorkspace:
-
     """Dataclass to hold the revelant cloud workspace parameters.
 
     :param project_id: The ID of the Google project.
@@ -57,7 +64,37 @@ class WorkflowConfig:
     :param release_date: Release date of the data dump. Must be in YYYYMMDD for BQ table shard.
     :param download_folder: Absolute path to the download folder.
     :param decompress_folder: Absolute path to the decompress folder.
+    :param index_folder: Absolute path to the folder for the entity id indexes.
+    :param report_folder: Absolute path to the folder where the workflow reports are written. Kept after cleanup.
+    :param cache_folder: Absolute path to the folder for cached metadata, e.g. the Zenodo record. Kept after cleanup.
     :param tables: List of table objects that hold the table metadata.
+    :param manifest_path: Where the shard manifest is kept when the workflow is sharded, gs://<bucket>/<folder> or a
+        local directory. Defaults to a _manifest folder in the bucket_folder.
+    :param integrity_check: Whether to check the relation table source and target ids against the entity tables.
+    :param sink: Where the transformed tables are written, gcs (default) or bigquery to stream them straight into
+        BigQuery with the Storage Write API.
+    :param sink_max_rejected: The most values of a table streamed by the bigquery sink that may be rejected, as they
+        cannot be coerced to the types of their columns, before its streams are not committed.
+    :param sink_overwrite: Whether the bigquery sink replaces a table that already exists, rather than failing.
+    :param pid_schemes: The pid schemes, e.g. doi, pmid and orcid, indexed by the pid_index stage. Empty to not build
+        the pid index.
+    :param pid_index_path: Where the pid index is saved. Kept after cleanup.
+    :param split_part_bytes: Part files at least this size are transformed in batches across every worker, 0 to always
+        transform a part file in a single worker.
+    :param relation_subsets: The (sourceType, targetType) subsets of the relation table to materialise as their own
+        tables after the BQ import.
+    :param column_stats: Whether to collect the column statistics of each table during the transform.
+    :param download_cache_path: Folder of the download cache shared between runs and configs, None to not cache the
+        downloads.
+    :param download_cache_bytes: The size cap of the download cache.
+    :param graph_export: Whether to export the relation table as a NumPy graph in the graph_export stage.
+    :param graph_path: Folder of the exported relation graph. Kept after cleanup.
+    :param autotune: Whether to tune the transform workers and the upload connections and chunk size from the
+        throughput measured while the stages run, starting from the settings of the previous run.
+    :param autotune_bounds: The lowest and highest value of each tuned setting.
+    :param dedup: What the dedup stage does with the records that repeat the id of an earlier record of their table,
+        report or drop them, None to not run the dedup stage.
+    :param dedup_bloom_bytes: The largest Bloom filter of the dedup stage.
     """
 
     data_path: str
@@ -65,13 +102,95 @@ class WorkflowConfig:
     release_date: str
     download_folder: str
     decompress_folder: str
+    index_folder: str
+    report_folder: str
+    cache_folder: str
     tables: List[Table]
+    manifest_path: Optional[str] = None
+    integrity_check: bool = False
+    sink: str = "gcs"
+    sink_max_rejected: int = 0
+    sink_overwrite: bool = False
+    pid_schemes: List[str] = field(default_factory=list)
+    pid_index_path: Optional[str] = None
+    split_part_bytes: int = DEFAULT_SPLIT_PART_BYTES
+    relation_subsets: List[Tuple[str, str]] = field(default_factory=list)
+    column_stats: bool = False
+    download_cache_path: Optional[str] = None
+    download_cache_bytes: int = DEFAULT_CACHE_BYTES
+    graph_export: bool = False
+    graph_path: Optional[str] = None
+    autotune: bool = True
+    autotune_bounds: Dict[str, Tuple[int, int]] = field(default_factory=default_bounds)
+    dedup: Optional[str] = None
+    dedup_bloom_bytes: int = DEFAULT_BLOOM_BYTES
+
+
+def check_table_layout(table: Table):
+    """Check that the partitioning and clustering columns of a table are valid for its BigQuery schema.
+
+    :param table: The table object.
+    """
+
+    with open(table.schema_path, "r") as f:
+        columns = {column["name"]: column for column in json.load(f)}
+
+    if table.partition_field:
+        column = columns.get(table.partition_field)
+        assert column, f"Table {table.name}: partition column {table.partition_field} is not in the schema."
+        assert column["type"] in ("DATE", "TIMESTAMP", "DATETIME") and column.get("mode") != "REPEATED", (
+            f"Table {table.name}: partition column {table.partition_field} must be a DATE, TIMESTAMP or DATETIME, "
+            f"not {column.get('mode', 'NULLABLE')} {column['type']}."
+        )
+        assert table.partition_type in (
+            "DAY",
+            "HOUR",
+            "MONTH",
+            "YEAR",
+        ), f"Table {table.name}: unknown partition type {table.partition_type}, must be DAY, HOUR, MONTH or YEAR."
+
+    if table.clustering_fields:
+        assert (
+            len(table.clustering_fields) <= 4
+        ), f"Table {table.name}: at most 4 clustering columns, got {table.clustering_fields}"
+        for name in table.clustering_fields:
+            column = columns.get(name)
+            assert column, f"Table {table.name}: clustering column {name} is not in the schema."
+            assert column["type"] != "RECORD" and column.get("mode") != "REPEATED", (
+                f"Table {table.name}: clustering column {name} must be a top level, non repeated column, "
+                f"not {column.get('mode', 'NULLABLE')} {column['type']}."
+            )
+
+
+def write_projected_schema(table: Table, schema_folder: str):
+    """Check the projection of a table against its schema and write the schema trimmed to the projection, which is
+    then used for the table in BigQuery.
+
+    :param table: The table object, with a projection.
+    :param schema_folder: Folder to write the trimmed schema to.
+    """
+
+    with open(table.schema_path, "r") as f:
+        fields = json.load(f)
 
+    table.projection.check(fields, table.name)
+    projected_fields = table.projection.schema(fields)
+    assert projected_fields, f"Table {table.name}: the projection removes every field of the table."
 
-def create_config(config_path: str) -> Tuple[CloudWorkspace, WorkflowConfig]:
+    pathlib.Path(schema_folder).mkdir(parents=True, exist_ok=True)
+    projected_schema_path = os.path.join(schema_folder, f"{table.name}.json")
+    with open(projected_schema_path, "w") as f:
+        json.dump(projected_fields, f, indent=2)
+
+    table.projected_schema_path = projected_schema_path
+
+
+def create_config(config_path: str, suffix: str = "") -> Tuple[CloudWorkspace, WorkflowConfig]:
     """Create the config objects for the Openaire workflow.
 
-    :param config_path: Path to the config path for the workflow."""
+    :param config_path: Path to the config path for the workflow.
+    :param suffix: Suffix of the BigQuery dataset, GCS folder and local data, report and pid index folders, e.g. for a
+        sample run that must not overwrite a full run."""
 
     # Load in the config file.
     try:
@@ -85,10 +204,10 @@ def create_config(config_path: str) -> Tuple[CloudWorkspace, WorkflowConfig]:
     ### Create Cloud Workspace config ###
     cloud_workspace = CloudWorkspace(
         project_id=config_data["cloud_workspace"]["project_id"],
-        dataset_id=config_data["cloud_workspace"]["dataset_id"],
+        dataset_id=f"{config_data['cloud_workspace']['dataset_id']}{suffix}",
         bucket_id=config_data["cloud_workspace"]["bucket_id"],
         data_location=config_data["cloud_workspace"]["data_location"],
-        bucket_folder=config_data["cloud_workspace"]["bucket_folder"],
+        bucket_folder=f"{config_data['cloud_workspace']['bucket_folder']}{suffix}",
     )
 
     ### Create Workflow config ###
@@ -99,7 +218,7 @@ def create_config(config_path: str) -> Tuple[CloudWorkspace, WorkflowConfig]:
     assert os.path.exists(working_path), f"Given path does not exist: {working_path}"
 
     # Create data folder.
-    data_path = os.path.join(working_path, "data")
+    data_path = os.path.join(working_path, f"data{suffix}")
     pathlib.Path(data_path).mkdir(parents=True, exist_ok=True)
 
     # Create download  and decompress folder.
@@ -109,6 +228,24 @@ def create_config(config_path: str) -> Tuple[CloudWorkspace, WorkflowConfig]:
     decompress_folder = os.path.join(data_path, "decompress")
     pathlib.Path(decompress_folder).mkdir(parents=True, exist_ok=True)
 
+    index_folder = os.path.join(data_path, "index")
+    pathlib.Path(index_folder).mkdir(parents=True, exist_ok=True)
+
+    # Reports live outside of the data folder so that they are kept after cleanup.
+    report_folder = os.path.join(working_path, f"reports{suffix}")
+    pathlib.Path(report_folder).mkdir(parents=True, exist_ok=True)
+
+    cache_folder = os.path.join(working_path, "cache")
+    pathlib.Path(cache_folder).mkdir(parents=True, exist_ok=True)
+
+    # The pid index is kept after cleanup, for local lookups.
+    pid_index_folder = os.path.join(working_path, f"pid_index{suffix}")
+    pathlib.Path(pid_index_folder).mkdir(parents=True, exist_ok=True)
+
+    # The relation graph is kept after cleanup, for local graph analysis.
+    graph_folder = os.path.join(working_path, f"graph{suffix}")
+    pathlib.Path(graph_folder).mkdir(parents=True, exist_ok=True)
+
     # Set Google service account credentials for the workflow.
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = config_data["workflow_config"]["google_secret_path"]
 
@@ -119,9 +256,21 @@ def create_config(config_path: str) -> Tuple[CloudWorkspace, WorkflowConfig]:
 
     release_date = config_data["workflow_config"]["release_date"]
     assert isinstance(
-        pendulum.from_format(release_date, "YYYYMMDD"), datetime
+        datetime.strptime(release_date, "%Y%m%d"), datetime
     ), f"Given release date is not a valid datetime string: {release_date}"
 
+    sink = config_data["workflow_config"].get("sink", "gcs")
+    assert sink in ("gcs", "bigquery"), f"Unknown sink: {sink}, must be gcs or bigquery"
+
+    # Build the part inventory of each table from the Zenodo record, falling back to num_parts from the config.
+    zenodo_url_path = config_data["workflow_config"]["zenodo_url_path"]
+    inventory = load_part_inventory(zenodo_url_path, list(config_tables.keys()), cache_folder)
+
+    column_stats = bool(config_data["workflow_config"].get("column_stats", False))
+
+    dedup = config_data["workflow_config"].get("dedup") or None
+    assert dedup is None or dedup in DEDUP_MODES, f"Unknown dedup: {dedup}, must be from {DEDUP_MODES}"
+
     tables = []
     for name, params in config_tables.items():
         # Optional params in the config file.
@@ -139,6 +288,63 @@ def create_config(config_path: str) -> Tuple[CloudWorkspace, WorkflowConfig]:
         except KeyError:
             remove_nulls = None
 
+        try:
+            num_parts = params["num_parts"]
+        except TypeError:
+            num_parts = None
+        except KeyError:
+            num_parts = None
+
+        try:
+            clustering_fields = params["cluster"].split(", ")
+        except TypeError:
+            clustering_fields = None
+        except KeyError:
+            clustering_fields = None
+
+        try:
+            partition_field = params["partition"]
+        except TypeError:
+            partition_field = None
+        except KeyError:
+            partition_field = None
+
+        try:
+            partition_type = params["partition_type"]
+        except TypeError:
+            partition_type = "DAY"
+        except KeyError:
+            partition_type = "DAY"
+
+        try:
+            keep = params["keep"].split(", ")
+        except TypeError:
+            keep = None
+        except KeyError:
+            keep = None
+
+        try:
+            drop = params["drop"].split(", ")
+        except TypeError:
+            drop = None
+        except KeyError:
+            drop = None
+
+        try:
+            transforms = params["transforms"].split(", ")
+        except TypeError:
+            transforms = None
+        except KeyError:
+            transforms = None
+
+        parts = inventory.get(name) if inventory else None
+        if parts and num_parts and num_parts != len(parts):
+            logging.warning(
+                f"Table {name}: num_parts={num_parts} in the config but found {len(parts)} parts on Zenodo, "
+                f"using the parts from Zenodo."
+            )
+        assert parts or num_parts, f"Table {name}: no parts found on Zenodo and no num_parts given in the config."
+
         uri_prefix = f"gs://{cloud_workspace.bucket_id}/{cloud_workspace.bucket_folder}/{name}"
         gcs_uri_pattern = f"{uri_prefix}/*.json.gz"
 
@@ -146,16 +352,50 @@ def create_config(config_path: str) -> Tuple[CloudWorkspace, WorkflowConfig]:
         table = Table(
             name=name,
             full_table_id=f"{cloud_workspace.project_id}.{cloud_workspace.dataset_id}.{name}{release_date}",
-            zenodo_url_path=config_data["workflow_config"]["zenodo_url_path"],
-            num_parts=params["num_parts"],
+            zenodo_url_path=zenodo_url_path,
+            num_parts=num_parts,
             alt_name=alt_name,
             remove_nulls=remove_nulls,
+            parts=parts,
+            sink=sink,
+            partition_field=partition_field,
+            partition_type=partition_type,
+            clustering_fields=clustering_fields,
+            projection=Projection(keep=keep, drop=drop) if keep or drop else None,
             download_folder=download_folder,
             decompress_folder=decompress_folder,
             gcs_uri_pattern=gcs_uri_pattern,
+            transforms=transforms,
         )
+
+        # The stages of the transform pipeline are checked against the full schema of the table.
+        with open(table.schema_path, "r") as f:
+            fields = json.load(f)
+        table.pipeline = create_pipeline(fields, name, remove_nulls, table.projection, transforms, column_stats)
+
+        if table.projection:
+            write_projected_schema(table, os.path.join(cache_folder, "schemas"))
+        check_table_layout(table)
         tables.append(table)
 
+    # Subsets of the relation table to materialise after the import, given as "sourceType, targetType".
+    relation_subsets = []
+    for subset in config_data["workflow_config"].get("relation_subsets") or []:
+        source_type, target_type = [value.strip() for value in subset.split(",")]
+        for value in (source_type, target_type):
+            assert value in RELATION_TYPE_TABLES, f"Unknown relation type {value} in relation_subsets: {subset}"
+        relation_subsets.append((source_type, target_type))
+
+    # Bounds of the tuned settings, given as [lowest, highest], replace the defaults for this machine.
+    autotune_bounds = default_bounds()
+    for name, bounds in (config_data["workflow_config"].get("autotune_bounds") or {}).items():
+        assert (
+            name in autotune_bounds
+        ), f"Unknown setting {name} in autotune_bounds, must be from {list(autotune_bounds)}"
+        low, high = [int(value) for value in bounds]
+        assert 0 < low <= high, f"The bounds of {name} in autotune_bounds must be 0 < lowest <= highest: {bounds}"
+        autotune_bounds[name] = (low, high)
+
     # Define the workflow config object
     workflow_config = WorkflowConfig(
         data_path=config_data["workflow_config"]["working_path"],
@@ -163,7 +403,30 @@ def create_config(config_path: str) -> Tuple[CloudWorkspace, WorkflowConfig]:
         release_date=release_date,
         download_folder=download_folder,
         decompress_folder=decompress_folder,
+        index_folder=index_folder,
+        report_folder=report_folder,
+        cache_folder=cache_folder,
         tables=tables,
+        manifest_path=config_data["workflow_config"].get(
+            "manifest_path", f"gs://{cloud_workspace.bucket_id}/{cloud_workspace.bucket_folder}/_manifest"
+        ),
+        integrity_check=bool(config_data["workflow_config"].get("integrity_check", False)),
+        sink=sink,
+        sink_max_rejected=int(config_data["workflow_config"].get("sink_max_rejected", 0)),
+        sink_overwrite=bool(config_data["workflow_config"].get("sink_overwrite", False)),
+        pid_schemes=[scheme.strip().lower() for scheme in config_data["workflow_config"].get("pid_index") or []],
+        pid_index_path=os.path.join(pid_index_folder, "pid_index.npy"),
+        split_part_bytes=int(config_data["workflow_config"].get("split_part_bytes", DEFAULT_SPLIT_PART_BYTES)),
+        relation_subsets=relation_subsets,
+        column_stats=column_stats,
+        download_cache_path=config_data["workflow_config"].get("download_cache_path"),
+        download_cache_bytes=int(config_data["workflow_config"].get("download_cache_bytes", DEFAULT_CACHE_BYTES)),
+        graph_export=bool(config_data["workflow_config"].get("graph_export", False)),
+        graph_path=graph_folder,
+        autotune=bool(config_data["workflow_config"].get("autotune", True)),
+        autotune_bounds=autotune_bounds,
+        dedup=dedup,
+        dedup_bloom_bytes=int(config_data["workflow_config"].get("dedup_bloom_bytes", DEFAULT_BLOOM_BYTES)),
     )
 
     return cloud_workspace, workflow_config
@@ -17,16 +17,24 @@
 import os
 import sys
 import wget
-from typing import Set
-from openaire.files import load_jsonl_gz, save_jsonl_gz
+from typing import Dict, Optional, Tuple
+from openaire.download_cache import DownloadCache
+from openaire.files import iter_jsonl_gz, load_jsonl_gz, save_jsonl_gz, verify_checksum
+from openaire.pipeline import Pipeline
 
 
-def download_from_zenodo_wget(url: str, output_path: str):
+def download_from_zenodo_wget(
+    url: str, output_path: str, checksum: Optional[str] = None, cache: Optional[DownloadCache] = None
+):
     """Download a single file from Zenodo using the wget library.
 
 
     :param url: Url of the file to download.
     :param output_path: Path of the download on disk.
+    :param checksum: Optional checksum of the file from the Zenodo record, e.g. md5:1a2b... If given, an existing file
+        that matches is kept rather than downloaded again, and the download is verified against it.
+    :param cache: Optional download cache. If given along with the checksum, the file is linked from the cache when it
+        is there, and a verified download is added to the cache.
     :return: True if downloaded successfuflly, otherwise False.
     """
 
@@ -38,7 +46,18 @@ def download_from_zenodo_wget(url: str, output_path: str):
         sys.stdout.flush()
 
     try:
+        # Cached files were verified when they were added, so they are linked in without reading them again.
+        if checksum and cache and cache.get(checksum, output_path):
+            print(f"Found {checksum} in the download cache {cache.folder}, skipping download.")
+            return True
+
         # Check files already exists.
+        if checksum and os.path.exists(output_path) and verify_checksum(output_path, checksum):
+            print(f"Found previous download matching checksum {checksum}, skipping download.")
+            if cache:
+                cache.put(checksum, output_path)
+            return True
+
         if os.path.exists(output_path):
             print(f"Found old file. Deleting previous download and starting again.")
             os.remove(output_path)
@@ -46,6 +65,13 @@ def download_from_zenodo_wget(url: str, output_path: str):
         # Download using Wget
         wget.download(url, out=output_path, bar=bar_custom)
 
+        if checksum and not verify_checksum(output_path, checksum):
+            print(f"\nFile {url} does not match checksum {checksum}.")
+            return False
+
+        if checksum and cache:
+            cache.put(checksum, output_path)
+
     except:
         print(f"File {url} was unable to be downloaded.")
         return False
@@ -53,35 +79,55 @@ def download_from_zenodo_wget(url: str, output_path: str):
     return True
 
 
-def remove_nulls(
-    input_path: str,
-    suspect_columns: Set[str],
-    output_path: str,
-):
+def transform_file(input_path: str, pipeline: Pipeline, output_path: str) -> Pipeline:
     """
-    Removes unnecessary nulls/Nones from top level columns.
+    Runs the rows of a part file through the transform pipeline of its table, e.g. removes unnecessary nulls/Nones
+    from top level columns, and writes the transformed rows to file.
 
-    :param input_path: Path to the file with the Nones.
-    :param suspect_columns: Set of columns that have the Nones. Top level to the data only.
+    :param input_path: Path to the part file.
+    :param pipeline: An empty copy of the transform pipeline of the table.
     :param output_path: Where to write the data to file.
+    :return: The pipeline, with the timings and state of the part file.
     """
 
     data = load_jsonl_gz(input_path)
 
-    result_filtered = []
-    # Go through each row of the data
-    for row in data:
-        # Loop through the suspect columns of data with Nones/null.
-        for column in suspect_columns:
-            # Sometimes this column does not exist in the data. Try is to avoid it.
-            try:
-                # Filter out the nones
-                row[column] = [s for s in row[column] if s is not None]
-            except KeyError:
-                pass
-                # print(f"No key of '{column}' found in file: {input_path}")
-
-        # Add filtered data row to a list.
-        result_filtered.append(row)
+    # Go through each batch of rows of the data and add the transformed rows to a list.
+    result_filtered = list(pipeline.run(data))
 
     save_jsonl_gz(output_path, result_filtered)
+
+    return pipeline
+
+
+def transform_to_sink(input_path: str, pipeline: Pipeline, sink) -> Tuple[str, Dict[str, int], Pipeline]:
+    """
+    Runs the rows of a part file through the transform pipeline of its table and streams them into a sink, e.g.
+    straight into BigQuery, rather than writing them to file. The rows are read from file one at a time.
+
+    :param input_path: Path to the part file.
+    :param pipeline: An empty copy of the transform pipeline of the table.
+    :param sink: The RecordSink of the table.
+    :return: The name of the finalised stream, to be committed along with the other streams of the table, the number
+        of values of each field rejected by the sink, and the pipeline with the timings and state of the part file.
+    """
+
+    stream_name, rejected = sink.write_stream(pipeline.run(iter_jsonl_gz(input_path)))
+
+    return stream_name, rejected, pipeline
+
+
+def run_pipeline(input_path: str, pipeline: Pipeline) -> Pipeline:
+    """
+    Runs the rows of a part file that is not transformed through a pipeline of stages that leave the rows unchanged,
+    e.g. the column statistics, reading the rows one at a time.
+
+    :param input_path: Path to the part file.
+    :param pipeline: An empty copy of the pipeline of the table.
+    :return: The pipeline, with the timings and state of the part file.
+    """
+
+    for _ in pipeline.run(iter_jsonl_gz(input_path)):
+        pass
+
+    return pipeline
@@ -0,0 +1,397 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+### Deduplication of the records of a table across all of its part files, with a Bloom filter and a disk-backed key set.
+
+import gzip
+import hashlib
+import json
+import math
+import os
+import shutil
+from concurrent.futures import as_completed
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from openaire.graph import dedupe_sorted
+from openaire.id_index import DEFAULT_RUN_SIZE, IdIndex, merge_sorted_runs
+from openaire.profiling import worker_task
+from openaire.workers import worker_pool
+
+# What the dedup stage does with the duplicates: report them, or drop them from the part files as well.
+DEDUP_MODES = ["report", "drop"]
+
+# Largest Bloom filter, in bytes, built for a table. It is sized for the rows of the table up to this cap.
+DEFAULT_BLOOM_BYTES = 512 * 1024**2
+
+# False positive rate the Bloom filter is sized for.
+DEFAULT_FALSE_POSITIVE_RATE = 0.01
+
+# Number of keys checked against the Bloom filter and the key set at once.
+DEFAULT_KEY_CHUNK_SIZE = 1_000_000
+
+# Width of the hashed keys. 128 bits, so that two different records of even the largest table do not share a key.
+KEY_BYTES = 16
+
+# The key of a row without an id, which is never a duplicate.
+NO_KEY = b""
+
+# The fields that identify a relation, which has no id of its own.
+RELATION_KEY_FIELDS = ["source", "target", "reltype.name", "reltype.type"]
+
+
+def record_key(row: Dict, table_name: str) -> Optional[str]:
+    """The key identifying a record of a table: its id, or for the relation table its source, target and type.
+
+    :param row: The record.
+    :param table_name: The name of the table.
+    :return: The key, None if the record has no id.
+    """
+
+    if table_name != "relation":
+        return row.get("id")
+
+    values = []
+    for field in RELATION_KEY_FIELDS:
+        value = row
+        for name in field.split("."):
+            value = (value or {}).get(name)
+        values.append(value)
+
+    if values[0] is None or values[1] is None:
+        return None
+
+    return "\x1f".join("" if value is None else str(value) for value in values)
+
+
+def hash_key(key: Optional[str]) -> bytes:
+    if key is None:
+        return NO_KEY
+
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=KEY_BYTES).digest()
+
+
+def iter_lines_gz(file_path: str):
+    """Stream the non-empty lines of a gzipped JSONL file as bytes, so they can be written back unchanged."""
+
+    with gzip.open(file_path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield line
+
+
+def write_part_keys(file_path: str, table_name: str, output_path: str, chunk_size: int = DEFAULT_KEY_CHUNK_SIZE) -> int:
+    """Write the hashed key of each row of a part file, in the order of the rows, to a binary file of KEY_BYTES wide
+    keys.
+
+    :param file_path: The part file.
+    :param table_name: The name of the table, see record_key.
+    :param output_path: Where to write the keys.
+    :param chunk_size: The number of keys written at once.
+    :return: The number of rows.
+    """
+
+    num_rows = 0
+    keys = []
+    with open(output_path, "wb") as f:
+        for line in iter_lines_gz(file_path):
+            keys.append(hash_key(record_key(json.loads(line), table_name)))
+            if len(keys) >= chunk_size:
+                np.array(keys, dtype=f"S{KEY_BYTES}").tofile(f)
+                num_rows += len(keys)
+                keys = []
+
+        if keys:
+            np.array(keys, dtype=f"S{KEY_BYTES}").tofile(f)
+            num_rows += len(keys)
+
+    return num_rows
+
+
+def load_keys(key_path: str) -> np.ndarray:
+    """Memory map the keys written by write_part_keys."""
+
+    if os.path.getsize(key_path) == 0:
+        return np.zeros(0, dtype=f"S{KEY_BYTES}")
+
+    return np.memmap(key_path, dtype=f"S{KEY_BYTES}", mode="r")
+
+
+class BloomFilter:
+
+    """Bloom filter of hashed keys, with vectorised lookups and inserts of a chunk of keys at a time. The bit positions
+    of a key are derived from the two halves of its hash, so no further hashing is needed.
+
+    :param num_bytes: The size of the filter.
+    :param num_hashes: The number of bits set per key.
+    """
+
+    def __init__(self, num_bytes: int, num_hashes: int):
+        self.bits = np.zeros(num_bytes, dtype=np.uint8)
+        self.num_bits = np.uint64(num_bytes * 8)
+        self.num_hashes = num_hashes
+
+    @staticmethod
+    def for_keys(
+        num_keys: int, max_bytes: int = DEFAULT_BLOOM_BYTES, false_positive_rate: float = DEFAULT_FALSE_POSITIVE_RATE
+    ) -> "BloomFilter":
+        """A filter sized for a number of keys and a false positive rate, up to max_bytes. A filter at the cap gives
+        more false positives, which are only extra keys checked exactly, not wrong answers.
+
+        :param num_keys: The expected number of keys.
+        :param max_bytes: The largest filter.
+        :param false_positive_rate: The false positive rate to size the filter for.
+        :return: The filter.
+        """
+
+        num_keys = max(num_keys, 1)
+        num_bits = -num_keys * math.log(false_positive_rate) / math.log(2) ** 2
+        num_bytes = max(8, min(max_bytes, math.ceil(num_bits / 8)))
+        num_hashes = max(1, min(16, round(num_bytes * 8 / num_keys * math.log(2))))
+
+        return BloomFilter(num_bytes, num_hashes)
+
+    def positions(self, keys: np.ndarray) -> np.ndarray:
+        halves = np.ascontiguousarray(keys).view(np.uint64).reshape(-1, 2)
+        hashes = np.arange(self.num_hashes, dtype=np.uint64)
+        return (halves[:, :1] + hashes * halves[:, 1:]) % self.num_bits
+
+    def might_contain(self, keys: np.ndarray) -> np.ndarray:
+        """Check which of the keys may have been added. False means the key has certainly not been added.
+
+        :param keys: The hashed keys.
+        :return: Boolean array, True where the key may have been added.
+        """
+
+        positions = self.positions(keys)
+        bits = self.bits[positions >> np.uint64(3)] & (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8))
+        return np.all(bits != 0, axis=1)
+
+    def add(self, keys: np.ndarray):
+        positions = self.positions(keys).ravel()
+        masks = np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)
+        np.bitwise_or.at(self.bits, (positions >> np.uint64(3)).astype(np.int64), masks)
+
+
+def save_sorted_run(keys: List[np.ndarray], run_path: str) -> str:
+    run = np.concatenate(keys)
+    run.sort()
+    np.save(run_path, run)
+
+    return run_path
+
+
+def find_candidates(
+    key_paths: List[str],
+    bloom: BloomFilter,
+    output_path: str,
+    tmp_folder: str,
+    chunk_size: int = DEFAULT_KEY_CHUNK_SIZE,
+    run_size: int = DEFAULT_RUN_SIZE,
+) -> int:
+    """Stream the keys of every part through the Bloom filter and save the keys that may have been seen before, the
+    candidate duplicates, as a sorted, distinct, memory-mappable array. Every duplicate is a candidate, along with the
+    false positives of the filter.
+
+    The candidates are spilled to disk as sorted runs and merged, so memory stays bounded by the filter and one run
+    whatever the number of duplicates.
+
+    :param key_paths: The key files of the parts, in order.
+    :param bloom: An empty Bloom filter.
+    :param output_path: Where to save the candidates.
+    :param tmp_folder: Folder for the sorted runs.
+    :param chunk_size: The number of keys checked at once.
+    :param run_size: The number of candidates sorted in memory at once.
+    :return: The number of candidates.
+    """
+
+    run_paths = []
+    buffer = []
+    buffered = 0
+    for key_path in key_paths:
+        keys = load_keys(key_path)
+        for start in range(0, len(keys), chunk_size):
+            chunk = np.asarray(keys[start : start + chunk_size])
+            chunk = chunk[chunk != NO_KEY]
+
+            # Keys repeated within the chunk are not in the filter yet, so are found by counting them.
+            distinct, counts = np.unique(chunk, return_counts=True)
+            candidates = np.union1d(distinct[bloom.might_contain(distinct)], distinct[counts > 1])
+            bloom.add(distinct)
+
+            buffer.append(candidates)
+            buffered += len(candidates)
+            if buffered >= run_size:
+                run_paths.append(save_sorted_run(buffer, os.path.join(tmp_folder, f"candidates_{len(run_paths)}.npy")))
+                buffer, buffered = [], 0
+
+    if buffered or not run_paths:
+        buffer.append(np.zeros(0, dtype=f"S{KEY_BYTES}"))
+        run_paths.append(save_sorted_run(buffer, os.path.join(tmp_folder, f"candidates_{len(run_paths)}.npy")))
+
+    merged_path = os.path.join(tmp_folder, "candidates_merged.npy")
+    merge_sorted_runs(run_paths, merged_path)
+    for run_path in run_paths:
+        os.remove(run_path)
+
+    total = dedupe_sorted(merged_path, output_path)
+    os.remove(merged_path)
+
+    return total
+
+
+def find_duplicates(
+    key_paths: List[str], candidates_path: str, chunk_size: int = DEFAULT_KEY_CHUNK_SIZE
+) -> Tuple[Dict[str, np.ndarray], int]:
+    """Stream the keys of every part against the candidates, exactly, and find the rows that repeat a key seen earlier
+    in the table. The first row with a key is kept, in the order of the parts and their rows.
+
+    :param key_paths: The key files of the parts, in order.
+    :param candidates_path: The sorted, distinct candidates from find_candidates.
+    :param chunk_size: The number of keys checked at once.
+    :return: The duplicate row numbers of each part with duplicates, by key file, and the number of keys with
+        duplicates. The other candidates were false positives of the Bloom filter.
+    """
+
+    candidates = IdIndex(candidates_path)
+    seen = np.zeros(len(candidates), dtype=bool)
+    duplicated = np.zeros(len(candidates), dtype=bool)
+
+    duplicates = {}
+    for key_path in key_paths:
+        keys = load_keys(key_path)
+        part_duplicates = []
+        for start in range(0, len(keys), chunk_size):
+            chunk = np.asarray(keys[start : start + chunk_size])
+            rows = np.flatnonzero(candidates.contains(chunk) & (chunk != NO_KEY))
+            if not len(rows):
+                continue
+
+            # The first row of a key in the chunk is a duplicate only if the key was seen in an earlier chunk.
+            index = np.searchsorted(candidates.ids, chunk[rows])
+            first = np.zeros(len(rows), dtype=bool)
+            first[np.unique(index, return_index=True)[1]] = True
+            duplicate = ~first | seen[index]
+            seen[index] = True
+            duplicated[index[duplicate]] = True
+            part_duplicates.append(rows[duplicate] + start)
+
+        if part_duplicates:
+            rows = np.concatenate(part_duplicates)
+            if len(rows):
+                duplicates[key_path] = rows
+
+    return duplicates, int(duplicated.sum())
+
+
+def drop_rows(file_path: str, rows: np.ndarray) -> int:
+    """Rewrite a part file without some of its rows. The other rows are written back unchanged.
+
+    :param file_path: The part file.
+    :param rows: The row numbers to drop.
+    :return: The number of rows dropped.
+    """
+
+    drop = set(rows.tolist())
+    tmp_path = f"{file_path}.dedup"
+    dropped = 0
+    with gzip.open(tmp_path, "wb") as f:
+        for i, line in enumerate(iter_lines_gz(file_path)):
+            if i in drop:
+                dropped += 1
+                continue
+            f.write(line if line.endswith(b"\n") else line + b"\n")
+
+    os.replace(tmp_path, file_path)
+
+    return dropped
+
+
+def dedup_table(
+    table_name: str,
+    file_paths: List[str],
+    tmp_folder: str,
+    drop: bool = False,
+    max_processes: int = 7,
+    bloom_bytes: int = DEFAULT_BLOOM_BYTES,
+) -> Dict:
+    """Find the records of a table that repeat the key of an earlier record, across all of its part files, and drop
+    them from the part files if asked.
+
+    The keys of the rows are hashed in parallel, one part per process, then streamed in order through a Bloom filter,
+    which passes the keys that may have been seen before. Only those candidates are checked exactly, against a sorted
+    key set kept on disk, so memory stays bounded by the filter however large the table.
+
+    :param table_name: The name of the table, see record_key.
+    :param file_paths: The part files of the table.
+    :param tmp_folder: Folder for the keys and candidates, removed when done.
+    :param drop: Whether to drop the duplicates from the part files, rather than only report them.
+    :param max_processes: The maximum number of processes.
+    :param bloom_bytes: The largest Bloom filter.
+    :return: The report of the table: its rows, duplicates, the parts with duplicates and the Bloom filter.
+    """
+
+    func_name = dedup_table.__name__
+
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+
+    file_paths = sorted(file_paths)
+    key_paths = {
+        file_path: os.path.join(tmp_folder, f"{i}_{os.path.basename(file_path).split('.')[0]}.keys")
+        for i, file_path in enumerate(file_paths)
+    }
+    part_rows = {}
+    with worker_pool(max_processes) as executor:
+        futures = {
+            executor.submit(worker_task(write_part_keys), file_path, table_name, key_paths[file_path]): file_path
+            for file_path in file_paths
+        }
+        for future in as_completed(futures):
+            part_rows[futures[future]] = future.result()
+
+    num_rows = sum(part_rows.values())
+    bloom = BloomFilter.for_keys(num_rows, max_bytes=bloom_bytes)
+    print(f"{func_name}: {table_name} has {num_rows} rows, Bloom filter of {len(bloom.bits)} bytes")
+
+    candidates_path = os.path.join(tmp_folder, "candidates.npy")
+    num_candidates = find_candidates(list(key_paths.values()), bloom, candidates_path, tmp_folder)
+    bloom_report = {"bytes": len(bloom.bits), "hashes": bloom.num_hashes, "candidates": num_candidates}
+    del bloom
+
+    duplicates, duplicate_keys = find_duplicates(list(key_paths.values()), candidates_path)
+    bloom_report["false_positives"] = num_candidates - duplicate_keys
+    files = {key_path: file_path for file_path, key_path in key_paths.items()}
+    part_duplicates = {files[key_path]: rows for key_path, rows in duplicates.items()}
+
+    if drop and part_duplicates:
+        with worker_pool(max_processes) as executor:
+            futures = {
+                executor.submit(worker_task(drop_rows), file_path, rows): file_path
+                for file_path, rows in part_duplicates.items()
+            }
+            for future in as_completed(futures):
+                print(f"{func_name}: dropped {future.result()} duplicates from {futures[future]}")
+
+    return {
+        "rows": num_rows,
+        "duplicates": sum(len(rows) for rows in part_duplicates.values()),
+        "duplicate_keys": duplicate_keys,
+        "dropped": drop,
+        "parts": {os.path.basename(file_path): len(rows) for file_path, rows in sorted(part_duplicates.items())},
+        "bloom_filter": bloom_report,
+    }
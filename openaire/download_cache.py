@@ -0,0 +1,178 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+### Download cache shared between runs and configs, keyed by the checksum of the Zenodo files.
+
+import fcntl
+import os
+import shutil
+import time
+from typing import List, Optional, Set, Tuple
+
+# Size cap of the cache by default.
+DEFAULT_CACHE_BYTES = 200 * 1024**3
+
+# ioctl to clone a file on filesystems with copy-on-write extents (btrfs, xfs), from linux/fs.h.
+FICLONE = 0x40049409
+
+
+def link_file(src: str, dst: str) -> str:
+    """Make dst a view of src without copying the data if possible. On the same filesystem this is a hard link, or a
+    reflink (copy-on-write clone) where the filesystem cannot hard link the file, e.g. past its link count limit.
+    Neither works across filesystems, so there the file is copied.
+
+    :param src: The existing file.
+    :param dst: The new file, must not exist.
+    :return: How the file was made, link, reflink or copy.
+    """
+
+    func_name = link_file.__name__
+
+    if os.stat(src).st_dev == os.stat(os.path.dirname(os.path.abspath(dst))).st_dev:
+        try:
+            os.link(src, dst)
+            return "link"
+        except OSError:
+            pass
+
+        try:
+            with open(src, "rb") as s, open(dst, "wb") as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return "reflink"
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+
+    print(f"{func_name}: copying {src} to {dst}, it cannot be linked and takes its own disk space")
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+class DownloadCache:
+
+    """Content-addressed cache of downloaded files, keyed by their checksum, e.g. md5:1a2b... Files are stored as
+    <folder>/<algorithm>/<hex digest>, so the same Zenodo file is cached once whichever run or config downloaded it.
+
+    Files are hard linked between the cache and the working tree, so a cached file takes no extra disk space while the
+    working copy exists, and deleting the working copy in the cleanup stage leaves the cached file. The modified time
+    of a cached file is its last use, and the least recently used files are evicted once the cache is over max_bytes.
+
+    :param folder: The folder of the cache.
+    :param max_bytes: The size cap of the cache.
+    """
+
+    def __init__(self, folder: str, max_bytes: int = DEFAULT_CACHE_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, checksum: str) -> str:
+        algorithm, digest = checksum.split(":", 1)
+        return os.path.join(self.folder, algorithm, digest)
+
+    def __contains__(self, checksum: str) -> bool:
+        return os.path.exists(self.path(checksum))
+
+    def touch(self, checksum: str):
+        os.utime(self.path(checksum))
+
+    def get(self, checksum: str, output_path: str) -> bool:
+        """Link a cached file into the working tree.
+
+        :param checksum: The checksum of the file.
+        :param output_path: Where the file is wanted. An existing file there is replaced.
+        :return: Whether the file was in the cache.
+        """
+
+        if checksum not in self:
+            return False
+
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        link_file(self.path(checksum), output_path)
+        self.touch(checksum)
+
+        return True
+
+    def put(self, checksum: str, file_path: str):
+        """Add a downloaded file to the cache, then evict the least recently used files if the cache is over its cap.
+
+        :param checksum: The checksum of the file, it must already have been verified.
+        :param file_path: The downloaded file, which is linked into the cache rather than copied.
+        """
+
+        cache_path = self.path(checksum)
+        if os.path.exists(cache_path):
+            self.touch(checksum)
+            return
+
+        # Link under a temporary name first, so that a cached file is always complete.
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        link_file(file_path, tmp_path)
+        os.replace(tmp_path, cache_path)
+        self.touch(checksum)
+
+        self.evict(keep={checksum})
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        """The cached files, as (last use, size, path), least recently used first."""
+
+        entries = []
+        for algorithm in os.listdir(self.folder):
+            algorithm_folder = os.path.join(self.folder, algorithm)
+            if not os.path.isdir(algorithm_folder):
+                continue
+            for name in os.listdir(algorithm_folder):
+                if name.endswith(".tmp"):
+                    continue
+                stat = os.stat(os.path.join(algorithm_folder, name))
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(algorithm_folder, name)))
+
+        entries.sort()
+        return entries
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep: Optional[Set[str]] = None) -> List[str]:
+        """Remove the least recently used files until the cache is within max_bytes.
+
+        :param keep: Checksums of files not to remove, e.g. the file just added.
+        :return: The paths of the removed files.
+        """
+
+        func_name = self.evict.__name__
+
+        keep_paths = {self.path(checksum) for checksum in keep or set()}
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+
+        removed = []
+        for last_used, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path in keep_paths:
+                continue
+
+            os.remove(path)
+            total -= size
+            removed.append(path)
+            print(
+                f"{func_name}: evicted {path} ({size} bytes), last used {time.strftime('%Y-%m-%d', time.localtime(last_used))}"
+            )
+
+        return removed
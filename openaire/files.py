@@ -17,11 +17,12 @@
 import io
 import os
 import gzip
+import hashlib
 import codecs
 import tarfile
 import pathlib
 import jsonlines
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Iterator
 from google_crc32c import Checksum as Crc32cChecksum
 
 
@@ -75,6 +76,20 @@ def load_jsonl_gz(file_path: str) -> List[Dict]:
     return data
 
 
+def iter_jsonl_gz(file_path: str) -> Iterator[Dict]:
+    """Stream the rows of a gzipped JSONL file one at a time, without loading the whole file into memory.
+
+    :param file_path: Path to the .jsonl.gz file
+    :return: A generator of dictionaries, one per line of the file.
+    """
+
+    with open(file_path, "rb") as jsonl_gzip_file:
+        with gzip.GzipFile(fileobj=jsonl_gzip_file, mode="rb") as gzip_file:
+            with jsonlines.Reader(gzip_file) as reader:
+                for line in reader.iter():
+                    yield line
+
+
 def save_jsonl_gz(file_path: str, data: List[Dict]) -> None:
     """Takes a list of dictionaries and writes this to a gzipped jsonl file.
     :param file_path: Path to the .jsonl.gz file
@@ -109,6 +124,37 @@ def crc32c_base64_hash(file_path: str, chunk_size: int = 8 * 1024) -> str:
     return hex_to_base64_str(hash_alg.hexdigest())
 
 
+def file_checksum(file_path: str, algorithm: str = "md5", chunk_size: int = 8 * 1024 * 1024) -> str:
+    """Create a hex digest checksum of a file.
+
+    :param file_path: the path to the file.
+    :param algorithm: the hashlib algorithm to use, e.g. md5.
+    :param chunk_size: the size of each chunk to read.
+    :return: the hex digest.
+    """
+
+    hash_alg = hashlib.new(algorithm)
+
+    with open(file_path, "rb") as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            hash_alg.update(chunk)
+            chunk = f.read(chunk_size)
+    return hash_alg.hexdigest()
+
+
+def verify_checksum(file_path: str, checksum: str) -> bool:
+    """Check a file against a checksum in the form <algorithm>:<hex digest>, as given by Zenodo, e.g. md5:1a2b...
+
+    :param file_path: the path to the file.
+    :param checksum: the expected checksum.
+    :return: whether the file matches the checksum.
+    """
+
+    algorithm, expected = checksum.split(":", 1)
+    return file_checksum(file_path, algorithm=algorithm) == expected
+
+
 def hex_to_base64_str(hex_str: bytes) -> str:
     """Covert a hexadecimal string into a base64 encoded string. Removes trailing newline character.
 
@@ -17,14 +17,17 @@
 import os
 import logging
 import pathlib
-import multiprocessing
-from typing import List, Tuple
-from google.cloud import storage
+import functools
+from typing import List, Optional, Tuple
 from requests.exceptions import ChunkedEncodingError
 from multiprocessing import BoundedSemaphore, cpu_count
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, wait
 
+from openaire.autotune import ThroughputTuner
 from openaire.files import crc32c_base64_hash
+from openaire.profiling import worker_task
+from openaire.progress import Progress, total_size
+from openaire.workers import worker_pool
 
 # The chunk size to use when uploading / downloading a blob in multiple parts, must be a multiple of 256 KB.
 DEFAULT_CHUNK_SIZE = 256 * 1024 * 4
@@ -40,6 +43,22 @@ def gcs_blob_name_from_path(relative_local_filepath: str) -> str:
     return pathlib.Path(relative_local_filepath).as_posix().strip("/")
 
 
+@functools.lru_cache(maxsize=None)
+def gcs_bucket(bucket_name: str, project_id: Optional[str] = None):
+    """The bucket of a storage client, created once per process and kept for its later uploads. The Google Cloud
+    Storage library is only imported when it is first needed.
+
+    :param bucket_name: the name of the Google Cloud Storage bucket.
+    :param project_id: the project in which the bucket is located, defaults to inferred from the environment.
+    :return: the bucket.
+    """
+
+    from google.cloud import storage
+
+    storage_client = storage.Client(project=project_id)
+    return storage_client.get_bucket(bucket_name)
+
+
 def gcs_upload_file(
     *,
     bucket_name: str,
@@ -71,8 +90,7 @@ def gcs_upload_file(
     success = False
 
     # Get blob
-    storage_client = storage.Client(project=project_id)
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = gcs_bucket(bucket_name, project_id)
     blob = bucket.blob(blob_name)
 
     # Check if blob exists already and matches the file we are uploading
@@ -128,8 +146,15 @@ def gcs_upload_files(
     max_connections: int = cpu_count(),
     retries: int = 3,
     chunk_size: int = DEFAULT_CHUNK_SIZE,
+    connections_tuner: Optional[ThroughputTuner] = None,
+    chunk_tuner: Optional[ThroughputTuner] = None,
 ) -> bool:
-    """Upload a list of files to Google Cloud storage.
+    """Upload a list of files to Google Cloud storage, with the warm workers of the workflow. At most max_connections
+    files are handed to the workers at once, which limits the upload connections without a semaphore shared through a
+    manager process.
+
+    With tuners, the connections and then the chunk size are tuned from the upload throughput, one after the other so
+    that the change of one does not hide the effect of the other. Files that were already uploaded are not measured.
 
     :param bucket_name: the name of the Google Cloud storage bucket.
     :param file_paths: the paths of the files to upload as blobs.
@@ -139,6 +164,8 @@ def gcs_upload_files(
     :param max_connections: the maximum number of upload connections at once.
     :param retries: the number of times to retry uploading a file if an error occurs.
     :param chunk_size: the chunk size to use when uploading a blob in multiple parts, must be a multiple of 256 KB.
+    :param connections_tuner: optional tuner of the number of upload connections, kept within max_processes.
+    :param chunk_tuner: optional tuner of the chunk size, used once the connections are settled.
     :return: whether the files were uploaded successfully or not.
     """
 
@@ -161,37 +188,53 @@ def gcs_upload_files(
     # Assert that file_paths and blob_names have the same length
     assert len(file_paths) == len(blob_names), f"{func_name}: file_paths and blob_names have different lengths"
 
-    # Upload each file in parallel
-    manager = multiprocessing.Manager()
-    connection_sem = manager.BoundedSemaphore(value=max_connections)
-    with ProcessPoolExecutor(max_workers=max_processes) as executor:
-        # Create tasks
-        futures = []
-        futures_msgs = {}
-        for blob_name, file_path in zip(blob_names, file_paths):
-            msg = f"{func_name}: bucket_name={bucket_name}, blob_name={blob_name}, file_path={str(file_path)}"
-            print(f"{func_name}: {msg}")
-            future = executor.submit(
-                gcs_upload_file,
-                bucket_name=bucket_name,
-                blob_name=blob_name,
-                file_path=str(file_path),
-                retries=retries,
-                connection_sem=connection_sem,
-                chunk_size=chunk_size,
-            )
-            futures.append(future)
-            futures_msgs[future] = msg
+    if connections_tuner:
+        max_connections = connections_tuner.value
+    if chunk_tuner:
+        chunk_size = chunk_tuner.value
 
-        # Wait for completed tasks
+    # Upload each file in parallel
+    with worker_pool(max_processes) as executor:
         results = []
-        for future in as_completed(futures):
-            success, upload = future.result()
-            results.append(success)
-            msg = futures_msgs[future]
-            if success:
-                logging.info(f"{func_name}: success, {msg}")
-            else:
-                logging.info(f"{func_name}: failed, {msg}")
+        progress = Progress(func_name, total_size([str(file_path) for file_path in file_paths]))
+        pending = list(zip(blob_names, file_paths))
+        futures_msgs = {}
+        futures_files = {}
+        while pending or futures_msgs:
+            # Create tasks
+            while pending and len(futures_msgs) < min(max_connections, max_processes):
+                blob_name, file_path = pending.pop(0)
+                msg = f"{func_name}: bucket_name={bucket_name}, blob_name={blob_name}, file_path={str(file_path)}"
+                print(f"{func_name}: {msg}")
+                future = executor.submit(
+                    worker_task(gcs_upload_file),
+                    bucket_name=bucket_name,
+                    blob_name=blob_name,
+                    file_path=str(file_path),
+                    retries=retries,
+                    chunk_size=chunk_size,
+                )
+                futures_msgs[future] = msg
+                futures_files[future] = str(file_path)
+
+            # Wait for completed tasks
+            done, _ = wait(list(futures_msgs), return_when=FIRST_COMPLETED)
+            for future in done:
+                success, upload = future.result()
+                results.append(success)
+                msg = futures_msgs.pop(future)
+                file_path = futures_files.pop(future)
+                if success:
+                    progress.update(os.path.getsize(file_path), label=os.path.basename(file_path))
+                    logging.info(f"{func_name}: success, {msg}")
+
+                    if upload and connections_tuner and not connections_tuner.settled:
+                        max_connections = connections_tuner.observe(os.path.getsize(file_path))
+                        if connections_tuner.settled and chunk_tuner:
+                            chunk_tuner.reset_window()
+                    elif upload and chunk_tuner:
+                        chunk_size = chunk_tuner.observe(os.path.getsize(file_path))
+                else:
+                    logging.info(f"{func_name}: failed, {msg}")
 
     return all(results)
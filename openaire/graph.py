@@ -0,0 +1,354 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+### Export of the relation table as a graph: interned entity ids and a compressed sparse row adjacency per relation type.
+
+import json
+import os
+import re
+import shutil
+from collections import defaultdict
+from concurrent.futures import as_completed
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from openaire.files import iter_jsonl_gz
+from openaire.id_index import (
+    DEFAULT_MERGE_BLOCK_SIZE,
+    DEFAULT_RUN_SIZE,
+    encode_ids,
+    merge_sorted_runs,
+    write_sorted_run,
+)
+from openaire.profiling import worker_task
+from openaire.workers import worker_pool
+
+# Number of edges mapped to node numbers at once.
+DEFAULT_EDGE_BATCH_SIZE = 1_000_000
+
+# Number of edges read at once when building the adjacency arrays.
+DEFAULT_CSR_CHUNK_SIZE = 10_000_000
+
+
+def type_folder_name(relation_type: str) -> str:
+    """The folder name of a relation type, e.g. Cites or IsProducedBy, with any character unsafe in a path replaced."""
+
+    return re.sub(r"[^A-Za-z0-9_-]", "_", relation_type)
+
+
+def write_endpoint_runs(file_path: str, tmp_folder: str, run_size: int = DEFAULT_RUN_SIZE) -> List[str]:
+    """Write the distinct source and target ids of a relation part file as sorted runs.
+
+    :param file_path: The relation part file.
+    :param tmp_folder: Folder for the runs.
+    :param run_size: The number of distinct ids to sort in memory at once.
+    :return: The paths of the runs.
+    """
+
+    os.makedirs(tmp_folder, exist_ok=True)
+    prefix = os.path.basename(file_path).split(".")[0]
+
+    run_paths = []
+    buffer = set()
+    for row in iter_jsonl_gz(file_path):
+        for id_ in (row.get("source"), row.get("target")):
+            if id_ is not None:
+                buffer.add(id_)
+
+        if len(buffer) >= run_size:
+            run_paths.append(write_sorted_run(list(buffer), os.path.join(tmp_folder, f"{prefix}_{len(run_paths)}.npy")))
+            buffer = set()
+
+    if buffer:
+        run_paths.append(write_sorted_run(list(buffer), os.path.join(tmp_folder, f"{prefix}_{len(run_paths)}.npy")))
+
+    return run_paths
+
+
+def dedupe_sorted(input_path: str, output_path: str, block_size: int = DEFAULT_MERGE_BLOCK_SIZE) -> int:
+    """Remove the duplicates from a sorted .npy array, a block at a time.
+
+    :param input_path: The sorted array.
+    :param output_path: Where to save the distinct values.
+    :param block_size: The number of values read at once.
+    :return: The number of distinct values.
+    """
+
+    values = np.load(input_path, mmap_mode="r")
+
+    # Count first, so the output can be memory mapped at its final size.
+    def distinct_blocks():
+        previous = None
+        for start in range(0, len(values), block_size):
+            block = np.asarray(values[start : start + block_size])
+            keep = np.ones(len(block), dtype=bool)
+            keep[1:] = block[1:] != block[:-1]
+            if previous is not None:
+                keep[0] = block[0] != previous
+            previous = block[-1]
+            yield block[keep]
+
+    total = sum(len(block) for block in distinct_blocks())
+    output = np.lib.format.open_memmap(output_path, mode="w+", dtype=values.dtype, shape=(total,))
+    written = 0
+    for block in distinct_blocks():
+        output[written : written + len(block)] = block
+        written += len(block)
+
+    output.flush()
+    del output
+
+    return total
+
+
+def write_edges(
+    file_path: str, ids_path: str, tmp_folder: str, batch_size: int = DEFAULT_EDGE_BATCH_SIZE
+) -> Dict[str, Tuple[str, int]]:
+    """Map the edges of a relation part file to node numbers, the positions of their source and target in the sorted
+    ids, and append them to a binary file of (source, target) int64 pairs per relation type.
+
+    :param file_path: The relation part file.
+    :param ids_path: The sorted, distinct ids of the graph.
+    :param tmp_folder: Folder for the edge files.
+    :param batch_size: The number of edges mapped at once.
+    :return: The edge file and number of edges of each relation type, relation type: (path, edges).
+    """
+
+    ids = np.load(ids_path, mmap_mode="r")
+    prefix = os.path.basename(file_path).split(".")[0]
+    batches = defaultdict(list)
+    edge_files = {}
+
+    def flush(relation_type: str):
+        sources, targets = zip(*batches.pop(relation_type))
+        edges = np.stack([np.searchsorted(ids, encode_ids(sources)), np.searchsorted(ids, encode_ids(targets))], axis=1)
+
+        path = os.path.join(tmp_folder, type_folder_name(relation_type), f"{prefix}.bin")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "ab") as f:
+            edges.astype(np.int64).tofile(f)
+
+        _, count = edge_files.get(relation_type, (path, 0))
+        edge_files[relation_type] = (path, count + len(edges))
+
+    for row in iter_jsonl_gz(file_path):
+        relation_type = (row.get("reltype") or {}).get("name")
+        if row.get("source") is None or row.get("target") is None or relation_type is None:
+            continue
+
+        batches[relation_type].append((row["source"], row["target"]))
+        if len(batches[relation_type]) >= batch_size:
+            flush(relation_type)
+
+    for relation_type in list(batches):
+        flush(relation_type)
+
+    return edge_files
+
+
+def build_csr(
+    edge_paths: List[str], num_nodes: int, output_folder: str, chunk_size: int = DEFAULT_CSR_CHUNK_SIZE
+) -> int:
+    """Build the compressed sparse row adjacency of the edges of one relation type: indptr, of num_nodes + 1 offsets,
+    and indices, the targets of the edges of node i being indices[indptr[i]:indptr[i + 1]].
+
+    The edges are placed with a counting sort, a chunk at a time, so memory stays bounded by the offsets and one chunk
+    rather than the number of edges. The targets of a node are kept in the order they were read.
+
+    :param edge_paths: The binary files of (source, target) int64 pairs.
+    :param num_nodes: The number of nodes of the graph.
+    :param output_folder: Where to save indptr.npy and indices.npy.
+    :param chunk_size: The number of edges read at once.
+    :return: The number of edges.
+    """
+
+    os.makedirs(output_folder, exist_ok=True)
+
+    def chunks():
+        for edge_path in edge_paths:
+            edges = np.memmap(edge_path, dtype=np.int64, mode="r").reshape(-1, 2)
+            for start in range(0, len(edges), chunk_size):
+                yield np.asarray(edges[start : start + chunk_size])
+
+    # Out degree of each node, then the offsets of its targets.
+    degree = np.zeros(num_nodes, dtype=np.int64)
+    for chunk in chunks():
+        degree += np.bincount(chunk[:, 0], minlength=num_nodes)
+
+    num_edges = int(degree.sum())
+    indptr = np.lib.format.open_memmap(
+        os.path.join(output_folder, "indptr.npy"), mode="w+", dtype=np.int64, shape=(num_nodes + 1,)
+    )
+    indptr[0] = 0
+    np.cumsum(degree, out=indptr[1:])
+    del degree
+
+    index_dtype = np.int32 if num_nodes < 2**31 else np.int64
+    indices = np.lib.format.open_memmap(
+        os.path.join(output_folder, "indices.npy"), mode="w+", dtype=index_dtype, shape=(num_edges,)
+    )
+
+    # Next free slot of each node.
+    fill = np.array(indptr[:-1])
+    for chunk in chunks():
+        order = np.argsort(chunk[:, 0], kind="stable")
+        sources, targets = chunk[order, 0], chunk[order, 1]
+
+        # Rank of each edge among the edges of the same source in the chunk.
+        starts = np.flatnonzero(np.r_[True, sources[1:] != sources[:-1]])
+        counts = np.diff(np.r_[starts, len(sources)])
+        rank = np.arange(len(sources)) - np.repeat(starts, counts)
+
+        indices[fill[sources] + rank] = targets
+        fill[sources[starts]] += counts
+
+    indptr.flush()
+    indices.flush()
+    del indptr, indices
+
+    return num_edges
+
+
+def export_relation_graph(file_paths: List[str], output_folder: str, tmp_folder: str, max_processes: int = 7) -> Dict:
+    """Export the relation table as a graph that can be memory mapped with NumPy, see RelationGraph.
+
+    The part files are read twice, one process per part: once to intern the entity ids, with the same sorted runs and
+    k-way merge as the entity id indexes, and once to map the edges to node numbers. The adjacency of each relation type
+    is then built from the mapped edges.
+
+    :param file_paths: The relation part files.
+    :param output_folder: Where to save the graph.
+    :param tmp_folder: Folder for the intermediate files, removed at the end.
+    :param max_processes: The maximum number of processes.
+    :return: The summary of the graph, also saved as graph.json.
+    """
+
+    func_name = export_relation_graph.__name__
+
+    # Edges are appended to the edge files, so any left by an earlier run that failed are removed first.
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(output_folder, exist_ok=True)
+    ids_path = os.path.join(output_folder, "ids.npy")
+
+    with worker_pool(max_processes) as executor:
+        # Intern the ids: the sorted, distinct ids of every source and target, a node being its position.
+        run_paths = []
+        futures = [
+            executor.submit(worker_task(write_endpoint_runs), file_path, os.path.join(tmp_folder, "runs"))
+            for file_path in file_paths
+        ]
+        for future in as_completed(futures):
+            run_paths.extend(future.result())
+
+        if not run_paths:
+            run_paths.append(write_sorted_run([], os.path.join(tmp_folder, "run_empty.npy")))
+
+        merged_path = os.path.join(tmp_folder, "merged_ids.npy")
+        merge_sorted_runs(run_paths, merged_path)
+        num_nodes = dedupe_sorted(merged_path, ids_path)
+        print(f"{func_name}: interned {num_nodes} entity ids: {ids_path}")
+
+        # Map the edges to node numbers, per relation type.
+        edge_files = defaultdict(list)
+        futures = [
+            executor.submit(worker_task(write_edges), file_path, ids_path, os.path.join(tmp_folder, "edges"))
+            for file_path in file_paths
+        ]
+        for future in as_completed(futures):
+            for relation_type, (path, _) in future.result().items():
+                edge_files[relation_type].append(path)
+
+    summary = {"nodes": num_nodes, "types": {}}
+    for relation_type, paths in sorted(edge_files.items()):
+        folder = type_folder_name(relation_type)
+        num_edges = build_csr(sorted(paths), num_nodes, os.path.join(output_folder, folder))
+        summary["types"][relation_type] = {"folder": folder, "edges": num_edges}
+        print(f"{func_name}: {relation_type}: {num_edges} edges")
+
+    with open(os.path.join(output_folder, "graph.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    return summary
+
+
+class RelationGraph:
+
+    """The relation graph exported by export_relation_graph. Every array is memory mapped, so degree counts and
+    neighbourhood queries only read the pages they touch.
+
+    :param folder: The folder of the graph.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        with open(os.path.join(folder, "graph.json"), "r") as f:
+            self.summary = json.load(f)
+        self.ids = np.load(os.path.join(folder, "ids.npy"), mmap_mode="r")
+        self.arrays = {}
+
+    @property
+    def types(self) -> List[str]:
+        return list(self.summary["types"])
+
+    def csr(self, relation_type: str) -> Tuple[np.ndarray, np.ndarray]:
+        """The indptr and indices arrays of a relation type."""
+
+        if relation_type not in self.arrays:
+            folder = os.path.join(self.folder, self.summary["types"][relation_type]["folder"])
+            self.arrays[relation_type] = (
+                np.load(os.path.join(folder, "indptr.npy"), mmap_mode="r"),
+                np.load(os.path.join(folder, "indices.npy"), mmap_mode="r"),
+            )
+
+        return self.arrays[relation_type]
+
+    def nodes(self, ids: List[str]) -> np.ndarray:
+        """The node numbers of OpenAIRE ids, -1 where the id is not in the graph."""
+
+        if len(ids) == 0 or len(self.ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+
+        encoded = encode_ids(ids)
+        positions = np.minimum(np.searchsorted(self.ids, encoded), len(self.ids) - 1)
+
+        return np.where(self.ids[positions] == encoded, positions, -1)
+
+    def id(self, node: int) -> str:
+        return self.ids[node].decode("utf-8")
+
+    def out_degree(self, relation_type: str) -> np.ndarray:
+        """The number of edges of a relation type from each node."""
+
+        indptr, _ = self.csr(relation_type)
+        return np.diff(indptr)
+
+    def neighbours(self, relation_type: str, id_: str) -> List[str]:
+        """The targets of the edges of a relation type from an entity.
+
+        :param relation_type: The relation type, e.g. Cites.
+        :param id_: The OpenAIRE id of the entity.
+        :return: The OpenAIRE ids of the targets, empty if the entity has no such edges.
+        """
+
+        node = int(self.nodes([id_])[0])
+        if node < 0:
+            return []
+
+        indptr, indices = self.csr(relation_type)
+        return [self.id(target) for target in indices[indptr[node] : indptr[node + 1]]]
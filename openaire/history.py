@@ -0,0 +1,87 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+import json
+import os
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+
+class RunHistory:
+
+    """Measurements recorded from previous runs of the workflow, e.g. the throughput of each stage, kept in a JSON file.
+
+    Each stage has a dictionary of measurements. Recording a stage replaces the measurements from the previous run.
+
+    :param path: Path to the JSON file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.stages: Dict[str, Dict[str, Any]] = {}
+
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.stages = json.load(f)
+
+    def record(self, stage: str, num_bytes: int, seconds: float, **measurements):
+        """Record the bytes processed and time taken by a stage, along with any other measurements, and save.
+        Measurements that are None are not recorded.
+
+        :param stage: The name of the stage.
+        :param num_bytes: The number of bytes processed by the stage.
+        :param seconds: The time taken by the stage in seconds.
+        :param measurements: Other measurements of the stage, e.g. compression ratios.
+        """
+
+        # Nothing to measure, e.g. the stage had no files to process on this run.
+        if not num_bytes:
+            return
+
+        self.stages[stage] = {
+            "bytes": num_bytes,
+            "seconds": seconds,
+            "rate": num_bytes / seconds if seconds > 0 else None,
+            "recorded": datetime.now().isoformat(timespec="seconds"),
+            **{key: value for key, value in measurements.items() if value is not None},
+        }
+        self.save()
+
+    def update(self, stage: str, **measurements):
+        """Add measurements to a stage without replacing the ones already recorded, and save.
+
+        :param stage: The name of the stage.
+        :param measurements: The measurements.
+        """
+
+        self.stages.setdefault(stage, {}).update(measurements)
+        self.save()
+
+    def get(self, stage: str, key: str, default: Optional[Any] = None) -> Any:
+        """Get a measurement of a stage from the history.
+
+        :param stage: The name of the stage.
+        :param key: The name of the measurement, e.g. rate.
+        :param default: Returned if there is no such measurement.
+        :return: The measurement.
+        """
+
+        value = self.stages.get(stage, {}).get(key)
+        return default if value is None else value
+
+    def save(self):
+        with open(self.path, "w") as f:
+            json.dump(self.stages, f, indent=2)
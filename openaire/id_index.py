@@ -0,0 +1,197 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+import os
+import pathlib
+from typing import Iterable, List
+
+import numpy as np
+
+from openaire.files import iter_jsonl_gz
+
+# Number of ids held in memory and sorted at once before being spilled to disk as a run.
+DEFAULT_RUN_SIZE = 2_000_000
+
+# Number of ids read from each run per step of the k-way merge.
+DEFAULT_MERGE_BLOCK_SIZE = 500_000
+
+
+def encode_ids(ids: Iterable[str]) -> np.ndarray:
+    """Encode a list of string ids into a fixed width numpy bytes array.
+
+    :param ids: The ids to encode.
+    :return: A numpy array of dtype S<n>, where n is the length of the longest id.
+    """
+
+    return np.array([i.encode("utf-8") for i in ids], dtype=np.bytes_)
+
+
+def write_sorted_run(ids: List[str], run_path: str) -> str:
+    """Sort a list of ids in memory and save it to disk as a .npy file.
+
+    :param ids: The ids to sort.
+    :param run_path: Where to save the sorted run.
+    :return: The path to the saved run.
+    """
+
+    run = encode_ids(ids)
+    run.sort()
+    np.save(run_path, run)
+
+    return run_path
+
+
+def merge_sorted_runs(run_paths: List[str], output_path: str, block_size: int = DEFAULT_MERGE_BLOCK_SIZE) -> int:
+    """Merge sorted .npy runs into a single sorted, memory-mappable .npy file.
+
+    Each step reads a block from every run, takes everything up to the smallest of the block maxima (which is
+    guaranteed to be in its final position) and sorts that in memory, so memory use is bounded by
+    block_size * len(run_paths).
+
+    :param run_paths: The paths to the sorted runs.
+    :param output_path: Where to save the merged index.
+    :param block_size: The number of ids to read from each run per merge step.
+    :return: The number of ids in the merged index.
+    """
+
+    runs = [np.load(run_path, mmap_mode="r") for run_path in run_paths]
+    total = sum(len(run) for run in runs)
+    width = max([run.dtype.itemsize for run in runs] + [1])
+    dtype = np.dtype(f"S{width}")
+
+    output = np.lib.format.open_memmap(output_path, mode="w+", dtype=dtype, shape=(total,))
+    positions = [0] * len(runs)
+    written = 0
+
+    while written < total:
+        blocks = {}
+        cutoff = None
+        for i, run in enumerate(runs):
+            if positions[i] >= len(run):
+                continue
+
+            block = run[positions[i] : positions[i] + block_size]
+            blocks[i] = block
+
+            # Only a block that does not reach the end of its run limits what can be safely merged.
+            if positions[i] + len(block) < len(run) and (cutoff is None or block[-1] < cutoff):
+                cutoff = block[-1]
+
+        taken = []
+        for i, block in blocks.items():
+            n = len(block) if cutoff is None else int(np.searchsorted(block, cutoff, side="right"))
+            taken.append(block[:n].astype(dtype))
+            positions[i] += n
+
+        merged = np.sort(np.concatenate(taken))
+        output[written : written + len(merged)] = merged
+        written += len(merged)
+
+    output.flush()
+    del output
+
+    return total
+
+
+def external_sort_ids(
+    ids: Iterable[str],
+    output_path: str,
+    tmp_folder: str,
+    run_size: int = DEFAULT_RUN_SIZE,
+    block_size: int = DEFAULT_MERGE_BLOCK_SIZE,
+) -> int:
+    """Sort a stream of ids that may not fit into memory, using sorted runs spilled to disk and a k-way merge.
+
+    :param ids: The ids to sort.
+    :param output_path: Where to save the sorted ids as a .npy file.
+    :param tmp_folder: Folder where the intermediate sorted runs are written. Runs are removed once merged.
+    :param run_size: The number of ids to sort in memory at once.
+    :param block_size: The number of ids to read from each run per merge step.
+    :return: The number of ids sorted.
+    """
+
+    pathlib.Path(tmp_folder).mkdir(parents=True, exist_ok=True)
+
+    run_paths = []
+    buffer = []
+    for id_ in ids:
+        buffer.append(id_)
+        if len(buffer) >= run_size:
+            run_paths.append(write_sorted_run(buffer, os.path.join(tmp_folder, f"run_{len(run_paths)}.npy")))
+            buffer = []
+
+    if buffer or not run_paths:
+        run_paths.append(write_sorted_run(buffer, os.path.join(tmp_folder, f"run_{len(run_paths)}.npy")))
+
+    total = merge_sorted_runs(run_paths, output_path, block_size=block_size)
+
+    for run_path in run_paths:
+        os.remove(run_path)
+
+    return total
+
+
+def build_id_index(
+    file_paths: List[str], output_path: str, tmp_folder: str, field: str = "id", run_size: int = DEFAULT_RUN_SIZE
+) -> int:
+    """Build a sorted id index for a table from its gzipped JSONL part files.
+
+    :param file_paths: The part files of the table.
+    :param output_path: Where to save the index as a .npy file.
+    :param tmp_folder: Folder for the intermediate sorted runs.
+    :param field: The top level field that holds the id of each row.
+    :param run_size: The number of ids to sort in memory at once.
+    :return: The number of ids in the index.
+    """
+
+    def ids():
+        for file_path in file_paths:
+            for row in iter_jsonl_gz(file_path):
+                id_ = row.get(field)
+                if id_ is not None:
+                    yield id_
+
+    return external_sort_ids(ids(), output_path, tmp_folder, run_size=run_size)
+
+
+class IdIndex:
+
+    """Sorted, memory-mapped array of ids that supports vectorised membership lookups.
+
+    :param path: Path to the .npy index created by build_id_index.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ids = np.load(path, mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def contains(self, ids: np.ndarray) -> np.ndarray:
+        """Check which of the given ids are in the index.
+
+        :param ids: Numpy bytes array of ids, see encode_ids.
+        :return: Boolean array, True where the id is in the index.
+        """
+
+        if len(self.ids) == 0 or len(ids) == 0:
+            return np.zeros(len(ids), dtype=bool)
+
+        positions = np.searchsorted(self.ids, ids)
+        positions = np.minimum(positions, len(self.ids) - 1)
+
+        return self.ids[positions] == ids
@@ -0,0 +1,178 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+from collections import Counter
+from concurrent.futures import as_completed
+from typing import Dict, List
+
+import numpy as np
+
+from openaire.files import iter_jsonl_gz
+from openaire.id_index import IdIndex, encode_ids
+from openaire.profiling import worker_task
+from openaire.workers import worker_pool
+
+# Which entity tables an id of the given relation sourceType/targetType can point to.
+RELATION_TYPE_TABLES = {
+    "result": ["publication", "dataset", "software", "otherresearchproduct"],
+    "organization": ["organization"],
+    "project": ["project"],
+    "datasource": ["datasource"],
+    "community": ["communities_infrastructures"],
+}
+
+# Number of relation rows checked against the indexes at once.
+DEFAULT_BATCH_SIZE = 500_000
+
+# Maximum number of example dangling ids kept in the report.
+MAX_EXAMPLES = 20
+
+
+def empty_report() -> Dict:
+    """Create an empty relation integrity report.
+
+    :return: The report dictionary.
+    """
+
+    return {
+        "files": 0,
+        "edges": 0,
+        "edge_types": Counter(),
+        "dangling_source": Counter(),
+        "dangling_target": Counter(),
+        "unchecked": Counter(),
+        "dangling_examples": [],
+    }
+
+
+def merge_reports(reports: List[Dict]) -> Dict:
+    """Merge the integrity reports of several relation parts into one.
+
+    :param reports: The reports to merge.
+    :return: The merged report.
+    """
+
+    merged = empty_report()
+    for report in reports:
+        merged["files"] += report["files"]
+        merged["edges"] += report["edges"]
+        for key in ["edge_types", "dangling_source", "dangling_target", "unchecked"]:
+            merged[key].update(report[key])
+        merged["dangling_examples"].extend(report["dangling_examples"])
+    merged["dangling_examples"] = merged["dangling_examples"][:MAX_EXAMPLES]
+
+    return merged
+
+
+def check_endpoints(ids: List[str], types: List[str], side: str, indexes: Dict[str, IdIndex], report: Dict):
+    """Check one side (source or target) of a batch of relation edges against the id indexes.
+
+    :param ids: The endpoint ids.
+    :param types: The entity type of each endpoint id.
+    :param side: Either "source" or "target".
+    :param indexes: The id indexes, keyed by table name.
+    :param report: The report to update.
+    """
+
+    encoded = encode_ids(ids)
+    types = np.array(types, dtype=object)
+
+    for type_ in set(types):
+        mask = types == type_
+        tables = [table for table in RELATION_TYPE_TABLES.get(type_, []) if table in indexes]
+        if not tables:
+            report["unchecked"][f"{side}:{type_}"] += int(mask.sum())
+            continue
+
+        type_ids = encoded[mask]
+        found = np.zeros(len(type_ids), dtype=bool)
+        for table in tables:
+            found |= indexes[table].contains(type_ids)
+
+        n_dangling = int((~found).sum())
+        if n_dangling:
+            report[f"dangling_{side}"][type_] += n_dangling
+            for id_ in type_ids[~found][: MAX_EXAMPLES - len(report["dangling_examples"])]:
+                report["dangling_examples"].append({side: id_.decode("utf-8"), "type": type_})
+
+
+def check_relation_part(file_path: str, index_paths: Dict[str, str], batch_size: int = DEFAULT_BATCH_SIZE) -> Dict:
+    """Stream a relation part file and check that its source and target ids exist in the entity id indexes.
+
+    :param file_path: The relation part file.
+    :param index_paths: The paths to the id indexes, keyed by table name.
+    :param batch_size: The number of relation rows to check at once.
+    :return: The integrity report for the part.
+    """
+
+    indexes = {table: IdIndex(path) for table, path in index_paths.items()}
+    report = empty_report()
+    report["files"] = 1
+
+    sources, source_types, targets, target_types = [], [], [], []
+
+    def check_batch():
+        check_endpoints(sources, source_types, "source", indexes, report)
+        check_endpoints(targets, target_types, "target", indexes, report)
+        for batch in [sources, source_types, targets, target_types]:
+            batch.clear()
+
+    for row in iter_jsonl_gz(file_path):
+        source_type, target_type = row.get("sourceType"), row.get("targetType")
+        sources.append(row.get("source") or "")
+        source_types.append(source_type)
+        targets.append(row.get("target") or "")
+        target_types.append(target_type)
+
+        report["edges"] += 1
+        report["edge_types"][f"{source_type}->{target_type}"] += 1
+
+        if len(sources) >= batch_size:
+            check_batch()
+
+    if sources:
+        check_batch()
+
+    return report
+
+
+def check_relation_integrity(relation_files: List[str], index_paths: Dict[str, str], max_processes: int = 7) -> Dict:
+    """Check the referential integrity of the relation table against the entity id indexes, one part per process.
+
+    :param relation_files: The relation part files.
+    :param index_paths: The paths to the id indexes, keyed by table name.
+    :param max_processes: The maximum number of processes.
+    :return: The merged integrity report.
+    """
+
+    func_name = check_relation_integrity.__name__
+
+    reports = []
+    with worker_pool(max_processes) as executor:
+        futures = {
+            executor.submit(worker_task(check_relation_part), file_path, index_paths): file_path
+            for file_path in relation_files
+        }
+        for future in as_completed(futures):
+            report = future.result()
+            reports.append(report)
+            print(
+                f"{func_name}: checked {futures[future]}, edges={report['edges']}, "
+                f"dangling_source={sum(report['dangling_source'].values())}, "
+                f"dangling_target={sum(report['dangling_target'].values())}"
+            )
+
+    return merge_reports(reports)
@@ -17,9 +17,12 @@
 import os
 import pathlib
 import re
-from typing import Dict, Union, List, Optional
+from typing import Dict, Union, List, Optional, Set
 
 from openaire.files import schema_folder as default_schema_folder
+from openaire.pipeline import Pipeline
+from openaire.projection import Projection
+from openaire.zenodo import ZenodoFile
 
 
 class Table:
@@ -36,6 +39,18 @@ class Table:
     :param alt_name: Alternative name of the table part file on Zenodo. e.g. otherresearchproduct_1.tar but only 1 part,
         so the file to download is otherresearchproduct_1.tar
     :param remove_nulls: Columns of where suspect nulls are that cause issues with importing to Bigquery.
+    :param parts: The part files of the table from the Zenodo record, with their sizes and checksums. When given, these
+        are used for the downloads instead of num_parts and alt_name.
+    :param sink: Where the transformed records are written, gcs to stage files in GCS for a load job or bigquery to
+        stream them straight into BigQuery with the Storage Write API.
+    :param partition_field: Optional DATE/TIMESTAMP column to time partition the BigQuery table on.
+    :param partition_type: The time partitioning granularity, DAY, HOUR, MONTH or YEAR.
+    :param clustering_fields: Optional top level columns, at most 4, to cluster the BigQuery table on.
+    :param projection: Optional projection of the rows onto a subset of their fields, applied in the transform.
+    :param projected_schema_path: Path to the schema trimmed to the projection, when there is a projection.
+    :param transforms: Names of the transform stages run on the rows after the nulls are removed and the rows projected.
+    :param pipeline: The transform pipeline of the table, composed from the above.
+    :param assigned_parts: File names of the parts processed on this machine when the workflow is sharded, None for all.
     :param local_part_list_gz: List of where all the part files are locally stored (for the upload step).
     :param uri_part_list: List of all the uris of parts uploaded to Google Cloud Storage.
 
@@ -44,7 +59,7 @@ class Table:
     def __init__(
         self,
         name: str,
-        num_parts: int,
+        num_parts: Optional[int],
         zenodo_url_path: str,
         full_table_id: str,
         download_folder: str,
@@ -52,6 +67,15 @@ class Table:
         gcs_uri_pattern: str,
         alt_name: Optional[str] = None,
         remove_nulls: Optional[Union[str, List[str]]] = None,
+        parts: Optional[List[ZenodoFile]] = None,
+        sink: str = "gcs",
+        partition_field: Optional[str] = None,
+        partition_type: str = "DAY",
+        clustering_fields: Optional[List[str]] = None,
+        projection: Optional[Projection] = None,
+        projected_schema_path: Optional[str] = None,
+        transforms: Optional[List[str]] = None,
+        pipeline: Optional[Pipeline] = None,
     ):
         self.name = name
         self.num_parts = num_parts
@@ -64,21 +88,60 @@ class Table:
         self.decompress_folder = os.path.join(decompress_folder)
         self.part_location = os.path.join(decompress_folder, name)
         self.zenodo_name = alt_name if alt_name else name
+        self.parts = parts
+        self.sink = sink
+        self.partition_field = partition_field
+        self.partition_type = partition_type
+        self.clustering_fields = clustering_fields
+        self.projection = projection
+        self.projected_schema_path = projected_schema_path
+        self.transforms = transforms
+        self.pipeline = pipeline
+        self.assigned_parts: Optional[Set[str]] = None
 
     @property
     def schema_path(self):
+        if self.projected_schema_path:
+            return self.projected_schema_path
         return os.path.join(default_schema_folder(), "schemas", f"{self.name}.json")
 
+    @property
+    def needs_transform(self) -> bool:
+        """Whether the table is transformed, i.e. has nulls to remove, fields to project or transform stages."""
+
+        return bool(self.remove_nulls or self.projection or self.transforms)
+
+    @property
+    def streams_to_bigquery(self) -> bool:
+        """Whether the transformed records are streamed straight into BigQuery rather than staged in GCS. Only tables
+        that are transformed are streamed, the others are loaded from their extracted files."""
+
+        return self.sink == "bigquery" and self.needs_transform
+
     @property
     def download_paths(self) -> Dict[str, str]:
-        """Dictionary of downloads[download_url] = download_local_file_location
-        download_url ."""
+        """Dictionary of downloads[download_url] = download_local_file_location for the parts processed on this
+        machine. This is all of the parts, unless the workflow is sharded across several machines."""
+
+        downloads = self.zenodo_download_paths
+        if self.assigned_parts is not None:
+            downloads = {url: path for url, path in downloads.items() if os.path.basename(path) in self.assigned_parts}
+
+        return downloads
+
+    @property
+    def zenodo_download_paths(self) -> Dict[str, str]:
+        """Dictionary of downloads[download_url] = download_local_file_location for all parts of the table on
+        Zenodo."""
 
         # Create the download folder for this table's data.
         pathlib.Path(self.download_folder).mkdir(parents=True, exist_ok=True)
 
         downloads = {}
-        if self.num_parts > 1:
+        if self.parts:
+            for part in self.parts:
+                downloads[part.url] = os.path.join(self.download_folder, part.key)
+        elif self.num_parts > 1:
             for i in range(self.num_parts):
                 downloads[f"{self.zenodo_url_path}/files/{self.zenodo_name}_{i+1}.tar"] = os.path.join(
                     self.download_folder, f"{self.name}_{i+1}.tar"
@@ -90,6 +153,21 @@ class Table:
 
         return downloads
 
+    @property
+    def download_checksums(self) -> Dict[str, Optional[str]]:
+        """Dictionary of checksums[download_url] = checksum of the part file from the Zenodo record."""
+
+        return {part.url: part.checksum for part in self.parts} if self.parts else {}
+
+    @property
+    def download_size(self) -> int:
+        """Total size in bytes of the part files to download, 0 if unknown."""
+
+        if not self.parts:
+            return 0
+
+        return sum(part.size for part in self.parts if self.assigned_parts is None or part.key in self.assigned_parts)
+
     @property
     def extracted_files(self):
         files = [
@@ -104,8 +182,8 @@ class Table:
     def transform_files(self):
         files = []
         for file in os.listdir(self.part_location):
-            if (self.remove_nulls and re.match(r".+_NR\.json\.gz$", file)) or (
-                not self.remove_nulls and re.match(r".+((?<!_NR)\.json\.gz)$", file)
+            if (self.needs_transform and re.match(r".+_NR\.json\.gz$", file)) or (
+                not self.needs_transform and re.match(r".+((?<!_NR)\.json\.gz)$", file)
             ):
                 files.append(os.path.join(self.part_location, file))
         files.sort()
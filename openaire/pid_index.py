@@ -0,0 +1,214 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+### Local index from persistent identifiers (DOI, PMID, ORCID, ...) to the OpenAIRE ids of the research products.
+
+import hashlib
+import os
+import shutil
+from concurrent.futures import as_completed
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
+
+from openaire.files import iter_jsonl_gz
+from openaire.id_index import DEFAULT_RUN_SIZE, merge_sorted_runs, write_sorted_run
+from openaire.profiling import worker_task
+from openaire.workers import worker_pool
+
+# The result tables, whose rows have pids.
+RESULT_TABLES = ["publication", "dataset", "software", "otherresearchproduct"]
+
+# Number of hex characters of the hash of a pid at the start of each index entry, followed by the OpenAIRE id.
+KEY_WIDTH = 32
+
+
+def normalise_pid(scheme: str, value: str) -> str:
+    """Normalise a pid to the form scheme:value, in lower case, as DOIs are case insensitive.
+
+    :param scheme: The pid scheme, e.g. doi.
+    :param value: The pid value, e.g. 10.1000/182.
+    :return: The normalised pid.
+    """
+
+    return f"{scheme.strip().lower()}:{value.strip().lower()}"
+
+
+def pid_key(pid: str) -> str:
+    """The fixed width key of a normalised pid in the index, a 128 bit hash in hex.
+
+    :param pid: The normalised pid.
+    :return: The key.
+    """
+
+    return hashlib.blake2b(pid.encode("utf-8"), digest_size=KEY_WIDTH // 2).hexdigest()
+
+
+def row_pids(row: Dict, schemes: Set[str]) -> Set[str]:
+    """The normalised pids of a result, from its pid, instance.pid and author.pid fields, in the given schemes.
+
+    :param row: The result.
+    :param schemes: The pid schemes to keep, in lower case.
+    :return: The normalised pids.
+    """
+
+    pids = list(row.get("pid") or [])
+    for instance in row.get("instance") or []:
+        pids.extend(instance.get("pid") or [])
+    for author in row.get("author") or []:
+        author_pid = (author.get("pid") or {}).get("id")
+        if author_pid:
+            pids.append(author_pid)
+
+    return {
+        normalise_pid(pid["scheme"], pid["value"])
+        for pid in pids
+        if pid and pid.get("scheme") and pid.get("value") and pid["scheme"].strip().lower() in schemes
+    }
+
+
+def write_pid_runs(
+    file_paths: List[str], tmp_folder: str, schemes: Set[str], run_size: int = DEFAULT_RUN_SIZE
+) -> List[str]:
+    """Write the (pid key, OpenAIRE id) entries of the part files of a table as sorted runs.
+
+    :param file_paths: The part files of the table.
+    :param tmp_folder: Folder for the runs, one per table.
+    :param schemes: The pid schemes to index, in lower case.
+    :param run_size: The number of entries to sort in memory at once.
+    :return: The paths of the runs.
+    """
+
+    os.makedirs(tmp_folder, exist_ok=True)
+
+    run_paths = []
+    buffer = []
+    for file_path in file_paths:
+        for row in iter_jsonl_gz(file_path):
+            id_ = row.get("id")
+            if id_ is None:
+                continue
+
+            buffer.extend(f"{pid_key(pid)}{id_}" for pid in row_pids(row, schemes))
+            if len(buffer) >= run_size:
+                run_paths.append(write_sorted_run(buffer, os.path.join(tmp_folder, f"run_{len(run_paths)}.npy")))
+                buffer = []
+
+    if buffer:
+        run_paths.append(write_sorted_run(buffer, os.path.join(tmp_folder, f"run_{len(run_paths)}.npy")))
+
+    return run_paths
+
+
+def build_pid_index(
+    table_files: Dict[str, List[str]],
+    output_path: str,
+    tmp_folder: str,
+    schemes: Set[str],
+    max_processes: int = 7,
+) -> int:
+    """Build the pid index of the result tables: a sorted, memory-mapped .npy array of entries made of the hash of a
+    pid followed by the OpenAIRE id of a result with that pid.
+
+    The sorted runs of each table are written in parallel, one table per process, then merged into the index with the
+    same k-way merge as the entity id indexes, so memory stays bounded.
+
+    :param table_files: The part files of each result table, table name: files.
+    :param output_path: Where to save the index.
+    :param tmp_folder: Folder for the intermediate sorted runs.
+    :param schemes: The pid schemes to index, in lower case.
+    :param max_processes: The maximum number of processes.
+    :return: The number of entries in the index.
+    """
+
+    func_name = build_pid_index.__name__
+
+    run_paths = []
+    with worker_pool(max_processes) as executor:
+        futures = {
+            executor.submit(worker_task(write_pid_runs), file_paths, os.path.join(tmp_folder, name), schemes): name
+            for name, file_paths in table_files.items()
+        }
+        for future in as_completed(futures):
+            runs = future.result()
+            print(f"{func_name}: wrote {len(runs)} sorted runs for table {futures[future]}")
+            run_paths.extend(runs)
+
+    if not run_paths:
+        run_paths.append(write_sorted_run([], os.path.join(tmp_folder, "run_empty.npy")))
+
+    total = merge_sorted_runs(run_paths, output_path)
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    return total
+
+
+class PidIndex:
+
+    """Lookup of the OpenAIRE ids of the research products with a given persistent identifier, from the index built
+    by build_pid_index. The index is memory mapped, so only the pages touched by a lookup are read from disk.
+
+    :param path: Path to the .npy index.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = np.load(path, mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def ranges(self, pids: List[Tuple[str, str]]) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the entries of a batch of pids, with two vectorised binary searches over the index.
+
+        :param pids: The pids, as (scheme, value).
+        :return: Arrays of the start and end of the entries of each pid in the index.
+        """
+
+        keys = np.array(
+            [pid_key(normalise_pid(scheme, value)).encode() for scheme, value in pids], dtype=f"S{KEY_WIDTH}"
+        )
+        starts = np.searchsorted(self.entries, keys, side="left")
+        # Every entry of a key sorts before the key followed by the largest byte.
+        ends = np.searchsorted(self.entries, np.char.add(keys, b"\xff"), side="left")
+
+        return starts, ends
+
+    def lookup_many(self, pids: List[Tuple[str, str]]) -> List[List[str]]:
+        """Look up the OpenAIRE ids of a batch of pids.
+
+        :param pids: The pids, as (scheme, value), e.g. ("doi", "10.1000/182").
+        :return: The OpenAIRE ids of each pid, an empty list where the pid is not in the index.
+        """
+
+        if len(pids) == 0:
+            return []
+
+        starts, ends = self.ranges(pids)
+
+        return [
+            [entry[KEY_WIDTH:].decode("utf-8") for entry in self.entries[start:end]] for start, end in zip(starts, ends)
+        ]
+
+    def lookup(self, scheme: str, value: str) -> List[str]:
+        """Look up the OpenAIRE ids of a pid.
+
+        :param scheme: The pid scheme, e.g. doi, pmid or orcid.
+        :param value: The pid value.
+        :return: The OpenAIRE ids, an empty list if the pid is not in the index.
+        """
+
+        return self.lookup_many([(scheme, value)])[0]
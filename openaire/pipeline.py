@@ -0,0 +1,396 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+### Pipeline of record transform stages, composed into a single pass over each part file and run on batches of rows.
+
+import datetime
+import json
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from openaire.column_stats import TableStats
+from openaire.projection import Projection
+
+# Number of rows handed to the stages at once.
+DEFAULT_PIPELINE_BATCH_SIZE = 10_000
+
+# Prefixes of DOIs written as links or with a scheme, removed by the normalise_doi stage.
+DOI_PREFIXES = ["https://doi.org/", "http://doi.org/", "https://dx.doi.org/", "http://dx.doi.org/", "doi:"]
+
+
+class TransformStage(ABC):
+
+    """A stage of a transform pipeline. A stage transforms a batch of rows at a time, so it can be vectorised or
+    amortise its per-call costs over the batch.
+
+    Subclasses set the name the stage is declared with in the config file, and implement apply. A stage that keeps
+    state across batches, e.g. statistics, implements empty and merge, so that the state of the copies run in each
+    worker process can be merged.
+    """
+
+    name = "stage"
+
+    # Whether the stage changes the rows. A pipeline of stages that do not, e.g. statistics, writes no output.
+    modifies_rows = True
+
+    def setup(self, fields: List[Dict], table_name: str) -> List[Dict]:
+        """Check the stage against the schema of its input and prepare it.
+
+        :param fields: The schema fields of the rows given to the stage.
+        :param table_name: The name of the table, for the error messages.
+        :return: The schema fields of the rows output by the stage.
+        """
+
+        return fields
+
+    @abstractmethod
+    def apply(self, rows: List[Dict]) -> List[Dict]:
+        """Transform a batch of rows.
+
+        :param rows: The rows, which may be modified in place.
+        :return: The transformed rows.
+        """
+
+    def empty(self) -> "TransformStage":
+        """A copy of the stage without its accumulated state, for a worker to run."""
+
+        return self
+
+    def merge(self, other: "TransformStage"):
+        """Merge the state accumulated by a copy of the stage."""
+
+        pass
+
+
+def remove_row_nulls(row: Dict, suspect_columns: List[str]) -> Dict:
+    """
+    Removes unnecessary nulls/Nones from the top level columns of a single row.
+
+    :param row: The row of data.
+    :param suspect_columns: Set of columns that have the Nones. Top level to the data only.
+    :return: The row with the Nones removed.
+    """
+
+    # Loop through the suspect columns of data with Nones/null.
+    for column in suspect_columns:
+        # Sometimes this column does not exist in the data. Try is to avoid it.
+        try:
+            # Filter out the nones
+            row[column] = [s for s in row[column] if s is not None]
+        except KeyError:
+            pass
+
+    return row
+
+
+class RemoveNulls(TransformStage):
+
+    """Remove the nulls from top level repeated columns, which BigQuery cannot load.
+
+    :param columns: The suspect columns.
+    """
+
+    name = "remove_nulls"
+
+    def __init__(self, columns: List[str]):
+        self.columns = columns
+
+    def apply(self, rows: List[Dict]) -> List[Dict]:
+        return [remove_row_nulls(row, self.columns) for row in rows]
+
+
+class Project(TransformStage):
+
+    """Project the rows onto a subset of their fields, see Projection.
+
+    :param projection: The projection.
+    """
+
+    name = "project"
+
+    def __init__(self, projection: Projection):
+        self.projection = projection
+
+    def setup(self, fields: List[Dict], table_name: str) -> List[Dict]:
+        self.projection.check(fields, table_name)
+        projected_fields = self.projection.schema(fields)
+        assert projected_fields, f"Table {table_name}: the projection removes every field of the table."
+
+        return projected_fields
+
+    def apply(self, rows: List[Dict]) -> List[Dict]:
+        return [self.projection.apply(row) for row in rows]
+
+
+def normalise_doi(value: str) -> str:
+    """Normalise a DOI to its bare, lower case form, e.g. https://doi.org/10.1000/ABC becomes 10.1000/abc."""
+
+    value = value.strip()
+    for prefix in DOI_PREFIXES:
+        if value.lower().startswith(prefix):
+            value = value[len(prefix) :]
+            break
+
+    return value.strip().lower()
+
+
+class NormaliseDoi(TransformStage):
+
+    """Normalise the DOIs in the pid, instance.pid and instance.alternateIdentifier fields of the results, the pids
+    with the doi scheme, so that the same DOI is written the same way in every row."""
+
+    name = "normalise_doi"
+
+    def setup(self, fields: List[Dict], table_name: str) -> List[Dict]:
+        names = {field["name"] for field in fields}
+        assert names & {"pid", "instance"}, f"Table {table_name}: normalise_doi needs a pid or instance field."
+
+        return fields
+
+    @staticmethod
+    def normalise_pids(pids: Optional[List[Dict]]):
+        for pid in pids or []:
+            if pid and isinstance(pid.get("value"), str) and str(pid.get("scheme", "")).strip().lower() == "doi":
+                pid["value"] = normalise_doi(pid["value"])
+
+    def apply(self, rows: List[Dict]) -> List[Dict]:
+        for row in rows:
+            self.normalise_pids(row.get("pid"))
+            for instance in row.get("instance") or []:
+                if instance:
+                    self.normalise_pids(instance.get("pid"))
+                    self.normalise_pids(instance.get("alternateIdentifier"))
+
+        return rows
+
+
+def coerce_json_value(value: Any, field_type: str) -> Any:
+    """Coerce a JSON value to the type of its BigQuery column, or None if it cannot be.
+
+    :param value: The value, not a record.
+    :param field_type: The BigQuery type of the column.
+    :return: The coerced value.
+    """
+
+    try:
+        if field_type == "STRING":
+            return value if isinstance(value, str) else json.dumps(value)
+        if field_type in ("INTEGER", "INT64"):
+            return value if isinstance(value, int) and not isinstance(value, bool) else int(float(value))
+        if field_type in ("FLOAT", "FLOAT64", "NUMERIC"):
+            return value if isinstance(value, float) else float(value)
+        if field_type in ("BOOLEAN", "BOOL"):
+            if isinstance(value, bool):
+                return value
+            return {"true": True, "false": False}.get(str(value).strip().lower())
+        if field_type == "DATE":
+            return datetime.date.fromisoformat(str(value)[:10]).isoformat()
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+    return value
+
+
+class CoerceTypes(TransformStage):
+
+    """Coerce the values of the rows to the types of their columns in the schema, e.g. numbers given as strings, and
+    set the values that cannot be coerced, e.g. malformed dates, to null rather than failing the BigQuery load."""
+
+    name = "coerce_types"
+
+    def __init__(self):
+        self.fields: List[Dict] = []
+
+    def setup(self, fields: List[Dict], table_name: str) -> List[Dict]:
+        self.fields = fields
+        return fields
+
+    def coerce_record(self, record: Dict, fields: List[Dict]):
+        for field in fields:
+            value = record.get(field["name"])
+            if value is None:
+                continue
+
+            if field["type"] in ("RECORD", "STRUCT"):
+                for item in value if isinstance(value, list) else [value]:
+                    if isinstance(item, dict):
+                        self.coerce_record(item, field["fields"])
+            elif isinstance(value, list):
+                # BigQuery does not load nulls in a repeated column.
+                coerced = [coerce_json_value(v, field["type"]) for v in value if v is not None]
+                record[field["name"]] = [v for v in coerced if v is not None]
+            else:
+                record[field["name"]] = coerce_json_value(value, field["type"])
+
+    def apply(self, rows: List[Dict]) -> List[Dict]:
+        for row in rows:
+            self.coerce_record(row, self.fields)
+
+        return rows
+
+
+class CollectStats(TransformStage):
+
+    """Collect the column statistics of the transformed rows, see TableStats. Added last to the pipeline of every table
+    when column statistics are enabled."""
+
+    name = "column_stats"
+    modifies_rows = False
+
+    def __init__(self, stats: Optional[TableStats] = None):
+        self.stats = stats
+
+    def setup(self, fields: List[Dict], table_name: str) -> List[Dict]:
+        self.stats = TableStats(fields)
+        return fields
+
+    def apply(self, rows: List[Dict]) -> List[Dict]:
+        self.stats.observe_batch(rows)
+
+        return rows
+
+    def empty(self) -> "CollectStats":
+        return CollectStats(self.stats.empty())
+
+    def merge(self, other: "CollectStats"):
+        self.stats.merge(other.stats)
+
+
+# The stages that can be declared in the transforms of a table in the config file.
+TRANSFORM_STAGES = {stage.name: stage for stage in [NormaliseDoi, CoerceTypes]}
+
+
+class Pipeline:
+
+    """A pipeline of transform stages, composed into a single pass over the rows of each part file. The rows are handed
+    to the stages in batches, and the time spent in each stage is recorded, so the cost of each stage can be seen.
+
+    :param stages: The stages, in the order they are run.
+    """
+
+    def __init__(self, stages: List[TransformStage]):
+        self.stages = stages
+        self.rows = 0
+        self.timings = {stage.name: 0.0 for stage in stages}
+
+    @property
+    def modifies_rows(self) -> bool:
+        return any(stage.modifies_rows for stage in self.stages)
+
+    def stage(self, name: str) -> Optional[TransformStage]:
+        return next((stage for stage in self.stages if stage.name == name), None)
+
+    def setup(self, fields: List[Dict], table_name: str) -> List[Dict]:
+        """Set up each stage with the schema of its input.
+
+        :param fields: The schema fields of the table.
+        :param table_name: The name of the table.
+        :return: The schema fields of the rows output by the pipeline.
+        """
+
+        for stage in self.stages:
+            fields = stage.setup(fields, table_name)
+
+        return fields
+
+    def apply(self, rows: List[Dict]) -> List[Dict]:
+        """Run a batch of rows through every stage.
+
+        :param rows: The rows.
+        :return: The transformed rows.
+        """
+
+        self.rows += len(rows)
+        for stage in self.stages:
+            start = time.perf_counter()
+            rows = stage.apply(rows)
+            self.timings[stage.name] += time.perf_counter() - start
+
+        return rows
+
+    def run(self, rows: Iterable[Dict], batch_size: int = DEFAULT_PIPELINE_BATCH_SIZE) -> Iterator[Dict]:
+        """Run a stream of rows through the pipeline in batches.
+
+        :param rows: The rows.
+        :param batch_size: The number of rows per batch.
+        :return: Generator of the transformed rows.
+        """
+
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield from self.apply(batch)
+                batch = []
+
+        if batch:
+            yield from self.apply(batch)
+
+    def empty(self) -> "Pipeline":
+        """A copy of the pipeline without its timings and accumulated state, for a worker to run."""
+
+        return Pipeline([stage.empty() for stage in self.stages])
+
+    def merge(self, other: "Pipeline"):
+        """Merge the timings and state of a copy of the pipeline run by a worker."""
+
+        self.rows += other.rows
+        for stage, other_stage in zip(self.stages, other.stages):
+            self.timings[stage.name] += other.timings[other_stage.name]
+            stage.merge(other_stage)
+
+    def report(self) -> Dict:
+        return {"rows": self.rows, "seconds": {name: round(seconds, 3) for name, seconds in self.timings.items()}}
+
+
+def create_pipeline(
+    fields: List[Dict],
+    table_name: str,
+    remove_nulls: Optional[List[str]] = None,
+    projection: Optional[Projection] = None,
+    transforms: Optional[List[str]] = None,
+    column_stats: bool = False,
+) -> Pipeline:
+    """Create the transform pipeline of a table from its config: the nulls are removed first, then the rows are
+    projected, then the declared transforms are run in the order given, and the column statistics are collected last.
+
+    :param fields: The schema fields of the table.
+    :param table_name: The name of the table.
+    :param remove_nulls: The columns to remove the nulls from.
+    :param projection: The projection of the rows.
+    :param transforms: The names of the declared transform stages, see TRANSFORM_STAGES.
+    :param column_stats: Whether to collect the column statistics.
+    :return: The pipeline, set up with the schema.
+    """
+
+    stages = []
+    if remove_nulls:
+        stages.append(RemoveNulls(remove_nulls))
+    if projection:
+        stages.append(Project(projection))
+    for name in transforms or []:
+        assert (
+            name in TRANSFORM_STAGES
+        ), f"Table {table_name}: unknown transform {name}, must be from {list(TRANSFORM_STAGES)}"
+        stages.append(TRANSFORM_STAGES[name]())
+    if column_stats:
+        stages.append(CollectStats())
+
+    pipeline = Pipeline(stages)
+    pipeline.setup(fields, table_name)
+
+    return pipeline
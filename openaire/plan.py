@@ -0,0 +1,275 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+import os
+from dataclasses import dataclass, asdict
+from typing import Dict, List
+
+from openaire.admission import total_memory
+from openaire.dedup import DEFAULT_BLOOM_BYTES
+from openaire.history import RunHistory
+from openaire.model import Table
+from openaire.pid_index import RESULT_TABLES
+from openaire.progress import format_bytes, format_seconds, total_size
+
+# The stages of the workflow, in the order they are run.
+STAGES = [
+    "download",
+    "decompress",
+    "transform",
+    "dedup",
+    "integrity_check",
+    "pid_index",
+    "graph_export",
+    "gcs_upload",
+    "bq_import",
+    "relation_subsets",
+    "cleanup",
+]
+
+# Throughput (bytes/s) and ratios assumed for a stage when no previous run has been recorded.
+DEFAULT_MODEL = {
+    "download": {"rate": 50 * 1024**2},
+    "decompress": {"rate": 200 * 1024**2, "output_ratio": 1.0},
+    "transform": {
+        "rate": 20 * 1024**2,
+        "output_ratio": 1.0,
+        "memory_ratio": 15.0,
+        "largest_part_bytes": 512 * 1024**2,
+    },
+    "dedup": {"rate": 30 * 1024**2},
+    "integrity_check": {"rate": 30 * 1024**2},
+    "pid_index": {"rate": 30 * 1024**2},
+    "graph_export": {"rate": 20 * 1024**2},
+    "gcs_upload": {"rate": 100 * 1024**2},
+    "bq_import": {"rate": 200 * 1024**2, "bq_ratio": 8.0},
+    "relation_subsets": {"rate": 500 * 1024**2},
+    "cleanup": {"rate": 2 * 1024**3},
+}
+
+
+@dataclass
+class StageEstimate:
+
+    """Estimated cost of running a workflow stage.
+
+    :param stage: Name of the stage.
+    :param input_bytes: Bytes read by the stage.
+    :param seconds: Estimated wall time in seconds.
+    :param disk_bytes: Estimated local disk used by the workflow once the stage has finished.
+    :param memory_bytes: Estimated peak memory of the stage.
+    :param gcs_bytes: Bytes uploaded to Google Cloud Storage.
+    :param bq_bytes: Bytes stored in BigQuery.
+    :param measured: Whether the estimate is based on a previous run rather than the default model.
+    :param exceeds_memory: Whether the estimated peak memory is more than the memory of this machine.
+    """
+
+    stage: str
+    input_bytes: int
+    seconds: float
+    disk_bytes: int
+    memory_bytes: int = 0
+    gcs_bytes: int = 0
+    bq_bytes: int = 0
+    measured: bool = False
+    exceeds_memory: bool = False
+
+
+def model_value(history: RunHistory, stage: str, key: str) -> float:
+    """A value of the throughput model, from the run history if recorded or the default model otherwise."""
+
+    return history.get(stage, key, DEFAULT_MODEL[stage].get(key))
+
+
+def table_sizes(table: Table, history: RunHistory) -> Dict[str, int]:
+    """Estimate the bytes of each data product of a table, using files already on disk where there are any.
+
+    :param table: The table.
+    :param history: The run history.
+    :return: Dictionary of the download, extracted, transformed and upload bytes of the table.
+    """
+
+    download = table.download_size or total_size(list(table.download_paths.values()))
+
+    extracted = total_size(table.extracted_files) if os.path.isdir(table.part_location) else 0
+    if not extracted:
+        extracted = int(download * model_value(history, "decompress", "output_ratio"))
+
+    transformed = int(extracted * model_value(history, "transform", "output_ratio")) if table.needs_transform else 0
+    upload = transformed if table.needs_transform else extracted
+
+    # Tables streamed to BigQuery write no transformed files and skip the GCS upload.
+    if table.streams_to_bigquery:
+        transformed, upload = 0, 0
+
+    return {
+        "download": download,
+        "extracted": extracted,
+        "transformed": transformed,
+        "upload": upload,
+    }
+
+
+def plan_workflow(
+    tables: List[Table],
+    stages: List[str],
+    history: RunHistory,
+    max_processors: int = 7,
+    column_stats: bool = False,
+    dedup_bloom_bytes: int = DEFAULT_BLOOM_BYTES,
+) -> List[StageEstimate]:
+    """Estimate the wall time, disk, memory and cloud bytes of each stage of a run of the workflow.
+
+    Disk is accounted for every stage, selected or not, as the stages that are not selected are assumed to have already
+    been run, leaving their files on disk.
+
+    :param tables: The tables to process.
+    :param stages: The stages to run.
+    :param history: The run history, for throughput and ratios measured in previous runs.
+    :param max_processors: The maximum number of transform worker processes.
+    :param column_stats: Whether the transform also reads the tables that are not transformed, for their column
+        statistics.
+    :param dedup_bloom_bytes: The largest Bloom filter of the dedup stage, the bulk of its memory.
+    :return: The estimate of each selected stage.
+    """
+
+    sizes = {table.name: table_sizes(table, history) for table in tables}
+    total = {
+        key: sum(product_sizes[key] for product_sizes in sizes.values()) for key in ["download", "extracted", "upload"]
+    }
+    transform_input = sum(sizes[table.name]["extracted"] for table in tables if table.needs_transform or column_stats)
+    transform_output = sum(sizes[table.name]["transformed"] for table in tables)
+
+    # Memory of a transform worker scales with the size of the part file it holds in memory. The estimate is not capped
+    # at the memory of the machine, so that the plan shows when the transform needs more than the machine has.
+    local_parts = [file for table in tables if os.path.isdir(table.part_location) for file in table.extracted_files]
+    largest_part = max([os.path.getsize(file) for file in local_parts] + [0]) or model_value(
+        history, "transform", "largest_part_bytes"
+    )
+    transform_memory = int(max_processors * largest_part * model_value(history, "transform", "memory_ratio"))
+    if not transform_input:
+        transform_memory = 0
+
+    # The relation subsets are read from the relation table in BigQuery, which is clustered by source and target type,
+    # so the subsets together scan and store at most the relation table once.
+    relation_bq = sum(
+        int(sizes[table.name]["upload"] * model_value(history, "bq_import", "bq_ratio"))
+        for table in tables
+        if table.name == "relation"
+    )
+
+    result_bytes = sum(sizes[table.name]["extracted"] for table in tables if table.name in RESULT_TABLES)
+    relation_bytes = sum(sizes[table.name]["extracted"] for table in tables if table.name == "relation")
+
+    stage_bytes = {
+        "download": (total["download"], total["download"], 0),
+        "decompress": (total["download"], total["extracted"], 0),
+        "transform": (transform_input, transform_output, transform_memory),
+        "dedup": (total["upload"], 0, dedup_bloom_bytes if total["upload"] else 0),
+        "integrity_check": (total["extracted"], 0, 0),
+        "pid_index": (result_bytes, 0, 0),
+        "graph_export": (relation_bytes, 0, 0),
+        "gcs_upload": (total["upload"], 0, 0),
+        "bq_import": (total["upload"], 0, 0),
+        "relation_subsets": (relation_bq, 0, 0),
+        "cleanup": (0, 0, 0),
+    }
+    stage_bq_bytes = {
+        "bq_import": int(total["upload"] * model_value(history, "bq_import", "bq_ratio")),
+        "relation_subsets": relation_bq,
+    }
+
+    machine_memory = total_memory()
+    disk = 0
+    estimates = []
+    for stage in STAGES:
+        input_bytes, written_bytes, memory = stage_bytes[stage]
+        disk = 0 if stage == "cleanup" else disk + written_bytes
+
+        if stage not in stages:
+            continue
+
+        rate = model_value(history, stage, "rate")
+        estimates.append(
+            StageEstimate(
+                stage=stage,
+                input_bytes=input_bytes,
+                seconds=input_bytes / rate if rate else 0,
+                disk_bytes=disk,
+                memory_bytes=memory,
+                gcs_bytes=total["upload"] if stage == "gcs_upload" else 0,
+                bq_bytes=stage_bq_bytes.get(stage, 0),
+                measured=history.get(stage, "rate") is not None,
+                exceeds_memory=memory > machine_memory,
+            )
+        )
+
+    return estimates
+
+
+def format_plan(estimates: List[StageEstimate]) -> str:
+    """Format the estimates of a plan as a table.
+
+    :param estimates: The stage estimates.
+    :return: The formatted plan.
+    """
+
+    columns = ["Stage", "Input", "Wall time", "Disk after", "Memory", "GCS bytes", "BQ bytes", "Model"]
+    rows = [
+        [
+            e.stage,
+            format_bytes(e.input_bytes),
+            format_seconds(e.seconds),
+            format_bytes(e.disk_bytes),
+            format_bytes(e.memory_bytes),
+            format_bytes(e.gcs_bytes),
+            format_bytes(e.bq_bytes),
+            "measured" if e.measured else "default",
+        ]
+        for e in estimates
+    ]
+    rows.append(
+        [
+            "total",
+            "",
+            format_seconds(sum(e.seconds for e in estimates)),
+            f"peak {format_bytes(max([e.disk_bytes for e in estimates] + [0]))}",
+            f"peak {format_bytes(max([e.memory_bytes for e in estimates] + [0]))}",
+            format_bytes(sum(e.gcs_bytes for e in estimates)),
+            format_bytes(sum(e.bq_bytes for e in estimates)),
+            "",
+        ]
+    )
+
+    widths = [max(len(str(row[i])) for row in [columns] + rows) for i in range(len(columns))]
+    lines = ["  ".join(str(value).ljust(width) for value, width in zip(row, widths)) for row in [columns] + rows]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+
+    for e in estimates:
+        if e.exceeds_memory:
+            lines.append(
+                f"Warning: {e.stage} needs an estimated {format_bytes(e.memory_bytes)} of memory, more than the "
+                f"{format_bytes(total_memory())} of this machine. Fewer workers will run at once, and a single part "
+                f"that needs more than the machine has will swap."
+            )
+
+    return "\n".join(lines)
+
+
+def plan_to_dict(estimates: List[StageEstimate]) -> List[Dict]:
+    """Convert the estimates of a plan into a list of dictionaries, e.g. to save as JSON."""
+
+    return [asdict(estimate) for estimate in estimates]
@@ -0,0 +1,186 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+### Profiling of the workflow stages and of the tasks they run in worker processes.
+
+import cProfile
+import functools
+import glob
+import io
+import json
+import os
+import pathlib
+import pstats
+import shutil
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from openaire.admission import peak_memory, process_status, reset_peak_memory
+from openaire.progress import format_bytes
+
+# Folder where the profiles are written, None when profiling is disabled.
+_profile_folder: Optional[str] = None
+
+# The stage currently being profiled.
+_stage: Optional[str] = None
+
+
+def enable_profiling(profile_folder: str):
+    """Enable profiling of the workflow stages and their worker tasks.
+
+    :param profile_folder: Folder where the profiles and the per stage reports are written.
+    """
+
+    global _profile_folder
+    _profile_folder = profile_folder
+    pathlib.Path(profile_folder).mkdir(parents=True, exist_ok=True)
+
+
+def dump_profile(profiler: cProfile.Profile, stage_folder: str, prefix: str, task: str, start_rss: int):
+    """Save a profile and the memory high water mark of the profiled task to the stage folder.
+
+    The high water mark is reset when the task starts, see reset_peak_memory, as a warm worker runs the tasks of many
+    stages and its lifetime high water mark would otherwise be reported by every stage after the worst one. The memory
+    used by the task on top of what the process held when it started is recorded as well.
+
+    :param profiler: The profiler.
+    :param stage_folder: The folder of the stage being profiled.
+    :param prefix: Prefix of the file names, e.g. worker or main.
+    :param task: Name of the profiled task.
+    :param start_rss: The resident memory of the process when the task started.
+    """
+
+    name = f"{prefix}_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+    profiler.dump_stats(os.path.join(stage_folder, f"{name}.prof"))
+    peak = peak_memory()
+    with open(os.path.join(stage_folder, f"{name}.json"), "w") as f:
+        json.dump(
+            {
+                "process": f"{prefix}_{os.getpid()}",
+                "task": task,
+                "max_rss_bytes": peak,
+                "task_rss_bytes": max(0, peak - start_rss),
+            },
+            f,
+        )
+
+
+def profiled_call(stage_folder: str, func: Callable, *args, **kwargs):
+    """Run a task in a worker process under cProfile, saving its profile to the stage folder.
+
+    :param stage_folder: The folder of the stage being profiled.
+    :param func: The task function.
+    :return: The result of the task.
+    """
+
+    reset_peak_memory()
+    start_rss = process_status("self", "VmRSS")
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        dump_profile(profiler, stage_folder, "worker", func.__name__, start_rss)
+
+
+def worker_task(func: Callable) -> Callable:
+    """Wrap a function submitted to a process pool so that it is profiled when profiling is enabled.
+
+    :param func: The task function.
+    :return: The function to submit, the task function itself when profiling is disabled.
+    """
+
+    if _profile_folder is None or _stage is None:
+        return func
+
+    return functools.partial(profiled_call, os.path.join(_profile_folder, _stage), func)
+
+
+def stage_report(stage_folder: str, stage: str, top: int = 30) -> str:
+    """Merge the profiles of every process of a stage into one report of the hot functions and memory use.
+
+    :param stage_folder: The folder of the stage being profiled.
+    :param stage: The name of the stage.
+    :param top: The number of functions to list.
+    :return: The report.
+    """
+
+    stream = io.StringIO()
+    profiles = sorted(glob.glob(os.path.join(stage_folder, "*.prof")))
+
+    stream.write(f"Profile of stage {stage}, merged from {len(profiles)} profiles\n\n")
+    stats = pstats.Stats(*profiles, stream=stream)
+    stats.strip_dirs()
+    stream.write(f"Top {top} functions by own time:\n")
+    stats.sort_stats("tottime").print_stats(top)
+    stream.write(f"Top {top} functions by cumulative time:\n")
+    stats.sort_stats("cumulative").print_stats(top)
+
+    # A worker process can run many tasks of the stage, keep the highest high water mark of its tasks, and the most
+    # memory used by one of its tasks on top of what the process already held.
+    memory = {}
+    for file in glob.glob(os.path.join(stage_folder, "*.json")):
+        with open(file, "r") as f:
+            info = json.load(f)
+        max_rss, task_rss = memory.get(info["process"], (0, 0))
+        memory[info["process"]] = (max(max_rss, info["max_rss_bytes"]), max(task_rss, info["task_rss_bytes"]))
+
+    stream.write("Memory high water mark per process during the stage:\n")
+    for process, (max_rss, task_rss) in sorted(memory.items(), key=lambda item: item[1], reverse=True):
+        stream.write(f"  {process}: {format_bytes(max_rss)} (largest task {format_bytes(task_rss)})\n")
+
+    return stream.getvalue()
+
+
+@contextmanager
+def profile_stage(stage: str):
+    """Profile a workflow stage, in the main process and in the worker tasks wrapped with worker_task, and write a
+    merged report to <profile_folder>/<stage>.txt. Does nothing when profiling is disabled.
+
+    :param stage: The name of the stage.
+    """
+
+    global _stage
+
+    if _profile_folder is None:
+        yield
+        return
+
+    stage_folder = os.path.join(_profile_folder, stage)
+    shutil.rmtree(stage_folder, ignore_errors=True)
+    pathlib.Path(stage_folder).mkdir(parents=True, exist_ok=True)
+
+    _stage = stage
+    reset_peak_memory()
+    start_rss = process_status("self", "VmRSS")
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _stage = None
+        dump_profile(profiler, stage_folder, "main", stage, start_rss)
+
+        report = stage_report(stage_folder, stage)
+        report_path = os.path.join(_profile_folder, f"{stage}.txt")
+        with open(report_path, "w") as f:
+            f.write(report)
+
+        print(report[:4000])
+        print(f"Profile report for stage {stage} written to: {report_path}")
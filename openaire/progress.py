@@ -0,0 +1,115 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+import os
+import time
+from typing import List
+
+
+def format_bytes(num_bytes: float) -> str:
+    """Format a number of bytes in a human readable form, e.g. 1.5 GB
+
+    :param num_bytes: The number of bytes.
+    :return: The formatted string.
+    """
+
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(num_bytes) < 1024 or unit == "TB":
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+
+
+def format_seconds(seconds: float) -> str:
+    """Format a duration in seconds as HH:MM:SS
+
+    :param seconds: The duration in seconds.
+    :return: The formatted string.
+    """
+
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def total_size(file_paths: List[str]) -> int:
+    """Total size in bytes of the given files. Files that do not exist are counted as 0 bytes.
+
+    :param file_paths: The paths to the files.
+    :return: The total size in bytes.
+    """
+
+    return sum(os.path.getsize(file_path) for file_path in file_paths if os.path.exists(file_path))
+
+
+def largest_first(file_paths: List[str]) -> List[str]:
+    """Sort files by size, largest first, so that the biggest files are not left running on their own at the end.
+
+    :param file_paths: The paths to the files.
+    :return: The sorted paths.
+    """
+
+    return sorted(file_paths, key=lambda file_path: os.path.getsize(file_path), reverse=True)
+
+
+class Progress:
+
+    """Track the progress of a workflow stage by bytes processed and report the throughput and ETA.
+
+    :param stage: Name of the stage, used as the prefix of the progress messages.
+    :param total_bytes: Total number of bytes the stage will process. If 0, only the throughput is reported.
+    """
+
+    def __init__(self, stage: str, total_bytes: int):
+        self.stage = stage
+        self.total_bytes = total_bytes
+        self.done_bytes = 0
+        self.start_time = time.time()
+
+    @property
+    def elapsed(self) -> float:
+        return time.time() - self.start_time
+
+    @property
+    def rate(self) -> float:
+        """Throughput of the stage so far in bytes per second."""
+
+        return self.done_bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def update(self, num_bytes: int, label: str = ""):
+        """Record that a number of bytes has been processed and print the progress.
+
+        :param num_bytes: The number of bytes processed since the last update.
+        :param label: Optional label for what was processed, e.g. the file name.
+        """
+
+        self.done_bytes += num_bytes
+        print(f"{self.stage}: {self.message()} {label}".rstrip())
+
+    def message(self) -> str:
+        """The progress message, e.g. 35.2% (1.2 GB / 3.4 GB), 120.0 MB/s, ETA 00:00:18
+
+        :return: The progress message.
+        """
+
+        rate = self.rate
+        if not self.total_bytes:
+            return f"{format_bytes(self.done_bytes)}, {format_bytes(rate)}/s"
+
+        percent = self.done_bytes / self.total_bytes * 100
+        eta = (self.total_bytes - self.done_bytes) / rate if rate > 0 else 0
+        return (
+            f"{percent:.1f}% ({format_bytes(self.done_bytes)} / {format_bytes(self.total_bytes)}), "
+            f"{format_bytes(rate)}/s, ETA {format_seconds(max(eta, 0))}"
+        )
@@ -0,0 +1,188 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+### Projection of table rows and schemas onto a subset of their fields.
+
+import copy
+from typing import Dict, List, Optional
+
+
+def path_tree(paths: List[str]) -> Dict:
+    """Build a tree of field names from dotted field paths, e.g. ["id", "author.fullname"] becomes
+    {"id": {}, "author": {"fullname": {}}}. An empty subtree stands for the whole field.
+
+    :param paths: The dotted field paths.
+    :return: The tree.
+    """
+
+    tree = {}
+    for path in paths:
+        node = tree
+        names = path.split(".")
+        for i, name in enumerate(names):
+            # A whole field covers any of its subfields.
+            if name in node and not node[name]:
+                break
+            node = node.setdefault(name, {})
+            if i == len(names) - 1:
+                node.clear()
+
+    return tree
+
+
+def check_paths(fields: List[Dict], paths: List[str], table_name: str):
+    """Check that dotted field paths exist in a BigQuery schema, only going into RECORD fields.
+
+    :param fields: The schema fields.
+    :param paths: The dotted field paths.
+    :param table_name: The name of the table, for the error messages.
+    """
+
+    for path in paths:
+        columns = fields
+        for name in path.split("."):
+            assert columns is not None, f"Table {table_name}: field {path} goes into a field that is not a RECORD."
+            column = next((column for column in columns if column["name"] == name), None)
+            assert column, f"Table {table_name}: field {path} is not in the schema."
+            columns = column.get("fields")
+
+
+def keep_value(value, tree: Dict):
+    if not tree or value is None:
+        return value
+    if isinstance(value, list):
+        return [keep_fields(v, tree) if isinstance(v, dict) else v for v in value]
+    if isinstance(value, dict):
+        return keep_fields(value, tree)
+    return value
+
+
+def keep_fields(row: Dict, tree: Dict) -> Dict:
+    """Keep only the fields of a row that are in the tree, going into nested and repeated records.
+
+    :param row: The row.
+    :param tree: The tree of fields to keep.
+    :return: The projected row.
+    """
+
+    return {name: keep_value(row[name], subtree) for name, subtree in tree.items() if name in row}
+
+
+def drop_fields(row: Dict, tree: Dict) -> Dict:
+    """Remove the fields of a row that are in the tree, going into nested and repeated records.
+
+    :param row: The row, modified in place.
+    :param tree: The tree of fields to remove.
+    :return: The row.
+    """
+
+    for name, subtree in tree.items():
+        if not subtree:
+            row.pop(name, None)
+            continue
+
+        value = row.get(name)
+        for record in value if isinstance(value, list) else [value]:
+            if isinstance(record, dict):
+                drop_fields(record, subtree)
+
+    return row
+
+
+def keep_schema(fields: List[Dict], tree: Dict) -> List[Dict]:
+    projected = []
+    for field in fields:
+        if field["name"] not in tree:
+            continue
+        field = copy.deepcopy(field)
+        if tree[field["name"]]:
+            field["fields"] = keep_schema(field["fields"], tree[field["name"]])
+        projected.append(field)
+
+    return projected
+
+
+def drop_schema(fields: List[Dict], tree: Dict) -> List[Dict]:
+    projected = []
+    for field in fields:
+        subtree = tree.get(field["name"])
+        if subtree is not None and not subtree:
+            continue
+        field = copy.deepcopy(field)
+        if subtree:
+            field["fields"] = drop_schema(field["fields"], subtree)
+            # BigQuery does not allow a RECORD without fields.
+            if not field["fields"]:
+                continue
+        projected.append(field)
+
+    return projected
+
+
+class Projection:
+
+    """Projection of the rows of a table onto a subset of their fields, applied during the transform, and of the
+    BigQuery schema of the table to match.
+
+    Fields are given as dotted paths into nested RECORD fields, e.g. author.fullname. The keep fields are applied
+    first, then the drop fields are removed from what is left.
+
+    :param keep: Fields to keep, all other fields are removed. None to keep every field.
+    :param drop: Fields to remove.
+    """
+
+    def __init__(self, keep: Optional[List[str]] = None, drop: Optional[List[str]] = None):
+        self.keep = keep
+        self.drop = drop
+        self.keep_tree = path_tree(keep) if keep else None
+        self.drop_tree = path_tree(drop) if drop else None
+
+    def check(self, fields: List[Dict], table_name: str):
+        """Check that the fields of the projection exist in the schema of the table.
+
+        :param fields: The schema fields.
+        :param table_name: The name of the table.
+        """
+
+        check_paths(fields, (self.keep or []) + (self.drop or []), table_name)
+
+    def apply(self, row: Dict) -> Dict:
+        """Project a row.
+
+        :param row: The row.
+        :return: The projected row.
+        """
+
+        if self.keep_tree:
+            row = keep_fields(row, self.keep_tree)
+        if self.drop_tree:
+            row = drop_fields(row, self.drop_tree)
+
+        return row
+
+    def schema(self, fields: List[Dict]) -> List[Dict]:
+        """Project a BigQuery schema, removing the fields that are removed from the rows.
+
+        :param fields: The schema fields.
+        :return: The projected schema fields.
+        """
+
+        if self.keep_tree:
+            fields = keep_schema(fields, self.keep_tree)
+        if self.drop_tree:
+            fields = drop_schema(fields, self.drop_tree)
+
+        return fields
@@ -0,0 +1,188 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+### Deterministic sample of the data dump, streamed straight from the Zenodo tar parts.
+
+import gzip
+import hashlib
+import json
+import os
+import tarfile
+from typing import BinaryIO, Dict, Optional, Set, Tuple
+
+import requests
+
+from openaire.integrity import RELATION_TYPE_TABLES
+
+# Suffix of the data folder, GCS folder and BigQuery dataset of a sample run, so it never overwrites a full release.
+SAMPLE_SUFFIX = "_sample"
+
+# Compressed bytes read from Zenodo per table by default, split evenly over the tar parts of the table.
+DEFAULT_SAMPLE_BYTES = 256 * 1024**2
+
+# The relation type of the ids of each entity table, e.g. publication: result.
+TABLE_RELATION_TYPE = {table: type_ for type_, tables in RELATION_TYPE_TABLES.items() for table in tables}
+
+
+def in_sample(id_: str, fraction: float, seed: int) -> bool:
+    """Whether an OpenAIRE id is in the sample. The sample is a fixed function of the id, fraction and seed, so the
+    same ids are drawn on every run and in every table, whichever order the rows are read in.
+
+    :param id_: The OpenAIRE id.
+    :param fraction: The fraction of ids in the sample, between 0 and 1.
+    :param seed: The seed of the sample, a different seed draws a different sample.
+    :return: Whether the id is in the sample.
+    """
+
+    digest = hashlib.blake2b(f"{seed}:{id_}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") < fraction * 2**64
+
+
+def keep_row(
+    row: Dict, table_name: str, fraction: float, seed: int, relation_ids: Optional[Dict[str, Set[str]]] = None
+) -> bool:
+    """Whether a row is in the sample. Entity rows are kept if their id is in the sample. Relation rows are kept if both
+    their source and target are, so the relation sample only links entities of the sample.
+
+    :param row: The row.
+    :param table_name: The name of the table of the row.
+    :param fraction: The fraction of ids in the sample.
+    :param seed: The seed of the sample.
+    :param relation_ids: For the relation table, the ids actually sampled from the entity tables in this run, by
+        relation type. An endpoint of a type in here must be one of these ids, so that no edge points at an entity that
+        was left unread by the byte limit. Endpoints of other types only need to be in the sample.
+    :return: Whether to keep the row.
+    """
+
+    if table_name != "relation":
+        return row.get("id") is not None and in_sample(row["id"], fraction, seed)
+
+    relation_ids = relation_ids or {}
+    for id_, type_ in ((row.get("source"), row.get("sourceType")), (row.get("target"), row.get("targetType"))):
+        if id_ is None or not in_sample(id_, fraction, seed):
+            return False
+        if type_ in relation_ids and id_ not in relation_ids[type_]:
+            return False
+
+    return True
+
+
+class CountingReader:
+
+    """File object wrapper that counts the bytes read through it, to stop reading a download part way through.
+
+    :param raw: The file object to read from.
+    """
+
+    def __init__(self, raw: BinaryIO):
+        self.raw = raw
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.raw.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def sample_tar_stream(
+    fileobj: BinaryIO,
+    extract_path: str,
+    table_name: str,
+    fraction: float,
+    seed: int,
+    max_bytes: int,
+    relation_ids: Optional[Dict[str, Set[str]]] = None,
+) -> Tuple[Set[str], Dict]:
+    """Read a tar of gzipped JSONL part files as a stream and extract only the sampled rows of each part file, to the
+    same paths as a full extract. Reading stops once max_bytes of the tar have been read, part way through a part file
+    if need be: the part file is left unfinished rather than read to its end, as moving on to the next member of a tar
+    stream would, so the rest of the tar is never downloaded.
+
+    :param fileobj: The tar stream, e.g. the body of the download.
+    :param extract_path: Directory where the sampled part files are written.
+    :param table_name: The name of the table.
+    :param fraction: The fraction of ids in the sample.
+    :param seed: The seed of the sample.
+    :param max_bytes: The number of bytes of the tar to read at most.
+    :param relation_ids: For the relation table, the ids sampled from the entity tables, see keep_row.
+    :return: The ids of the sampled rows (empty for the relation table), and the counts of the rows read and kept.
+    """
+
+    reader = CountingReader(fileobj)
+    ids = set()
+    counts = {"rows_read": 0, "rows_kept": 0, "part_files": 0}
+
+    with tarfile.open(fileobj=reader, mode="r|") as tar:
+        for member in tar:
+            if reader.bytes_read >= max_bytes:
+                break
+            if not member.isfile() or not member.name.endswith(".json.gz"):
+                continue
+
+            # Only keep the path inside the extract folder, like a full extract.
+            output_path = os.path.join(extract_path, os.path.normpath(member.name).lstrip(os.sep))
+            assert os.path.abspath(output_path).startswith(
+                os.path.abspath(extract_path)
+            ), f"Tar member {member.name} is outside of the extract folder."
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+            counts["part_files"] += 1
+            with gzip.GzipFile(fileobj=tar.extractfile(member), mode="rb") as part, gzip.open(output_path, "wb") as out:
+                for line in part:
+                    if not line.strip():
+                        continue
+
+                    counts["rows_read"] += 1
+                    row = json.loads(line)
+                    if keep_row(row, table_name, fraction, seed, relation_ids):
+                        out.write(line if line.endswith(b"\n") else line + b"\n")
+                        counts["rows_kept"] += 1
+                        if table_name != "relation":
+                            ids.add(row["id"])
+
+                    if reader.bytes_read >= max_bytes:
+                        break
+
+            # Stop before asking for the next member, which would read the rest of this one first.
+            if reader.bytes_read >= max_bytes:
+                break
+
+    counts["bytes_read"] = reader.bytes_read
+
+    return ids, counts
+
+
+def sample_tar(
+    url: str,
+    extract_path: str,
+    table_name: str,
+    fraction: float,
+    seed: int,
+    max_bytes: int,
+    relation_ids: Optional[Dict[str, Set[str]]] = None,
+    timeout: int = 60,
+) -> Tuple[Set[str], Dict]:
+    """Stream a tar part of a table from Zenodo and extract its sampled rows, see sample_tar_stream. Nothing but the
+    sampled rows is written to disk.
+
+    :param url: Url of the tar part.
+    :param timeout: Timeout of the connection, in seconds.
+    :return: The ids of the sampled rows and the counts of the rows read and kept.
+    """
+
+    with requests.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        return sample_tar_stream(response.raw, extract_path, table_name, fraction, seed, max_bytes, relation_ids)
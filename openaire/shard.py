@@ -0,0 +1,214 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+import json
+import os
+import pathlib
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Set, Tuple
+
+from openaire.model import Table
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """Parse a shard given on the command line, in the form i/N, e.g. 0/4 is the first of 4 shards.
+
+    :param shard: The shard string.
+    :return: The shard index and the number of shards.
+    """
+
+    try:
+        index, num_shards = [int(value) for value in shard.split("/")]
+    except ValueError:
+        raise ValueError(f"Shard must be in the form i/N, e.g. 0/4, given: {shard}")
+
+    assert num_shards > 0 and 0 <= index < num_shards, f"Shard index must be in the range 0 to N-1, given: {shard}"
+
+    return index, num_shards
+
+
+def part_key(table: Table, download_path: str) -> str:
+    """The key of a table part in the shard manifest, e.g. publication/publication_1.tar
+
+    :param table: The table.
+    :param download_path: The local download path of the part.
+    :return: The key.
+    """
+
+    return f"{table.name}/{os.path.basename(download_path)}"
+
+
+def assign_parts(tables: List[Table], num_shards: int) -> Dict[str, int]:
+    """Deterministically split the part files of all tables across shards, balancing the bytes of each shard.
+
+    Parts are assigned largest first to the shard with the fewest bytes so far, ties broken by the lowest shard index,
+    so every node computes the same assignment from the same part inventory. Parts of unknown size count as 1 byte.
+
+    :param tables: The tables of the workflow.
+    :param num_shards: The number of shards.
+    :return: Dictionary of assignment[part_key] = shard index.
+    """
+
+    parts = []
+    for table in tables:
+        sizes = {part.key: part.size for part in table.parts} if table.parts else {}
+        for download_path in table.zenodo_download_paths.values():
+            parts.append((sizes.get(os.path.basename(download_path), 1), part_key(table, download_path)))
+
+    loads = [0] * num_shards
+    assignment = {}
+    for size, key in sorted(parts, key=lambda part: (-part[0], part[1])):
+        shard = loads.index(min(loads))
+        assignment[key] = shard
+        loads[shard] += size
+
+    return assignment
+
+
+def apply_shard(tables: List[Table], shard_index: int, num_shards: int, done: Set[str]) -> List[Table]:
+    """Restrict each table to the parts assigned to this shard that have not already been completed.
+
+    :param tables: The tables of the workflow.
+    :param shard_index: The index of this shard.
+    :param num_shards: The number of shards.
+    :param done: The part keys already recorded as completed in the manifest.
+    :return: The tables that have parts to process on this shard.
+    """
+
+    assignment = assign_parts(tables, num_shards)
+
+    shard_tables = []
+    for table in tables:
+        table.assigned_parts = {
+            os.path.basename(download_path)
+            for download_path in table.zenodo_download_paths.values()
+            if assignment[part_key(table, download_path)] == shard_index and part_key(table, download_path) not in done
+        }
+        if table.assigned_parts:
+            shard_tables.append(table)
+
+    return shard_tables
+
+
+class Manifest(ABC):
+    """Shared record of the table parts that have been uploaded to Google Cloud Storage by each shard."""
+
+    @abstractmethod
+    def mark_done(self, key: str, info: Dict):
+        """Record that a part has been uploaded.
+
+        :param key: The part key, see part_key.
+        :param info: Information about the part to record, e.g. the shard and the uploaded blobs.
+        """
+
+    @abstractmethod
+    def done_keys(self) -> Set[str]:
+        """The keys of all the parts that have been uploaded.
+
+        :return: The part keys.
+        """
+
+    def wait_for(self, keys: Set[str], poll_interval: int = 60, timeout: int = 24 * 60 * 60):
+        """Wait until all of the given parts have been uploaded.
+
+        :param keys: The part keys to wait for.
+        :param poll_interval: Seconds between checks of the manifest.
+        :param timeout: Maximum number of seconds to wait.
+        """
+
+        start = time.time()
+        while True:
+            remaining = keys - self.done_keys()
+            if not remaining:
+                return
+
+            assert time.time() - start < timeout, f"Timed out waiting for parts: {sorted(remaining)}"
+            print(f"Waiting for {len(remaining)} parts from the other shards: {sorted(remaining)[:10]}")
+            time.sleep(poll_interval)
+
+
+class LocalManifest(Manifest):
+    """Manifest stored in a local or network mounted directory, one JSON file per part.
+
+    :param path: The manifest directory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+
+    def mark_done(self, key: str, info: Dict):
+        file_path = os.path.join(self.path, f"{key}.json")
+        pathlib.Path(os.path.dirname(file_path)).mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first so that other shards never see a partially written entry.
+        with open(f"{file_path}.tmp", "w") as f:
+            json.dump(info, f)
+        os.replace(f"{file_path}.tmp", file_path)
+
+    def done_keys(self) -> Set[str]:
+        keys = set()
+        for root, _, files in os.walk(self.path):
+            for file in files:
+                if file.endswith(".json"):
+                    keys.add(os.path.relpath(os.path.join(root, file), self.path)[: -len(".json")])
+        return keys
+
+
+class GCSManifest(Manifest):
+    """Manifest stored in a Google Cloud Storage bucket, one JSON blob per part.
+
+    :param bucket_name: The name of the bucket.
+    :param prefix: The folder in the bucket for the manifest.
+    """
+
+    def __init__(self, bucket_name: str, prefix: str):
+        self.bucket_name = bucket_name
+        self.prefix = prefix.strip("/")
+        self._client = None
+
+    @property
+    def client(self):
+        """The storage client, created on first use and kept for every later call."""
+
+        if self._client is None:
+            from google.cloud import storage
+
+            self._client = storage.Client()
+        return self._client
+
+    def mark_done(self, key: str, info: Dict):
+        bucket = self.client.bucket(self.bucket_name)
+        bucket.blob(f"{self.prefix}/{key}.json").upload_from_string(json.dumps(info), content_type="application/json")
+
+    def done_keys(self) -> Set[str]:
+        blobs = self.client.list_blobs(self.bucket_name, prefix=f"{self.prefix}/")
+        return {blob.name[len(self.prefix) + 1 : -len(".json")] for blob in blobs if blob.name.endswith(".json")}
+
+
+def create_manifest(manifest_path: str) -> Manifest:
+    """Create the manifest for a path, either gs://<bucket>/<folder> or a local directory.
+
+    :param manifest_path: The path of the manifest.
+    :return: The manifest.
+    """
+
+    if manifest_path.startswith("gs://"):
+        bucket_name, _, prefix = manifest_path[len("gs://") :].partition("/")
+        return GCSManifest(bucket_name, prefix)
+
+    return LocalManifest(manifest_path)
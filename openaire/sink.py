@@ -0,0 +1,544 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+### Sinks that write transformed records straight into BigQuery, without staging files in Google Cloud Storage.
+
+import datetime
+import functools
+import json
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Only protobuf is needed to encode the records. The Google Cloud libraries are imported by BigQueryWriteSink when it is
+# used, so the encoding and InMemorySink work without them.
+from google.protobuf import descriptor_pb2, descriptor_pool, json_format, message_factory
+
+# Number of rows sent to BigQuery in each append request.
+DEFAULT_BATCH_ROWS = 10_000
+
+# Maximum size of an append request, BigQuery rejects requests over 10 MB.
+DEFAULT_BATCH_BYTES = 8 * 1024**2
+
+# Number of append requests of a stream sent without waiting for their response, which bounds the memory of a stream.
+DEFAULT_APPENDS_IN_FLIGHT = 4
+
+# Protobuf types of the BigQuery column types. DATE is sent as the number of days since the epoch.
+PROTO_TYPES = {
+    "STRING": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+    "INTEGER": descriptor_pb2.FieldDescriptorProto.TYPE_INT64,
+    "INT64": descriptor_pb2.FieldDescriptorProto.TYPE_INT64,
+    "FLOAT": descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE,
+    "FLOAT64": descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE,
+    "BOOLEAN": descriptor_pb2.FieldDescriptorProto.TYPE_BOOL,
+    "BOOL": descriptor_pb2.FieldDescriptorProto.TYPE_BOOL,
+    "DATE": descriptor_pb2.FieldDescriptorProto.TYPE_INT32,
+}
+
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def load_schema(schema_file_path: str) -> List[Dict]:
+    """Load a BigQuery JSON schema file from database/schemas.
+
+    :param schema_file_path: Path to the schema file.
+    :return: The list of schema fields.
+    """
+
+    with open(schema_file_path, "r") as f:
+        return json.load(f)
+
+
+def schema_to_descriptor(fields: List[Dict], name: str) -> descriptor_pb2.DescriptorProto:
+    """Create a self contained protobuf message descriptor for a BigQuery schema, RECORD fields as nested messages.
+
+    :param fields: The schema fields.
+    :param name: The name of the message.
+    :return: The message descriptor.
+    """
+
+    proto = descriptor_pb2.DescriptorProto(name=name)
+    for number, field in enumerate(fields, start=1):
+        proto_field = proto.field.add(name=field["name"], number=number)
+        mode = field.get("mode", "NULLABLE")
+        proto_field.label = (
+            descriptor_pb2.FieldDescriptorProto.LABEL_REPEATED
+            if mode == "REPEATED"
+            else descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL
+        )
+
+        if field["type"] in ("RECORD", "STRUCT"):
+            nested = schema_to_descriptor(field["fields"], f"{field['name']}_Record")
+            proto.nested_type.append(nested)
+            proto_field.type = descriptor_pb2.FieldDescriptorProto.TYPE_MESSAGE
+            proto_field.type_name = nested.name
+        else:
+            proto_field.type = PROTO_TYPES[field["type"]]
+
+    return proto
+
+
+def descriptor_to_message_class(descriptor: descriptor_pb2.DescriptorProto):
+    """Create a Python protobuf message class from a message descriptor.
+
+    :param descriptor: The message descriptor.
+    :return: The message class.
+    """
+
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(descriptor_pb2.FileDescriptorProto(name=f"{descriptor.name}.proto", message_type=[descriptor]))
+    message_descriptor = pool.FindMessageTypeByName(descriptor.name)
+
+    # GetMessageClass replaces MessageFactory.GetPrototype in newer versions of protobuf.
+    if hasattr(message_factory, "GetMessageClass"):
+        return message_factory.GetMessageClass(message_descriptor)
+    return message_factory.MessageFactory(pool).GetPrototype(message_descriptor)
+
+
+def coerce_value(value: Any, field: Dict, rejected: Dict[str, int], path: str) -> Any:
+    """Coerce a JSON value to the type of its BigQuery column. Raises TypeError or ValueError for a value that cannot
+    be coerced, which a BigQuery load job would reject.
+
+    :param value: The value.
+    :param field: The schema field.
+    :param rejected: The number of rejected values of each field, see prepare_row.
+    :param path: The dotted path of the field.
+    :return: The coerced value.
+    """
+
+    field_type = field["type"]
+    if field_type in ("RECORD", "STRUCT"):
+        if not isinstance(value, dict):
+            raise TypeError(f"{path}: expected a record, got {type(value).__name__}")
+        return prepare_row(value, field["fields"], rejected, f"{path}.")
+    if field_type == "STRING":
+        return value if isinstance(value, str) else json.dumps(value)
+    if field_type in ("INTEGER", "INT64"):
+        return int(value)
+    if field_type in ("FLOAT", "FLOAT64"):
+        return float(value)
+    if field_type in ("BOOLEAN", "BOOL"):
+        if isinstance(value, bool):
+            return value
+        if str(value).lower() not in ("true", "false"):
+            raise ValueError(f"{path}: not a boolean: {value}")
+        return str(value).lower() == "true"
+    if field_type == "DATE":
+        return (datetime.date.fromisoformat(str(value)[:10]) - EPOCH).days
+
+    return value
+
+
+def prepare_row(row: Dict, fields: List[Dict], rejected: Dict[str, int], prefix: str = "") -> Dict:
+    """Prepare a record for protobuf encoding: coerce values to the schema types and drop nulls and fields that are not
+    in the schema, as ignore_unknown_values does for load jobs.
+
+    A value that cannot be coerced to the type of its column is left out of the record and counted in rejected by the
+    dotted path of its field, so the sink can report the rejected values and fail past a threshold, as a load job
+    fails past max_bad_records.
+
+    :param row: The record.
+    :param fields: The schema fields.
+    :param rejected: The number of rejected values of each field, updated in place.
+    :param prefix: The dotted path of the record, for nested records.
+    :return: The prepared record.
+    """
+
+    prepared = {}
+    for field in fields:
+        value = row.get(field["name"])
+        if value is None:
+            continue
+
+        path = f"{prefix}{field['name']}"
+        repeated = field.get("mode") == "REPEATED"
+        coerced = []
+        for v in (value if isinstance(value, list) else [value]) if repeated else [value]:
+            if v is None:
+                continue
+            try:
+                coerced.append(coerce_value(v, field, rejected, path))
+            except (TypeError, ValueError, OverflowError):
+                rejected[path] = rejected.get(path, 0) + 1
+
+        if repeated:
+            if coerced:
+                prepared[field["name"]] = coerced
+        elif coerced:
+            prepared[field["name"]] = coerced[0]
+
+    return prepared
+
+
+def decode_value(value: Any, field: Dict) -> Any:
+    """Convert a value decoded from protobuf back to the value BigQuery returns for its column: DATE from its number of
+    days since the epoch to an ISO date, and INTEGER from the string protobuf gives for 64 bit integers to an int."""
+
+    field_type = field["type"]
+    if field_type in ("RECORD", "STRUCT"):
+        return decode_row(value, field["fields"])
+    if field_type in ("INTEGER", "INT64"):
+        return int(value)
+    if field_type == "DATE":
+        return (EPOCH + datetime.timedelta(days=value)).isoformat()
+
+    return value
+
+
+def decode_row(row: Dict, fields: List[Dict]) -> Dict:
+    """Convert a record decoded from protobuf back to the values BigQuery returns, see decode_value.
+
+    :param row: The decoded record.
+    :param fields: The schema fields.
+    :return: The record.
+    """
+
+    for field in fields:
+        name = field["name"]
+        if name in row:
+            if field.get("mode") == "REPEATED":
+                row[name] = [decode_value(value, field) for value in row[name]]
+            else:
+                row[name] = decode_value(row[name], field)
+
+    return row
+
+
+class RowEncoder:
+
+    """Encode records as serialised protobuf rows for a BigQuery schema.
+
+    :param schema_file_path: Path to the schema file.
+    :param name: Name of the protobuf message.
+    """
+
+    def __init__(self, schema_file_path: str, name: str = "Row"):
+        self.fields = load_schema(schema_file_path)
+        self.descriptor = schema_to_descriptor(self.fields, name)
+        self.message_class = descriptor_to_message_class(self.descriptor)
+
+        # The number of values of each field that could not be coerced to its type, and were left out.
+        self.rejected: Dict[str, int] = {}
+
+    def encode(self, row: Dict) -> bytes:
+        message = json_format.ParseDict(prepare_row(row, self.fields, self.rejected), self.message_class())
+        return message.SerializeToString()
+
+    def decode(self, data: bytes) -> Dict:
+        message = self.message_class.FromString(data)
+        return decode_row(json_format.MessageToDict(message, preserving_proto_field_name=True), self.fields)
+
+
+def batches(encoder: RowEncoder, rows: Iterable[Dict], batch_rows: int, batch_bytes: int) -> Iterable[List[bytes]]:
+    """Encode records and group them into batches of at most batch_rows rows and batch_bytes bytes.
+
+    :param encoder: The row encoder.
+    :param rows: The records.
+    :param batch_rows: The maximum number of rows in a batch.
+    :param batch_bytes: The maximum number of bytes in a batch.
+    :return: Generator of batches of encoded rows.
+    """
+
+    batch, size = [], 0
+    for row in rows:
+        data = encoder.encode(row)
+        if batch and (len(batch) >= batch_rows or size + len(data) > batch_bytes):
+            yield batch
+            batch, size = [], 0
+        batch.append(data)
+        size += len(data)
+
+    if batch:
+        yield batch
+
+
+class RecordSink(ABC):
+
+    """Destination for the transformed records of a table.
+
+    A table is written by any number of streams in parallel, e.g. one per part file in each worker process. The
+    records of a stream only become visible in the table once commit is called with every stream of the table, so a
+    table is either written in full or not at all.
+
+    Sinks are pickled to be sent to worker processes, so they should only hold configuration, not clients.
+
+    Values that cannot be coerced to the type of their column are left out of their records and counted. Like a load
+    job with max_bad_records, the streams are not committed if there are more than max_rejected of them.
+    """
+
+    max_rejected = 0
+
+    def check_rejected(self, rejected: Dict[str, int]):
+        """Check the values rejected by the streams of the table against max_rejected, before they are committed.
+
+        :param rejected: The number of rejected values of each field, summed over the streams.
+        """
+
+        num_rejected = sum(rejected.values())
+        assert (
+            num_rejected <= self.max_rejected
+        ), f"{num_rejected} values could not be coerced to the types of their columns, more than {self.max_rejected}: {rejected}"
+
+    @abstractmethod
+    def create_table(self, overwrite: bool = False):
+        """Create the table before the streams are written. An existing table is only replaced when asked to, else it
+        is an error, so a run never deletes a table it was not told to replace.
+
+        :param overwrite: Whether to replace an existing table.
+        """
+
+    @abstractmethod
+    def write_stream(self, rows: Iterable[Dict]) -> Tuple[str, Dict[str, int]]:
+        """Write records to a new pending stream and finalise it.
+
+        :param rows: The records.
+        :return: The name of the stream, and the number of rejected values of each field.
+        """
+
+    @abstractmethod
+    def commit(self, stream_names: List[str]):
+        """Atomically commit the finalised streams of the table.
+
+        :param stream_names: The names of the streams.
+        """
+
+
+@functools.lru_cache(maxsize=None)
+def write_client():
+    """The Storage Write API client of this process, created once and kept for the streams of every part and table it
+    writes. Workers are not forked from a process holding one, see openaire.workers."""
+
+    from google.cloud import bigquery_storage_v1
+
+    return bigquery_storage_v1.BigQueryWriteClient()
+
+
+class BigQueryWriteSink(RecordSink):
+
+    """Sink that streams records into a BigQuery table with the Storage Write API, using pending streams and a batch
+    commit for exactly once semantics.
+
+    At most appends_in_flight appends of a stream are awaiting their response at once. Appends are sent with their row
+    offset, so a failed append is retried at the same offset without duplicating rows: the connection is reopened and
+    the append is sent again along with the appends behind it, which fail with OUT_OF_RANGE once one before them has
+    failed. A resent append answered with ALREADY_EXISTS was written the first time.
+
+    :param table_id: The fully qualified BigQuery table identifier.
+    :param schema_file_path: Path to the schema file for the table.
+    :param table_description: The description of the table.
+    :param partition_field: Optional column to time partition the table on.
+    :param partition_type: The time partitioning granularity, DAY, HOUR, MONTH or YEAR.
+    :param clustering_fields: Optional columns to cluster the table on.
+    :param batch_rows: The maximum number of rows in each append request.
+    :param batch_bytes: The maximum number of bytes in each append request.
+    :param max_rejected: The most values that may be rejected before the streams are not committed.
+    :param appends_in_flight: The most append requests of a stream awaiting their response at once.
+    :param retries: The number of times to retry a failed append.
+    """
+
+    def __init__(
+        self,
+        table_id: str,
+        schema_file_path: str,
+        table_description: str = "",
+        partition_field: Optional[str] = None,
+        partition_type: str = "DAY",
+        clustering_fields: Optional[List[str]] = None,
+        batch_rows: int = DEFAULT_BATCH_ROWS,
+        batch_bytes: int = DEFAULT_BATCH_BYTES,
+        max_rejected: int = 0,
+        appends_in_flight: int = DEFAULT_APPENDS_IN_FLIGHT,
+        retries: int = 3,
+    ):
+        self.table_id = table_id
+        self.schema_file_path = schema_file_path
+        self.table_description = table_description
+        self.partition_field = partition_field
+        self.partition_type = partition_type
+        self.clustering_fields = clustering_fields
+        self.batch_rows = batch_rows
+        self.batch_bytes = batch_bytes
+        self.max_rejected = max_rejected
+        self.appends_in_flight = appends_in_flight
+        self.retries = retries
+
+    @property
+    def table_path(self) -> str:
+        from google.cloud import bigquery_storage_v1
+
+        project_id, dataset_id, table_name = self.table_id.split(".")
+        return bigquery_storage_v1.BigQueryWriteClient.table_path(project_id, dataset_id, table_name)
+
+    def create_table(self, overwrite: bool = False):
+        from google.cloud import bigquery
+        from google.cloud.exceptions import NotFound
+
+        client = bigquery.Client()
+        try:
+            client.get_table(self.table_id)
+            exists = True
+        except NotFound:
+            exists = False
+
+        if exists:
+            assert overwrite, f"Table {self.table_id} already exists, set sink_overwrite to replace it."
+            client.delete_table(self.table_id)
+
+        table = bigquery.Table(self.table_id, schema=client.schema_from_json(self.schema_file_path))
+        table.description = self.table_description
+        if self.partition_field:
+            table.time_partitioning = bigquery.TimePartitioning(type_=self.partition_type, field=self.partition_field)
+        if self.clustering_fields:
+            table.clustering_fields = self.clustering_fields
+        client.create_table(table)
+
+    def write_stream(self, rows: Iterable[Dict]) -> Tuple[str, Dict[str, int]]:
+        from google.api_core import exceptions
+        from google.cloud.bigquery_storage_v1 import types as storage_types
+        from google.cloud.bigquery_storage_v1 import writer
+
+        func_name = self.write_stream.__name__
+        encoder = RowEncoder(self.schema_file_path)
+        client = write_client()
+
+        write_stream = storage_types.WriteStream()
+        write_stream.type_ = storage_types.WriteStream.Type.PENDING
+        write_stream = client.create_write_stream(parent=self.table_path, write_stream=write_stream)
+
+        # The schema is sent once, with the first request on the connection.
+        request_template = storage_types.AppendRowsRequest()
+        request_template.write_stream = write_stream.name
+        proto_schema = storage_types.ProtoSchema()
+        proto_schema.proto_descriptor = encoder.descriptor
+        proto_data = storage_types.AppendRowsRequest.ProtoData()
+        proto_data.writer_schema = proto_schema
+        request_template.proto_rows = proto_data
+        append_rows_stream = writer.AppendRowsStream(client, request_template)
+
+        def send(request) -> Future:
+            # A send on a connection that has already failed raises, it is retried with the appends before it.
+            try:
+                return append_rows_stream.send(request)
+            except Exception as e:
+                future = Future()
+                future.set_exception(exceptions.ServiceUnavailable(f"Append was not sent: {e}"))
+                return future
+
+        def wait_oldest():
+            nonlocal append_rows_stream
+            request, future = in_flight.popleft()
+            for i in range(self.retries + 1):
+                try:
+                    future.result()
+                    return
+                except exceptions.AlreadyExists:
+                    return
+                except Exception as e:
+                    retryable = not isinstance(e, exceptions.ClientError) or isinstance(
+                        e, (exceptions.OutOfRange, exceptions.TooManyRequests)
+                    )
+                    if not retryable or i == self.retries:
+                        raise
+                    print(f"{func_name}: append at offset {request.offset} failed: try={i}, exception={e}")
+
+                # Resend this append and the ones behind it, in order, on a new connection.
+                append_rows_stream.close()
+                time.sleep(2**i)
+                append_rows_stream = writer.AppendRowsStream(client, request_template)
+                future = send(request)
+                resent = [(queued, send(queued)) for queued, _ in in_flight]
+                in_flight.clear()
+                in_flight.extend(resent)
+
+        offset = 0
+        in_flight = deque()
+        try:
+            for batch in batches(encoder, rows, self.batch_rows, self.batch_bytes):
+                proto_rows = storage_types.ProtoRows()
+                proto_rows.serialized_rows.extend(batch)
+                proto_data = storage_types.AppendRowsRequest.ProtoData()
+                proto_data.rows = proto_rows
+
+                request = storage_types.AppendRowsRequest()
+                request.offset = offset
+                request.proto_rows = proto_data
+                if len(in_flight) >= self.appends_in_flight:
+                    wait_oldest()
+                in_flight.append((request, send(request)))
+                offset += len(batch)
+
+            while in_flight:
+                wait_oldest()
+        finally:
+            append_rows_stream.close()
+
+        client.finalize_write_stream(name=write_stream.name)
+
+        return write_stream.name, encoder.rejected
+
+    def commit(self, stream_names: List[str]):
+        from google.cloud.bigquery_storage_v1 import types as storage_types
+
+        request = storage_types.BatchCommitWriteStreamsRequest(parent=self.table_path, write_streams=stream_names)
+        response = write_client().batch_commit_write_streams(request)
+
+        assert not response.stream_errors, f"Table {self.table_id}: streams failed to commit: {response.stream_errors}"
+
+
+class InMemorySink(RecordSink):
+
+    """Fake sink that keeps the records in memory, for testing offline. Records are encoded and decoded with the
+    table schema just as they are for BigQuery, so schema problems show up without a connection.
+
+    As the records are kept in memory, the streams must be written in the same process as the sink.
+
+    :param schema_file_path: Path to the schema file for the table.
+    :param max_rejected: The most values that may be rejected before the streams are not committed.
+    """
+
+    def __init__(self, schema_file_path: str, max_rejected: int = 0):
+        self.schema_file_path = schema_file_path
+        self.max_rejected = max_rejected
+        self.encoder = RowEncoder(schema_file_path)
+        self.pending: Dict[str, List[bytes]] = {}
+        self.rows: Optional[List[Dict]] = None
+
+    def create_table(self, overwrite: bool = False):
+        assert self.rows is None or overwrite, "The table already exists, set overwrite to replace it."
+
+        self.pending = {}
+        self.rows = []
+
+    def write_stream(self, rows: Iterable[Dict]) -> Tuple[str, Dict[str, int]]:
+        assert self.rows is not None, "create_table must be called before writing streams"
+
+        name = f"stream_{uuid.uuid4().hex}"
+        self.encoder.rejected = {}
+        self.pending[name] = [
+            data for batch in batches(self.encoder, rows, DEFAULT_BATCH_ROWS, DEFAULT_BATCH_BYTES) for data in batch
+        ]
+
+        return name, self.encoder.rejected
+
+    def commit(self, stream_names: List[str]):
+        missing = [name for name in stream_names if name not in self.pending]
+        assert not missing, f"Streams not found: {missing}"
+
+        for name in stream_names:
+            self.rows.extend(self.encoder.decode(data) for data in self.pending.pop(name))
@@ -0,0 +1,293 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+### Warm worker processes shared by every stage and table of the workflow, forked from a preloaded forkserver.
+
+import atexit
+import importlib
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+# Modules imported once by the forkserver, so that every worker forked from it starts with them already imported. The
+# cloud clients are not among them: they are imported by a worker on its first cloud task, then kept for its others.
+PRELOAD_MODULES = [
+    "numpy",
+    "openaire.admission",
+    "openaire.batch_transform",
+    "openaire.data",
+    "openaire.dedup",
+    "openaire.graph",
+    "openaire.id_index",
+    "openaire.integrity",
+    "openaire.pid_index",
+    "openaire.pipeline",
+    "openaire.profiling",
+    "openaire.sample",
+]
+
+# Modules whose import time is reported by the startup benchmark.
+BENCHMARK_IMPORTS = ["main", "google.cloud.bigquery", "google.cloud.storage", "google.cloud.bigquery_storage_v1"]
+
+# The shared pool of warm workers and its number of workers.
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+
+# The number of workers the shared pool is created with, at least the number of CPUs.
+_pool_size = 0
+
+
+def start_method() -> str:
+    """The start method of the workers: forkserver where available, so that no worker is forked from a main process
+    holding threads or cloud clients, else spawn."""
+
+    return "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def init_worker(environ: Dict[str, str]):
+    """Start a worker with the environment of the main process, e.g. GOOGLE_APPLICATION_CREDENTIALS, which is set after
+    the forkserver may have started."""
+
+    os.environ.update(environ)
+
+
+def create_pool(max_workers: int, method: Optional[str] = None) -> ProcessPoolExecutor:
+    """Create a process pool whose workers are started with the preloaded modules.
+
+    :param max_workers: The number of workers.
+    :param method: The start method, defaults to start_method().
+    :return: The pool.
+    """
+
+    context = multiprocessing.get_context(method or start_method())
+    if context.get_start_method() == "forkserver":
+        context.set_forkserver_preload(PRELOAD_MODULES)
+
+    return ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=context, initializer=init_worker, initargs=(dict(os.environ),)
+    )
+
+
+def set_worker_pool_size(num_workers: int):
+    """Set the number of workers of the shared pool, before it is first used, to the most tasks any stage runs at once,
+    so that the pool is not restarted with more workers by a later stage.
+
+    :param num_workers: The number of workers.
+    """
+
+    global _pool_size
+    _pool_size = num_workers
+
+
+def shared_pool(min_workers: int) -> ProcessPoolExecutor:
+    """The shared pool of warm workers, started on first use with the larger of the pool size, the number of CPUs and
+    min_workers. It is only restarted if it broke or a stage runs more tasks at once than it has workers.
+
+    :param min_workers: The number of workers needed.
+    :return: The pool.
+    """
+
+    global _pool, _pool_workers
+
+    if _pool is not None and (getattr(_pool, "_broken", False) or _pool_workers < min_workers):
+        shutdown_worker_pools()
+
+    if _pool is None:
+        _pool_workers = max(_pool_size, os.cpu_count() or 1, min_workers)
+        _pool = create_pool(_pool_workers)
+
+    return _pool
+
+
+class LimitedExecutor(Executor):
+
+    """A view of the shared pool that runs at most max_workers tasks of a stage at once. A task is only submitted to the
+    pool once one of the earlier tasks of the stage has finished, so submit blocks while max_workers tasks are in flight.
+
+    :param pool: The shared pool.
+    :param max_workers: The maximum number of tasks in flight.
+    """
+
+    def __init__(self, pool: ProcessPoolExecutor, max_workers: int):
+        self.pool = pool
+        self.max_workers = max_workers
+        self.slots = threading.BoundedSemaphore(max_workers)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+
+        return future
+
+    def shutdown(self, wait: bool = True, **kwargs):
+        # The pool is shared by the stages, it is shut down by shutdown_worker_pools.
+        pass
+
+
+@contextmanager
+def worker_pool(max_workers: int) -> Iterator[Executor]:
+    """The warm workers, kept between the stages and tables of the workflow rather than started for each of them, so the
+    workers pay for their imports and cloud clients once. Every stage uses the same pool, limited to max_workers of its
+    tasks at once, so there is only ever one set of workers.
+
+    Used in place of a ProcessPoolExecutor in a with statement. The pool is left running at the end of the with block,
+    unless the block raised, in which case its waiting tasks are cancelled and it is shut down.
+
+    :param max_workers: The maximum number of tasks running at once.
+    :return: The pool, limited to max_workers tasks.
+    """
+
+    executor = LimitedExecutor(shared_pool(max_workers), max_workers)
+    try:
+        yield executor
+    except BaseException:
+        shutdown_worker_pools()
+        raise
+
+
+def shutdown_pool(pool: ProcessPoolExecutor):
+    # Waiting tasks can only be cancelled from Python 3.9.
+    if sys.version_info >= (3, 9):
+        pool.shutdown(wait=True, cancel_futures=True)
+    else:
+        pool.shutdown(wait=True)
+
+
+def shutdown_worker_pools():
+    """Shut down the warm workers, at the end of the workflow."""
+
+    global _pool
+
+    pool, _pool = _pool, None
+    if pool is not None:
+        shutdown_pool(pool)
+
+
+atexit.register(shutdown_worker_pools)
+
+
+def worker_import(modules: List[str]) -> int:
+    """A short task that imports the cloud libraries, as the first cloud task of a worker does.
+
+    :param modules: The modules to import.
+    :return: The process id of the worker.
+    """
+
+    for module in modules:
+        importlib.import_module(module)
+
+    return os.getpid()
+
+
+def time_stages(num_stages: int, max_workers: int, warm: bool, method: str, modules: List[str]) -> Dict:
+    """Time the start up of the workers of a number of stages that each run one short task per worker, with a new pool
+    per stage as before, or with the warm pool.
+
+    :param num_stages: The number of stages.
+    :param max_workers: The number of workers.
+    :param warm: Whether to reuse one pool for every stage.
+    :param method: The start method of the workers.
+    :param modules: The modules imported by each task.
+    :return: The total seconds, the seconds of the first stage and the number of worker processes started.
+    """
+
+    pids = set()
+    stage_seconds = []
+    pool = create_pool(max_workers, method) if warm else None
+    try:
+        for _ in range(num_stages):
+            start = time.perf_counter()
+            stage_pool = pool or ProcessPoolExecutor(max_workers=max_workers)
+            futures = [stage_pool.submit(worker_import, modules) for _ in range(max_workers)]
+            wait(futures)
+            pids.update(future.result() for future in futures)
+            if not warm:
+                stage_pool.shutdown()
+            stage_seconds.append(time.perf_counter() - start)
+    finally:
+        if pool:
+            pool.shutdown()
+
+    return {
+        "seconds": round(sum(stage_seconds), 3),
+        "first_stage_seconds": round(stage_seconds[0], 3),
+        "processes_started": len(pids),
+    }
+
+
+def import_seconds(module: str, cwd: str) -> Optional[float]:
+    """The wall time of a fresh interpreter importing a module, None if it cannot be imported."""
+
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", f"import {module}"], cwd=cwd, capture_output=True)
+    if result.returncode != 0:
+        return None
+
+    return round(time.perf_counter() - start, 3)
+
+
+def benchmark_startup(cwd: str, num_stages: int = 10, max_workers: Optional[int] = None) -> Dict:
+    """Benchmark the start up costs of the workflow: the time of a fresh interpreter to import the CLI and the cloud
+    libraries, and the time to start the workers of a number of stages with a new pool per stage against the warm pool,
+    each task importing the cloud libraries that are installed.
+
+    :param cwd: The folder of main.py.
+    :param num_stages: The number of stages to time.
+    :param max_workers: The number of workers, defaults to the number of CPUs.
+    :return: The timings.
+    """
+
+    max_workers = max_workers or os.cpu_count() or 1
+    interpreter = import_seconds("sys", cwd)
+    imports = {}
+    for module in BENCHMARK_IMPORTS:
+        seconds = import_seconds(module, cwd)
+        imports[module] = round(seconds - interpreter, 3) if seconds is not None else None
+
+    cloud_modules = [module for module, seconds in imports.items() if module != "main" and seconds is not None]
+    return {
+        "interpreter_seconds": interpreter,
+        "import_seconds": imports,
+        "workers": max_workers,
+        "stages": num_stages,
+        "pool_per_stage": time_stages(num_stages, max_workers, False, start_method(), cloud_modules),
+        "warm_pool": time_stages(num_stages, max_workers, True, start_method(), cloud_modules),
+    }
+
+
+def format_benchmark(result: Dict) -> str:
+    lines: List[str] = [f"Interpreter start up: {result['interpreter_seconds']}s"]
+    for module, seconds in result["import_seconds"].items():
+        lines.append(f"Import {module}: {'not installed' if seconds is None else f'{seconds}s'}")
+    for name in ("pool_per_stage", "warm_pool"):
+        timing = result[name]
+        lines.append(
+            f"{result['stages']} stages of {result['workers']} tasks, {name.replace('_', ' ')}: {timing['seconds']}s "
+            f"(first stage {timing['first_stage_seconds']}s), {timing['processes_started']} worker processes"
+        )
+
+    return "\n".join(lines)
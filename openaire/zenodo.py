@@ -0,0 +1,173 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+import json
+import logging
+import os
+import re
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import requests
+
+
+@dataclass
+class ZenodoFile:
+
+    """Dataclass to hold the metadata of a single file in a Zenodo record.
+
+    :param key: The file name on Zenodo, e.g. publication_1.tar
+    :param url: The url to download the file from.
+    :param size: Size of the file in bytes.
+    :param checksum: Checksum of the file, in the form <algorithm>:<hex digest>, e.g. md5:1a2b...
+    """
+
+    key: str
+    url: str
+    size: int
+    checksum: Optional[str] = None
+
+
+def zenodo_record_id(zenodo_url_path: str) -> str:
+    """Get the record id from the url of a Zenodo record, e.g. https://zenodo.org/records/10037121 -> 10037121
+
+    :param zenodo_url_path: Url of the Zenodo record.
+    :return: The record id.
+    """
+
+    return zenodo_url_path.rstrip("/").split("/")[-1]
+
+
+def zenodo_api_url(zenodo_url_path: str) -> str:
+    """Get the REST API url for a Zenodo record.
+
+    :param zenodo_url_path: Url of the Zenodo record.
+    :return: The API url of the record.
+    """
+
+    url = urlparse(zenodo_url_path)
+    return f"{url.scheme}://{url.netloc}/api/records/{zenodo_record_id(zenodo_url_path)}"
+
+
+def fetch_zenodo_record(zenodo_url_path: str, cache_path: Optional[str] = None, timeout: int = 60) -> Dict:
+    """Fetch the metadata of a Zenodo record, using a locally cached copy if there is one.
+
+    :param zenodo_url_path: Url of the Zenodo record.
+    :param cache_path: Path of the local cache file for the record metadata. Delete it to fetch the record again.
+    :param timeout: Timeout of the request in seconds.
+    :return: The record metadata.
+    """
+
+    func_name = fetch_zenodo_record.__name__
+
+    if cache_path and os.path.exists(cache_path):
+        print(f"{func_name}: using cached Zenodo record metadata: {cache_path}")
+        with open(cache_path, "r") as f:
+            return json.load(f)
+
+    api_url = zenodo_api_url(zenodo_url_path)
+    print(f"{func_name}: fetching Zenodo record metadata: {api_url}")
+    response = requests.get(api_url, timeout=timeout)
+    response.raise_for_status()
+    record = response.json()
+
+    if cache_path:
+        with open(cache_path, "w") as f:
+            json.dump(record, f, indent=2)
+
+    return record
+
+
+def zenodo_record_files(record: Dict, zenodo_url_path: str) -> List[ZenodoFile]:
+    """Get the files of a Zenodo record from its metadata.
+
+    :param record: The record metadata, see fetch_zenodo_record.
+    :param zenodo_url_path: Url of the Zenodo record, used when a file has no download link.
+    :return: The files in the record.
+    """
+
+    files = record.get("files", [])
+    # Newer versions of the Zenodo API nest the list of files under "entries".
+    if isinstance(files, dict):
+        files = files.get("entries", {})
+        files = list(files.values()) if isinstance(files, dict) else files
+
+    zenodo_files = []
+    for file in files:
+        # Older versions of the Zenodo API use filename and filesize.
+        key = file.get("key", file.get("filename"))
+        zenodo_files.append(
+            ZenodoFile(
+                key=key,
+                url=file.get("links", {}).get("self", f"{zenodo_url_path}/files/{key}"),
+                size=int(file.get("size", file.get("filesize", 0))),
+                checksum=file.get("checksum"),
+            )
+        )
+
+    return zenodo_files
+
+
+def build_part_inventory(files: List[ZenodoFile], table_names: List[str]) -> Dict[str, List[ZenodoFile]]:
+    """Match the files of a Zenodo record to the tables of the workflow.
+
+    A file belongs to a table if it is named <table>.tar or <table>_<n>.tar. The parts are sorted by n.
+
+    :param files: The files in the Zenodo record.
+    :param table_names: The names of the tables in the workflow.
+    :return: Dictionary of inventory[table_name] = list of part files.
+    """
+
+    inventory = {}
+    for name in table_names:
+        pattern = re.compile(rf"^{re.escape(name)}(?:_(\d+))?\.tar$")
+        parts = [(pattern.match(file.key), file) for file in files]
+        parts = [(int(match.group(1) or 0), file) for match, file in parts if match]
+        inventory[name] = [file for _, file in sorted(parts, key=lambda part: part[0])]
+
+    return inventory
+
+
+def load_part_inventory(
+    zenodo_url_path: str, table_names: List[str], cache_folder: str
+) -> Optional[Dict[str, List[ZenodoFile]]]:
+    """Build the part inventory of the workflow tables from the Zenodo record, caching the record metadata locally.
+
+    :param zenodo_url_path: Url of the Zenodo record.
+    :param table_names: The names of the tables in the workflow.
+    :param cache_folder: Folder where the record metadata and the inventory are cached.
+    :return: Dictionary of inventory[table_name] = list of part files, or None if the record could not be fetched.
+    """
+
+    func_name = load_part_inventory.__name__
+    record_id = zenodo_record_id(zenodo_url_path)
+
+    try:
+        record = fetch_zenodo_record(
+            zenodo_url_path, cache_path=os.path.join(cache_folder, f"zenodo_record_{record_id}.json")
+        )
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.warning(f"{func_name}: unable to fetch Zenodo record {zenodo_url_path}, exception={e}")
+        return None
+
+    inventory = build_part_inventory(zenodo_record_files(record, zenodo_url_path), table_names)
+
+    # Keep a readable copy of the inventory next to the record metadata.
+    with open(os.path.join(cache_folder, f"zenodo_inventory_{record_id}.json"), "w") as f:
+        json.dump({name: [asdict(part) for part in parts] for name, parts in inventory.items()}, f, indent=2)
+
+    return inventory
@@ -0,0 +1,73 @@
+# Copyright 2023 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: Alex Massen-Hane
+
+### Tests of the sample of the data dump.
+
+import gzip
+import io
+import json
+import os
+import tarfile
+import tempfile
+import unittest
+
+from openaire.sample import sample_tar_stream
+
+
+def make_tar(num_parts: int, rows_per_part: int) -> bytes:
+    """A tar of gzipped JSONL part files of random, so incompressible, rows."""
+
+    output = io.BytesIO()
+    with tarfile.open(fileobj=output, mode="w") as tar:
+        for part in range(num_parts):
+            lines = b"".join(
+                json.dumps({"id": f"50|{part}::{i}", "title": os.urandom(64).hex()}).encode("utf-8") + b"\n"
+                for i in range(rows_per_part)
+            )
+            data = gzip.compress(lines)
+            info = tarfile.TarInfo(f"publication/part-{part:05d}.json.gz")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+    return output.getvalue()
+
+
+class TestSampleTarStream(unittest.TestCase):
+    def test_stops_part_way_through_a_part_file(self):
+        data = make_tar(num_parts=2, rows_per_part=20000)
+        max_bytes = 100_000
+
+        with tempfile.TemporaryDirectory() as extract_path:
+            _, counts = sample_tar_stream(io.BytesIO(data), extract_path, "publication", 1.0, 0, max_bytes)
+
+        # The first part file alone is several MB, only the read ahead of the readers may go past the limit.
+        self.assertGreater(len(data), 20 * max_bytes)
+        self.assertGreaterEqual(counts["bytes_read"], max_bytes)
+        self.assertLess(counts["bytes_read"], max_bytes + 256 * 1024)
+        self.assertEqual(counts["part_files"], 1)
+        self.assertEqual(counts["rows_read"], counts["rows_kept"])
+
+    def test_reads_every_part_file_under_the_limit(self):
+        data = make_tar(num_parts=3, rows_per_part=100)
+
+        with tempfile.TemporaryDirectory() as extract_path:
+            ids, counts = sample_tar_stream(io.BytesIO(data), extract_path, "publication", 1.0, 0, 10 * len(data))
+            with gzip.open(os.path.join(extract_path, "publication", "part-00002.json.gz"), "rb") as f:
+                self.assertEqual(len(f.readlines()), 100)
+
+        self.assertEqual(counts["part_files"], 3)
+        self.assertEqual(counts["rows_kept"], 300)
+        self.assertEqual(len(ids), 300)